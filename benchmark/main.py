@@ -1,13 +1,14 @@
-import csv
 import json
 from pathlib import Path
 
 from loguru import logger
 import numpy as np
 import pandas as pd
-from tqdm import trange
+from tqdm import tqdm
 import typer
 
+from table_io import read_table, table_writer
+
 ROOT_DIRECTORY = Path("/codeexecution")
 RUNTIME_DIRECTORY = ROOT_DIRECTORY / "submission"
 DATA_DIRECTORY = ROOT_DIRECTORY / "data"
@@ -19,24 +20,70 @@ DEFAULT_OUTPUT = ROOT_DIRECTORY / "submission.csv"
 NOT_USED_IN_SUBMISSION = ("trip_hour_of_day", "trip_day_of_week")
 
 
-def simulate_row(parameters, epsilon=None, taxi_id=None):
+def simulate_taxi_ids(
+    rng, n_rows, chunk_size, max_records_per_individual, record_count_probs=None
+):
+    """
+    Yield the taxi IDs of `n_rows` rows a chunk of `chunk_size` rows at a time. Each
+    individual (numbered from 1,000,000) gets a run of consecutive records whose length is
+    drawn from a normal distribution, many individuals at a time, and clipped to between 1
+    and `max_records_per_individual`. Pass `record_count_probs` to draw the lengths from it
+    instead, as the probabilities of 1 to `len(record_count_probs)` records.
+    """
+    next_taxi_id = 1_000_000
+    n_records_left = 0
+    for start in range(0, n_rows, chunk_size):
+        n_chunk_rows = min(chunk_size, n_rows - start)
+
+        # finish the individual the last chunk ended on
+        n_current = min(n_records_left, n_chunk_rows)
+        taxi_ids = [np.full(n_current, next_taxi_id - 1)]
+        n_records_left -= n_current
+        n_needed = n_chunk_rows - n_current
+
+        while n_needed > 0:
+            n_lengths = n_needed // 30 + 1
+            if record_count_probs is None:
+                lengths = rng.normal(55, 25, size=n_lengths).astype(np.int64)
+            else:
+                lengths = rng.choice(len(record_count_probs), n_lengths, p=record_count_probs) + 1
+            lengths = np.clip(lengths, 1, max_records_per_individual)
+            ends = np.cumsum(lengths)
+            # the individual whose records cover the last row needed (if any of these do)
+            last = min(np.searchsorted(ends, n_needed), len(lengths) - 1)
+            lengths = lengths[: last + 1]
+            n_records_left = max(ends[last] - n_needed, 0)
+            lengths[-1] -= n_records_left
+
+            taxi_ids.append(
+                np.repeat(np.arange(next_taxi_id, next_taxi_id + len(lengths)), lengths)
+            )
+            next_taxi_id += len(lengths)
+            n_needed -= lengths.sum()
+
+        yield np.concatenate(taxi_ids)
+
+
+def simulate_chunk(parameters, rng, taxi_ids, epsilon=None):
     """
-    Naively create a valid row by picking random but valid values using the parameters file.
+    Naively create valid rows for each of `taxi_ids` by picking random but valid values for
+    whole columns at a time using the parameters file.
     """
-    row = {}
+    n_rows = len(taxi_ids)
+    chunk = {}
     if epsilon is not None:
-        row["epsilon"] = epsilon
-    if taxi_id is not None:
-        row["taxi_id"] = taxi_id
+        chunk["epsilon"] = np.full(n_rows, epsilon)
     for col, d in parameters["schema"].items():
-        if col == "taxi_id" or col in NOT_USED_IN_SUBMISSION:
+        if col in NOT_USED_IN_SUBMISSION:
             continue
-        if "values" in d:
-            value = np.random.choice(d["values"])
+        if col == "taxi_id":
+            values = taxi_ids
+        elif "values" in d:
+            values = rng.choice(d["values"], size=n_rows)
         elif "min" in d:
-            value = 0
-        row[col] = value
-    return row
+            values = np.zeros(n_rows)
+        chunk[col] = values.astype(d["dtype"])
+    return pd.DataFrame(chunk)
 
 
 def main(
@@ -44,9 +91,15 @@ def main(
     ground_truth_file: Path = DEFAULT_GROUND_TRUTH,
     output_file: Path = DEFAULT_OUTPUT,
     n_rows_to_simulate_per_epsilon: int = 100,
+    chunk_size: int = 1_000_000,
+    seed: int = None,
 ):
     """
     Create synthetic data appropriate to be submitted to the Sprint 2 competition.
+
+    The ground truth may be read from and the output written to CSV, Parquet (.parquet) or
+    Feather (.feather) files, chosen by extension; submissions must be CSV. Rows are simulated
+    and written `chunk_size` at a time; pass `seed` to make the output reproducible.
     """
     logger.info(f"reading schema from {parameters_file} ...")
     with parameters_file.open("r") as fp:
@@ -61,57 +114,30 @@ def main(
     dtypes = {
         column_name: d["dtype"] for column_name, d in parameters["schema"].items()
     }
-    ground_truth = pd.read_csv(ground_truth_file, dtype=dtypes)
+    ground_truth = read_table(ground_truth_file, dtypes)
     logger.info(f"... read ground truth dataframe of shape {ground_truth.shape}")
 
-    epsilons = [run["epsilon"] for run in parameters["runs"]]
-    columns = [
-        k for k in parameters["schema"].keys() if k not in NOT_USED_IN_SUBMISSION
-    ]
-    headers = ["epsilon"] + columns
+    rng = np.random.default_rng(seed)
 
-    # start writing the CSV with headers
     logger.info(f"writing output to {output_file}")
-    with output_file.open("w", newline="") as fp:
-        output = csv.DictWriter(
-            fp, fieldnames=headers, dialect="unix", quoting=csv.QUOTE_NONNUMERIC
-        )
-        output.writeheader()
-
-        n_rows = 0
-        for epsilon in epsilons:
-            current_individual_id = 1_000_000 - 1
-            n_records_left_for_current_individual = 0
-            for _ in trange(n_rows_to_simulate_per_epsilon):
-                # see if we need to switch to a new individual
-                if n_records_left_for_current_individual <= 0:
-                    next_individual_records = int(np.random.normal(55, 25))
-                    n_records_left_for_current_individual = max(
-                        1, next_individual_records
-                    )
-                    # increment which individual we're talking about
-                    current_individual_id += 1
-                # simulate the row
-                row = simulate_row(
-                    parameters, epsilon=epsilon, taxi_id=current_individual_id
+    n_rows = 0
+    with table_writer(output_file) as write:
+        for run in parameters["runs"]:
+            taxi_id_chunks = simulate_taxi_ids(
+                rng,
+                n_rows_to_simulate_per_epsilon,
+                chunk_size,
+                run["max_records_per_individual"],
+            )
+            for taxi_ids in tqdm(taxi_id_chunks, unit="chunk"):
+                chunk = simulate_chunk(
+                    parameters, rng, taxi_ids, epsilon=run["epsilon"]
                 )
-                # write it to STDOUT
-                output.writerow(row)
-                # decrement the counter for our current individual
-                n_records_left_for_current_individual -= 1
-                n_rows += 1
+                write(chunk)
+                n_rows += len(chunk)
 
     logger.success(f"finished writing {n_rows:,} rows to {output_file}")
 
-    logger.info("reading and writing one final time casting to correct dtypes ...")
-    df = pd.read_csv(output_file)
-    for col_name, d in parameters["schema"].items():
-        if col_name in NOT_USED_IN_SUBMISSION:
-            continue
-        df[col_name] = df[col_name].astype(d["dtype"])
-    df.to_csv(output_file, index=False)
-    logger.success("... done.")
-
 
 if __name__ == "__main__":
     typer.run(main)
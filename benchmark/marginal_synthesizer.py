@@ -0,0 +1,343 @@
+"""
+Create a differentially private synthetic submission from noisy marginals of the ground truth.
+
+For each run in `parameters.json`, the number of records of each taxi and, from a random
+`--contribution-bound` records of each taxi, the marginals of a fixed Bayesian network over the
+submission's binned columns (see `NETWORK`) are measured with the Gaussian mechanism, splitting
+that run's `epsilon`/`delta` evenly between them (through zero-concentrated differential
+privacy). Everything after that only uses the noisy counts: taxis are given numbers of records
+(at most `max_records_per_individual`) following the noisy distribution, and each column is
+sampled from its noisy distribution given the columns it depends on, a chunk of rows at a time
+across `--processes` worker processes.
+
+Being a fixed network of low order marginals, this is a baseline rather than a competitive
+solution, but its output looks like a real submission to the scorer, which makes it a
+realistic load for it when `--n-rows-per-epsilon` is set to the `max_records` limit.
+"""
+from contextlib import contextmanager
+import json
+import multiprocessing
+import os
+from pathlib import Path
+
+from loguru import logger
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+import typer
+
+from main import (
+    DEFAULT_GROUND_TRUTH,
+    DEFAULT_OUTPUT,
+    DEFAULT_PARAMS,
+    NOT_USED_IN_SUBMISSION,
+    simulate_taxi_ids,
+)
+from table_io import read_table, table_writer
+
+# each column in the order it is sampled, with the columns its distribution is conditioned on
+NETWORK = [
+    ("pickup_community_area", ()),
+    ("shift", ("pickup_community_area",)),
+    ("dropoff_community_area", ("pickup_community_area",)),
+    ("company_id", ("shift",)),
+    ("payment_type", ("company_id",)),
+    ("trip_seconds", ("pickup_community_area",)),
+    ("trip_miles", ("trip_seconds",)),
+    ("fare", ("trip_miles",)),
+    ("tips", ("payment_type", "fare")),
+    ("trip_total", ("fare", "tips")),
+]
+
+# records of each taxi the marginals are measured from by default (fewer if the run allows fewer
+# per individual); the noise grows with the number, so measuring every record is rarely worth it
+CONTRIBUTION_BOUND = 25
+
+# numeric columns are measured in bins of `step` from 0 up to `stop` (the last bin is open),
+# plus one bin for the negative values; the scorer bins them the same way
+NUMERIC_BINS = {
+    "fare": (100, 10),
+    "tips": (100, 10),
+    "trip_total": (100, 10),
+    "trip_seconds": (2000, 200),
+    "trip_miles": (100, 10),
+}
+
+
+def zcdp_rho(epsilon, delta):
+    """ Return the largest rho for which rho-zCDP implies (`epsilon`, `delta`)-DP. """
+    log_term = np.log(1 / delta)
+    return (np.sqrt(log_term + epsilon) - np.sqrt(log_term)) ** 2
+
+
+def bound_contributions(taxi_ids, contribution_bound, rng):
+    """ Return a mask keeping `contribution_bound` records of each taxi, chosen at random. """
+    order = rng.permutation(len(taxi_ids))
+    keep = np.empty(len(taxi_ids), dtype=bool)
+    keep[order] = (
+        pd.Series(taxi_ids[order]).groupby(taxi_ids[order]).cumcount().to_numpy()
+        < contribution_bound
+    )
+    return keep
+
+
+class Domain:
+    """ Encodes the values of one column as codes 0 to `size - 1` and decodes them again. """
+
+    def __init__(self, col, schema):
+        self.col = col
+        self.dtype = schema["dtype"]
+        self.min = schema.get("min")
+        self.max = schema.get("max")
+        if col in NUMERIC_BINS:
+            stop, self.step = NUMERIC_BINS[col]
+            self.values = None
+            self.size = stop // self.step + 1
+        else:
+            self.values = np.sort(schema["values"])
+            self.size = len(self.values)
+
+    def encode(self, values):
+        values = np.asarray(values)
+        if self.values is not None:
+            return np.searchsorted(self.values, values).clip(0, self.size - 1)
+        codes = np.floor_divide(values, self.step) + 1
+        return np.where(values < 0, 0, codes.clip(1, self.size - 1))
+
+    def decode(self, codes, rng):
+        if self.values is not None:
+            return self.values[codes].astype(self.dtype)
+        # a value drawn uniformly from within each bin, and the minimum for negative ones
+        values = (codes - 1) * self.step + rng.integers(0, self.step, size=len(codes))
+        values = np.where(codes == 0, self.min, values.clip(0, self.max))
+        return values.astype(self.dtype)
+
+
+class MarginalModel:
+    """
+    The conditional distribution of each column of `NETWORK` given its parents, as cumulative
+    probabilities laid end to end (one run of `size` per combination of parent codes, offset by
+    the index of that combination) so whole columns are sampled with one `searchsorted`.
+    """
+
+    def __init__(self, domains, cumulative):
+        self.domains = domains
+        self.cumulative = cumulative
+
+    @classmethod
+    def from_noisy_counts(cls, domains, noisy_counts, noise_scale):
+        """
+        Counts below `noise_scale` cannot be told from zero, so they are all raised to it:
+        values missing from the sample are then more likely than if they were clipped to zero,
+        which the scorer penalizes more than spreading rows too thinly.
+        """
+        cumulative = {}
+        for col, parents in NETWORK:
+            size = domains[col].size
+            counts = noisy_counts[col].reshape(-1, size).clip(noise_scale, None)
+            probs = counts / counts.sum(axis=1, keepdims=True)
+            cdf = probs.cumsum(axis=1)
+            cdf[:, -1] = 1.0
+            cumulative[col] = (cdf + np.arange(len(cdf))[:, None]).ravel()
+        return cls(domains, cumulative)
+
+    def sample_codes(self, n_rows, rng):
+        codes = {}
+        for col, parents in NETWORK:
+            size = self.domains[col].size
+            if parents:
+                parent = np.ravel_multi_index(
+                    [codes[p] for p in parents], [self.domains[p].size for p in parents]
+                )
+            else:
+                parent = np.zeros(n_rows, dtype=np.int64)
+            position = np.searchsorted(
+                self.cumulative[col], parent + rng.random(n_rows), side="right"
+            )
+            codes[col] = position - parent * size
+        return codes
+
+
+def measure_record_counts(taxi_ids, max_records_per_individual, sigma, rng):
+    """
+    Return the noisy number of taxis with each number of records from 1 to
+    `max_records_per_individual` (more are counted as that many). A taxi is counted once, so
+    the L2 sensitivity is 1. Numbers of records too rare to tell from the noise are dropped.
+    """
+    _, records = np.unique(taxi_ids, return_counts=True)
+    records = records.clip(None, max_records_per_individual)
+    counts = np.bincount(records, minlength=max_records_per_individual + 1)[1:]
+    noisy_counts = counts + rng.normal(0, sigma, size=len(counts))
+    noisy_counts[noisy_counts < 2 * sigma] = 0
+    return noisy_counts
+
+
+def measure_marginals(ground_truth, domains, contribution_bound, sigma, rng):
+    """
+    Return the noisy counts of each marginal of `NETWORK` in `ground_truth`, whose
+    contributions have been bounded. A taxi adds at most `contribution_bound` to the counts of
+    any marginal, which is their L2 sensitivity, so the noise has scale `contribution_bound`
+    times `sigma`.
+    """
+    codes = {col: domain.encode(ground_truth[col].to_numpy()) for col, domain in domains.items()}
+    noisy_counts = {}
+    for col, parents in NETWORK:
+        cols = parents + (col,)
+        shape = [domains[c].size for c in cols]
+        cells = np.ravel_multi_index([codes[c] for c in cols], shape)
+        counts = np.bincount(cells, minlength=int(np.prod(shape)))
+        noisy_counts[col] = counts + rng.normal(0, contribution_bound * sigma, size=len(counts))
+    return noisy_counts
+
+
+def _submission_columns(parameters):
+    return ["epsilon"] + [col for col in parameters["schema"] if col not in NOT_USED_IN_SUBMISSION]
+
+
+@contextmanager
+def chunk_writer(path, columns):
+    """
+    Like `table_writer`, but yield whether chunks should be given to the function it yields as
+    CSV text (without a header) rather than as dataframes, so that the workers rather than the
+    process writing the file spend the time formatting them.
+    """
+    if path.suffix.lower() in (".parquet", ".feather"):
+        with table_writer(path) as write:
+            yield write, False
+    else:
+        with path.open("w", newline="") as fp:
+            fp.write(",".join(columns) + "\n")
+            yield fp.write, True
+
+
+_WORKER_MODEL = {}
+
+
+def _init_worker(model, parameters, as_csv):
+    _WORKER_MODEL["model"] = model
+    _WORKER_MODEL["parameters"] = parameters
+    _WORKER_MODEL["as_csv"] = as_csv
+
+
+def _sample_chunk(args):
+    """ Return the number of rows sampled for `taxi_ids` and the rows, formatted for writing. """
+    taxi_ids, epsilon, seed = args
+    model = _WORKER_MODEL["model"]
+    rng = np.random.default_rng(seed)
+    codes = model.sample_codes(len(taxi_ids), rng)
+
+    chunk = {"epsilon": np.full(len(taxi_ids), epsilon)}
+    for col, d in _WORKER_MODEL["parameters"]["schema"].items():
+        if col in NOT_USED_IN_SUBMISSION:
+            continue
+        if col == "taxi_id":
+            chunk[col] = taxi_ids.astype(d["dtype"])
+        else:
+            chunk[col] = model.domains[col].decode(codes[col], rng)
+    chunk = pd.DataFrame(chunk)
+    if _WORKER_MODEL["as_csv"]:
+        return len(chunk), chunk.to_csv(index=False, header=False)
+    return len(chunk), chunk
+
+
+def main(
+    parameters_file: Path = DEFAULT_PARAMS,
+    ground_truth_file: Path = DEFAULT_GROUND_TRUTH,
+    output_file: Path = DEFAULT_OUTPUT,
+    n_rows_per_epsilon: int = typer.Option(
+        None,
+        help="Number of rows to synthesize for each run; by default the noisy number of "
+        "records in the ground truth, up to the run's max_records",
+    ),
+    contribution_bound: int = typer.Option(
+        CONTRIBUTION_BOUND,
+        help="Number of records of each taxi to measure the marginals from (at most the run's "
+        "max_records_per_individual)",
+    ),
+    processes: int = typer.Option(
+        None, help="Number of processes to sample with; by default one per CPU"
+    ),
+    chunk_size: int = 1_000_000,
+    seed: int = None,
+):
+    """
+    Create a differentially private synthetic submission from noisy marginals of the ground
+    truth.
+    """
+    logger.info(f"reading schema from {parameters_file} ...")
+    with parameters_file.open("r") as fp:
+        parameters = json.load(fp)
+
+    logger.info(f"reading ground truth from {ground_truth_file} ...")
+    dtypes = {column_name: d["dtype"] for column_name, d in parameters["schema"].items()}
+    ground_truth = read_table(ground_truth_file, dtypes)
+    logger.info(f"... read ground truth dataframe of shape {ground_truth.shape}")
+
+    domains = {col: Domain(col, parameters["schema"][col]) for col, _ in NETWORK}
+    seed_sequence = np.random.SeedSequence(seed)
+    processes = processes or os.cpu_count()
+
+    logger.info(f"writing output to {output_file}")
+    n_rows = 0
+    with chunk_writer(output_file, _submission_columns(parameters)) as (write, as_csv):
+        for run in parameters["runs"]:
+            bound = min(contribution_bound, run["max_records_per_individual"])
+            rng = np.random.default_rng(seed_sequence.spawn(1)[0])
+            taxi_ids = ground_truth["taxi_id"].to_numpy()
+            kept = ground_truth[bound_contributions(taxi_ids, bound, rng)]
+
+            # the budget is split evenly between the number of records of each taxi and the
+            # marginals, each a Gaussian mechanism of sensitivity 1 scaled by `sigma`
+            rho = zcdp_rho(run["epsilon"], run["delta"])
+            sigma = 1 / np.sqrt(2 * rho / (len(NETWORK) + 1))
+            logger.info(
+                f"epsilon {run['epsilon']}: measuring the records of each taxi and "
+                f"{len(NETWORK)} marginals of {len(kept):,} records (at most {bound} per "
+                f"taxi) with noise of scale {sigma:,.1f} per record"
+            )
+            record_counts = measure_record_counts(
+                taxi_ids, run["max_records_per_individual"], sigma, rng
+            )
+            if record_counts.sum() == 0:
+                record_counts[:] = 1
+            noisy_counts = measure_marginals(kept, domains, bound, sigma, rng)
+            model = MarginalModel.from_noisy_counts(domains, noisy_counts, bound * sigma)
+
+            n_run_rows = n_rows_per_epsilon
+            if n_run_rows is None:
+                n_run_rows = int(record_counts @ np.arange(1, len(record_counts) + 1))
+            n_run_rows = int(np.clip(n_run_rows, 1, run["max_records"]))
+            logger.info(f"epsilon {run['epsilon']}: sampling {n_run_rows:,} rows")
+
+            tasks = (
+                (taxi_ids, run["epsilon"], seed_sequence.spawn(1)[0])
+                for taxi_ids in simulate_taxi_ids(
+                    rng,
+                    n_run_rows,
+                    chunk_size,
+                    run["max_records_per_individual"],
+                    record_count_probs=record_counts / record_counts.sum(),
+                )
+            )
+            if processes > 1:
+                pool = multiprocessing.Pool(
+                    processes, initializer=_init_worker, initargs=(model, parameters, as_csv)
+                )
+                chunks = pool.imap(_sample_chunk, tasks)
+            else:
+                pool = None
+                _init_worker(model, parameters, as_csv)
+                chunks = map(_sample_chunk, tasks)
+            try:
+                for n_chunk_rows, chunk in tqdm(chunks, unit="chunk"):
+                    write(chunk)
+                    n_rows += n_chunk_rows
+            finally:
+                if pool is not None:
+                    pool.terminate()
+
+    logger.success(f"finished writing {n_rows:,} rows to {output_file}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1 @@
+../runtime/scripts/table_io.py
\ No newline at end of file
@@ -2,8 +2,34 @@
 
 exit_code=0
 
+# resources used by each phase of the run, written next to log.txt
+summary=/codeexecution/submission/resources.json
+# written by the monitor only if it stops the submission for going over a limit
+limit_file=/tmp/submission-limit-exceeded
+
+# run a phase of the run under the resource monitor, e.g. `monitor unzip -- unzip ...`
+monitor() {
+    phase=$1
+    shift
+    python /codeexecution/scripts/monitor.py --phase "$phase" --summary "$summary" "$@"
+}
+
+# optional limits for running the submission, e.g. SUBMISSION_TIME_LIMIT=3600 (seconds) and
+# SUBMISSION_MEMORY_LIMIT=16G (bytes, or with a K, M, G or T suffix); going over one is reported
+# in $limit_file rather than by exit status, which the submission could also exit with
+limits=(--limit-file "$limit_file")
+if [ -n "$SUBMISSION_TIME_LIMIT" ]
+then
+    limits+=(--time-limit "$SUBMISSION_TIME_LIMIT")
+fi
+if [ -n "$SUBMISSION_MEMORY_LIMIT" ]
+then
+    limits+=(--memory-limit "$SUBMISSION_MEMORY_LIMIT")
+fi
+
 {
     cd /codeexecution
+    rm -f "$summary" "$limit_file"
 
     # Check for gpu with nvidia-smi
     if [ $(which nvidia-smi) ]
@@ -15,25 +41,25 @@ exit_code=0
     echo "Running $processor image"
 
     echo "Unpacking submission..."
-    unzip ./submission/submission.zip -d ./
+    monitor unzip -- unzip ./submission/submission.zip -d ./
 
     if [ -f "main.py" ]
     then
         echo "Running submission with Python"
-        conda run --no-capture-output -n py-$processor python main.py
+        monitor submission "${limits[@]}" -- conda run --no-capture-output -n py-$processor python main.py
     elif [ -f "main.R" ]
     then
         echo "Running submission with R"
-        conda run --no-capture-output -n r-$processor Rscript main.R
+        monitor submission "${limits[@]}" -- conda run --no-capture-output -n r-$processor Rscript main.R
     elif [ -f "main" ]
     then
 	if [ $(stat -c %A main | cut -c4) = "x" ]
 	then
             echo "Running submission binary"
-            ./main
+            monitor submission "${limits[@]}" -- ./main
 	else
 	    echo -e "ERROR: main is not executable. Please run:\n\n\tchmod u+x main\n\nbefore creating your submission."
-	    exit_code==1
+	    exit_code=1
 	fi
 
     else
@@ -44,20 +70,27 @@ exit_code=0
     echo "Exporting submission.csv result..."
 
     # Valid scripts must create a "submission.csv" file within the same directory as main
-    if [ -f "submission.csv" ]
+    if [ -f "$limit_file" ]
+    then
+        echo "ERROR: Script was stopped for exceeding a resource limit, so its submission.csv is not used."
+        exit_code=1
+    elif [ -f "submission.csv" ]
     then
         echo "Script completed its run."
-        cp submission.csv ./submission/submission.csv
+        monitor copy -- cp submission.csv ./submission/submission.csv
     else
         echo "ERROR: Script did not produce a submission.csv file in the main directory."
         exit_code=1
     fi
 
     # Test that submission is valid
-    conda run -n py-$processor pytest -v
+    monitor validation -- conda run -n py-$processor pytest -v
 
     echo "================ END ================"
+    # the block runs in a subshell because it is piped to tee, so pass its exit code out
+    exit $exit_code
 } |& tee "/codeexecution/submission/log.txt"
+exit_code=${PIPESTATUS[0]}
 
 # copy for additional log uses
 cp /codeexecution/submission/log.txt /tmp/log
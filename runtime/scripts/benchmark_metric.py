@@ -0,0 +1,356 @@
+"""
+Time the stages of the scoring metric in `metric.py` on synthetic data of increasing size.
+
+For each size, a ground truth and a submission following the schema in parameters.json are
+generated (and kept in `--data-dir` so later runs can reuse them), then scored one stage at a
+time: reading, validating, binning and counting the inputs (the counts are the precomputed
+marginals and per-taxi counts every later stage uses), then the k-marginal, pickup-dropoff
+and higher order conjunction scores for each epsilon. The wall time, CPU time and peak memory
+allocated by each stage are written as JSON to `--output`; pass a previous output as
+`--baseline` to flag stages that got slower.
+"""
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import platform
+import resource
+import time
+import tracemalloc
+from typing import List
+
+from loguru import logger
+import numpy as np
+import pandas as pd
+import typer
+
+from metric import (
+    METRIC_VERSION,
+    NOT_USED_IN_SUBMISSION,
+    CountsAccumulator,
+    GroundTruthCounts,
+    SubmissionValidator,
+    TidyFormatKMarginalMetric,
+    bin_numerics,
+    read_chunks,
+    write_table,
+)
+
+ROOT_DIRECTORY = Path(__file__).parents[2]
+DEFAULT_PARAMETERS = ROOT_DIRECTORY / "data" / "parameters.json"
+DEFAULT_SIZES = [100_000, 1_000_000, 10_000_000, 40_000_000]
+
+# the average number of trips per taxi, well under the max_records_per_individual limit
+ROWS_PER_TAXI = 100
+# generated rows are written out a block at a time to bound the generator's memory
+GENERATE_BLOCK_ROWS = 1_000_000
+
+
+def _taxi_attributes(rng, schema, n_taxis):
+    """ Draw a home pickup area, usual shift and company for each taxi. """
+    return {
+        "pickup_community_area": rng.choice(
+            schema["pickup_community_area"]["values"], n_taxis
+        ),
+        "shift": rng.choice(schema["shift"]["values"], n_taxis),
+        "company_id": rng.choice(schema["company_id"]["values"], n_taxis),
+    }
+
+
+def generate_block(rng, schema, taxis, n_rows, epsilon=None):
+    """
+    Generate `n_rows` trips for the taxis described by `taxis` (see `_taxi_attributes`). Trips
+    start from their taxi's home area and usual shift most of the time so that per-taxi counts
+    and place/time marginals have some structure, and numeric columns are drawn from skewed
+    distributions clipped to the bounds in `schema`.
+    """
+    n_taxis = len(taxis["shift"])
+    taxi = rng.integers(0, n_taxis, n_rows)
+    min_taxi_id = schema["taxi_id"]["min"]
+
+    def categorical(col, usual=None, p_usual=0.0):
+        values = rng.choice(schema[col]["values"], n_rows)
+        if usual is not None:
+            values = np.where(rng.random(n_rows) < p_usual, usual[taxi], values)
+        return values.astype(schema[col]["dtype"])
+
+    def numeric(col, shape, scale):
+        values = rng.gamma(shape, scale, n_rows)
+        values = np.clip(values, schema[col]["min"], schema[col]["max"])
+        return values.astype(schema[col]["dtype"])
+
+    data = {}
+    if epsilon is not None:
+        data["epsilon"] = np.full(n_rows, epsilon)
+    data["taxi_id"] = (min_taxi_id + taxi).astype(schema["taxi_id"]["dtype"])
+    data["shift"] = categorical("shift", taxis["shift"], p_usual=0.6)
+    data["company_id"] = categorical("company_id", taxis["company_id"], p_usual=1.0)
+    data["pickup_community_area"] = categorical(
+        "pickup_community_area", taxis["pickup_community_area"], p_usual=0.5
+    )
+    for col in [
+        "dropoff_community_area",
+        "payment_type",
+        "trip_day_of_week",
+        "trip_hour_of_day",
+    ]:
+        data[col] = categorical(col)
+    data["fare"] = numeric("fare", 2, 8)
+    data["tips"] = numeric("tips", 1, 3)
+    data["trip_total"] = np.clip(
+        data["fare"].astype(np.int64) + data["tips"],
+        schema["trip_total"]["min"],
+        schema["trip_total"]["max"],
+    ).astype(schema["trip_total"]["dtype"])
+    data["trip_seconds"] = numeric("trip_seconds", 2, 400)
+    data["trip_miles"] = numeric("trip_miles", 1.5, 4)
+
+    df = pd.DataFrame(data)
+    if epsilon is not None:
+        df = df.drop(columns=list(NOT_USED_IN_SUBMISSION))
+    return df
+
+
+def generate(path, parameters, n_rows, seed, submission=False):
+    """
+    Write a synthetic ground truth (or submission, with the rows split evenly between the
+    epsilons of the runs in `parameters`) of `n_rows` rows to `path`. CSV files are written a
+    block at a time; the other formats need the whole table in memory.
+    """
+    schema = parameters["schema"]
+    rng = np.random.default_rng(seed)
+    taxis = _taxi_attributes(rng, schema, max(n_rows // ROWS_PER_TAXI, 1))
+
+    epsilons = [run["epsilon"] for run in parameters["runs"]] if submission else [None]
+    blocks = []
+    for i, epsilon in enumerate(epsilons):
+        n_epsilon_rows = n_rows // len(epsilons) + (i < n_rows % len(epsilons))
+        for start in range(0, n_epsilon_rows, GENERATE_BLOCK_ROWS):
+            block_rows = min(GENERATE_BLOCK_ROWS, n_epsilon_rows - start)
+            blocks.append((epsilon, block_rows))
+
+    tmp_path = path.with_name(f"{path.stem}.tmp{path.suffix}")
+    if path.suffix == ".csv":
+        for i, (epsilon, block_rows) in enumerate(blocks):
+            df = generate_block(rng, schema, taxis, block_rows, epsilon)
+            df.to_csv(tmp_path, index=False, mode="w" if i == 0 else "a", header=i == 0)
+    else:
+        df = pd.concat(
+            [
+                generate_block(rng, schema, taxis, block_rows, epsilon)
+                for epsilon, block_rows in blocks
+            ],
+            ignore_index=True,
+        )
+        write_table(df, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class StageRecorder:
+    """
+    Accumulates the wall time, CPU time and peak traced memory of each stage. A stage may be
+    measured several times (e.g., once per chunk); its times are summed and its peak is the
+    largest of the peaks. Memory is traced with `tracemalloc`, which numpy reports its
+    allocations to, so the peak is the most memory allocated at once while the stage ran.
+    """
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.records = {}
+
+    @contextmanager
+    def stage(self, name, epsilon=None):
+        record = self.records.setdefault(
+            (name, epsilon),
+            {
+                "stage": name,
+                "epsilon": epsilon,
+                "seconds": 0.0,
+                "cpu_seconds": 0.0,
+                "peak_memory_bytes": None,
+            },
+        )
+        if self.trace_memory:
+            tracemalloc.start()
+        start, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record["seconds"] += time.perf_counter() - start
+            record["cpu_seconds"] += time.process_time() - start_cpu
+            if self.trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                record["peak_memory_bytes"] = max(record["peak_memory_bytes"] or 0, peak)
+
+
+def benchmark(ground_truth_path, submission_path, parameters, chunk_size, trace_memory):
+    """ Score the submission stage by stage, returning the stage records and the scores. """
+    recorder = StageRecorder(trace_memory=trace_memory)
+
+    def read(path, name):
+        chunks = iter(read_chunks(path, chunk_size))
+        while True:
+            with recorder.stage(f"read_{name}"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    accumulator = CountsAccumulator(by_epsilon=False)
+    for chunk in read(ground_truth_path, "ground_truth"):
+        with recorder.stage("bin_ground_truth"):
+            binned = bin_numerics(chunk)
+        with recorder.stage("count_ground_truth"):
+            accumulator.update(binned)
+    with recorder.stage("count_ground_truth"):
+        (ground_truth,) = accumulator.finalize().values()
+        ground_truth_counts = GroundTruthCounts(
+            ground_truth.marginals, ground_truth.hoc_counts, ground_truth.taxi_ids
+        )
+
+    validator = SubmissionValidator(parameters)
+    accumulator = CountsAccumulator()
+    for chunk in read(submission_path, "submission"):
+        with recorder.stage("validate_submission"):
+            validator.update(chunk)
+        with recorder.stage("bin_submission"):
+            binned = bin_numerics(chunk)
+        with recorder.stage("count_submission"):
+            accumulator.update(binned)
+    with recorder.stage("validate_submission"):
+        validator.finalize()
+    with recorder.stage("count_submission"):
+        submitted_counts = accumulator.finalize()
+
+    scores = []
+    for epsilon, counts in submitted_counts.items():
+        metric = TidyFormatKMarginalMetric(
+            raw_actual_df=None,
+            raw_submitted_df=None,
+            ground_truth_counts=ground_truth_counts,
+            submitted_counts=counts,
+        )
+        with recorder.stage("k_marginal", epsilon):
+            k_marginal_score = metric.scaled_k_marginal_score()
+        with recorder.stage("pickup_dropoff", epsilon):
+            pickup_dropoff_score = metric.pickup_dropoff_score()
+        with recorder.stage("higher_order_conjunction", epsilon):
+            higher_order_conjunction_score = metric.higher_order_conjunction()
+        scores.append(
+            {
+                "epsilon": epsilon,
+                "k_marginal_score": k_marginal_score,
+                "pickup_dropoff_score": pickup_dropoff_score,
+                "higher_order_conjunction": higher_order_conjunction_score,
+            }
+        )
+    return list(recorder.records.values()), scores
+
+
+def find_regressions(results, baseline, tolerance):
+    """ List the stages in `results` that took more than (1 + tolerance) x their baseline time. """
+    baseline_seconds = {
+        (result["rows"], stage["stage"], stage["epsilon"]): stage["seconds"]
+        for result in baseline["results"]
+        for stage in result["stages"]
+    }
+    regressions = []
+    for result in results:
+        for stage in result["stages"]:
+            key = (result["rows"], stage["stage"], stage["epsilon"])
+            if key in baseline_seconds and stage["seconds"] > baseline_seconds[key] * (
+                1 + tolerance
+            ):
+                regressions.append(
+                    f"{stage['stage']} (rows={key[0]:,}, epsilon={key[2]}): "
+                    f"{stage['seconds']:.2f}s vs {baseline_seconds[key]:.2f}s"
+                )
+    return regressions
+
+
+def main(
+    rows: List[int] = typer.Option(
+        DEFAULT_SIZES, help="Number of rows to benchmark; may be given more than once"
+    ),
+    output: Path = typer.Option(
+        Path("benchmark-metric.json"), help="Path to write the JSON benchmark results to"
+    ),
+    parameters_json: Path = typer.Option(
+        DEFAULT_PARAMETERS, help="Path to parameters.json defining the schema and runs"
+    ),
+    data_dir: Path = typer.Option(
+        Path("/tmp/kmarginal-benchmark"),
+        help="Directory in which generated data is kept between runs",
+    ),
+    file_format: str = typer.Option(
+        "csv", "--format", help="File format for the generated data (csv, parquet, feather, npy)"
+    ),
+    seed: int = typer.Option(0, help="Random seed for the generated data"),
+    chunk_size: int = typer.Option(1_000_000, help="Number of rows to read at a time"),
+    trace_memory: bool = typer.Option(
+        True, help="Trace the peak memory of each stage (slows down some stages)"
+    ),
+    baseline: Path = typer.Option(
+        None, help="Previous benchmark results to compare the stage times against"
+    ),
+    tolerance: float = typer.Option(
+        0.25, help="Fraction by which a stage may be slower than the baseline"
+    ),
+):
+    """
+    Benchmark each stage of the scoring metric on generated data of each size in `--rows`.
+    """
+    parameters = json.loads(parameters_json.read_text())
+    data_dir.mkdir(parents=True, exist_ok=True)
+
+    results = []
+    for n_rows in rows:
+        paths = {}
+        for kind, submission in [("ground-truth", False), ("submission", True)]:
+            paths[kind] = data_dir / f"{kind}-{n_rows}-{seed}.{file_format}"
+            if not paths[kind].exists():
+                logger.info(f"generating {n_rows:,} row {kind} at {paths[kind]}")
+                generate(paths[kind], parameters, n_rows, seed + submission, submission)
+
+        logger.info(f"benchmarking scoring of {n_rows:,} rows")
+        stages, scores = benchmark(
+            paths["ground-truth"], paths["submission"], parameters, chunk_size, trace_memory
+        )
+        for stage in stages:
+            logger.info(
+                f"{stage['stage']:>26} epsilon={str(stage['epsilon']):>4}: "
+                f"{stage['seconds']:8.2f}s wall {stage['cpu_seconds']:8.2f}s cpu "
+                f"{(stage['peak_memory_bytes'] or 0) / 2**20:9.1f} MiB peak"
+            )
+        results.append({"rows": n_rows, "stages": stages, "scores": scores})
+
+    report = {
+        "metric_version": METRIC_VERSION,
+        "format": file_format,
+        "chunk_size": chunk_size,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "cpu_count": os.cpu_count(),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "results": results,
+    }
+    output.write_text(json.dumps(report, indent=2))
+    logger.success(f"wrote benchmark results to {output}")
+
+    if baseline is not None:
+        regressions = find_regressions(
+            results, json.loads(baseline.read_text()), tolerance
+        )
+        if regressions:
+            logger.error(
+                "stages slower than the baseline:\n  " + "\n  ".join(regressions)
+            )
+            raise typer.Exit(1)
+        logger.success(f"no stage is more than {tolerance:.0%} slower than {baseline}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
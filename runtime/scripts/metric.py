@@ -1,17 +1,32 @@
+import copy
+import hashlib
 import json
+import os
+import resource
 import shutil
+import sys
 import tempfile
+import threading
+import time
 from collections import defaultdict
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext
+from functools import partial
+from itertools import combinations
 from pathlib import Path
+from typing import List
 
 import numpy as np
 import pandas as pd
 import typer
 from loguru import logger
-from tqdm import tqdm, trange
+from tqdm import tqdm
 
 import multiprocessing
 
+import table_io
+from table_io import FILE_FORMATS, write_table  # noqa: F401
+
 COL_TYPES = {
     "trip_day_of_week": "int8",
     "trip_hour_of_day": "int8",
@@ -66,53 +81,1761 @@ MARGINAL_COLS = [
 PICKUP_DROPOFF_COLS = ["pickup_community_area", "dropoff_community_area"]
 NOT_USED_IN_SUBMISSION = ("trip_hour_of_day", "trip_day_of_week")
 
-# kmarginal constants
-PERMUTATIONS = [
-    ALWAYS_GROUP_BY + [c1, c2]
-    for c1 in MARGINAL_COLS
-    for c2 in MARGINAL_COLS
-    if c1 != c2
-]
-PRECALC_DIR = Path(tempfile.gettempdir()) / "kmarginal"
-PRECALC_GT_DIR = PRECALC_DIR / "gt"
-PRECALC_DP_DIR = PRECALC_DIR / "dp"
+# inclusive ranges of the values each categorical column may take (see parameters.json); binned
+# numeric columns take the values 0 through len(BINS[col]) - 2
+CATEGORICAL_RANGES = {
+    "shift": (0, 20),
+    "company_id": (0, 100),
+    "pickup_community_area": (-1, 77),
+    "dropoff_community_area": (-1, 77),
+    "payment_type": (-1, 8),
+    "trip_day_of_week": (0, 6),
+    "trip_hour_of_day": (0, 23),
+}
+
+# kmarginal constants: by default each marginal is ALWAYS_GROUP_BY plus a pair of MARGINAL_COLS
+MARGINAL_ORDER = 2
+COUNT_DTYPE = np.uint32
+# marginals are summed out of shared count cubes of at most this many cells (per epsilon);
+# marginals of more cells than MAX_DENSE_CELLS are counted sparsely from the distinct rows
+MAX_CUBE_CELLS = 2 ** 21
+MAX_DENSE_CELLS = 2 ** 22
+# columns whose codes make up the key of a binned row, from which any of the marginals follows
+ROW_KEY_COLS = ALWAYS_GROUP_BY + MARGINAL_COLS
+
+# number of submission rows read, validated and counted at a time
+CHUNK_SIZE = 1_000_000
+
+# ground truth counts cache; bump the version whenever the way counts are computed changes
+METRIC_VERSION = 2
+CACHE_DIR = Path(tempfile.gettempdir()) / "kmarginal"
+# submission counts are cached by the rows of each epsilon split into this many shards of taxis
+SUBMISSION_SHARDS = 16
+# cached submission counts that the latest version of no submission file refers to are removed
+# once they have not been written or used for this many seconds
+SUBMISSION_CACHE_GRACE = 60 * 60
+# counts handed to worker processes are memory-mapped from here (RAM-backed where available)
+SHARED_MEMORY_DIR = Path("/dev/shm") if os.path.isdir("/dev/shm") else None
+# submitted counts each worker of a `WorkerPool` keeps memory-mapped at a time
+WORKER_SUBMISSIONS_KEPT = 4
+
+# higher order conjunction constants
+HIGHER_ORDER_CONJUNCTION_ITERS = 50
+MIN_HOC_DIFF = 5
+MAX_HOC_DIFF = 50
+# number of draws compared at once and rough upper bound on the memory used per block of taxis
+HOC_DRAWS_PER_BATCH = 64
+HOC_BLOCK_BYTES = 64 * 2 ** 20
+# guards the ground truth's higher order conjunction references, shared by scoring threads
+_HOC_REFERENCE_LOCK = threading.Lock()
+
+# approximate scoring constants: the k-marginal scores are estimated from a random sample of the
+# place/times, whose fraction doubles from the initial to the maximum fraction until the 95%
+# interval for the overall score is within the tolerance (in points either side); at least the
+# minimum number of place/times are sampled so that the interval can use the normal quantile
+APPROXIMATE_INITIAL_FRACTION = 1 / 16
+APPROXIMATE_MAX_FRACTION = 1 / 2
+APPROXIMATE_MIN_STRATA = 50
+APPROXIMATE_TOLERANCE = 10.0
+APPROXIMATE_Z = 1.96
+
+
+def _bin_grid(bins):
+    """
+    Return the first finite edge, the width and the number of `bins`, which must be evenly
+    spaced between open ends so that a value's bin is clamped integer division.
+    """
+    edges = bins[1:-1]
+    step = edges[1] - edges[0]
+    if not (np.isneginf(bins[0]) and np.isposinf(bins[-1]) and np.all(np.diff(edges) == step)):
+        raise ValueError(f"bins must be evenly spaced between open ends, not {bins}")
+    if len(bins) - 1 > 256:
+        raise ValueError(f"{len(bins) - 1} bins do not fit in uint8 codes")
+    return edges[0], step, len(bins) - 1
+
+
+BIN_GRIDS = {col: _bin_grid(bins) for col, bins in BINS.items()}
+
+
+def bin_codes(values, col, out=None):
+    """
+    Return the bin of each of `values` in `BINS[col]` as uint8 codes, written into `out` if
+    given. This is exactly `pd.cut(values, BINS[col], right=False, labels=False)`: integers
+    are clamped to the finite edges and divided by the bin width in their own type, and other
+    values (whose division could round across an edge) are looked up among the edges.
+    """
+    values = np.asarray(values)
+    if out is None:
+        out = np.empty(len(values), dtype=np.uint8)
+    start, step, n_bins = BIN_GRIDS[col]
+    # values below `start` clamp to one bin width under it, so that every code is the quotient
+    # of the clamped value less that bound, which runs from 0 to (n_bins - 1) * step
+    low, high = start - step, start + (n_bins - 2) * step
+    if (
+        values.dtype.kind in "iu"
+        and float(low).is_integer()
+        and float(step).is_integer()
+        and np.iinfo(values.dtype).min <= low
+        and (n_bins - 1) * step <= np.iinfo(values.dtype).max
+    ):
+        clamped = np.clip(values, int(low), int(high))
+        clamped -= values.dtype.type(low)
+        np.floor_divide(clamped, values.dtype.type(step), out=out, casting="unsafe")
+    else:
+        out[:] = np.searchsorted(BINS[col][1:-1], values, side="right")
+    return out
+
+
+def bin_numerics(df):
+    for col in df.columns:
+        if col in BINS:
+            # replace the column rather than writing into it, since its codes have another type
+            df[col] = bin_codes(df[col].to_numpy(), col)
+    return df
+
+
+def read_chunks(path, chunk_size=None, binned=False):
+    """
+    Read a table of records in chunks of at most `chunk_size` rows (or all at once if
+    `chunk_size` is None) with the column types in `COL_TYPES`. The format is chosen by the
+    file extension (see `FILE_FORMATS`). With `binned`, the numeric columns are replaced by
+    their bin codes (see `bin_numerics`) as each chunk is read; Parquet, Feather and .npy
+    columns are binned straight from the (memory-mapped) file rather than from a frame.
+    """
+    converters = {col: partial(bin_codes, col=col) for col in BINS} if binned else None
+    return table_io.read_chunks(path, COL_TYPES, chunk_size, converters=converters)
+
+
+def read_table(path):
+    """Read a whole table of records; see `read_chunks`."""
+    return next(read_chunks(path))
+
+
+def _column_domain(col):
+    """
+    Return the offset and size of the integer codes used to represent a (binned) column in the
+    dense count arrays, so that code = value - offset and 0 <= code < size.
+    """
+    if col in BINS:
+        return 0, len(BINS[col]) - 1
+    low, high = CATEGORICAL_RANGES[col]
+    return low, high - low + 1
+
+
+def _row_key_layout():
+    """ The bit offset and width of the codes of each of ROW_KEY_COLS in a packed row key. """
+    layout, shift = {}, 0
+    for col in ROW_KEY_COLS:
+        width = (_column_domain(col)[1] - 1).bit_length()
+        layout[col] = (shift, width)
+        shift += width
+    assert shift <= 64
+    return layout
+
+
+def _unpack(keys, col):
+    """ The codes of `col` in packed row keys (see `PackedRows`). """
+    shift, width = PackedRows.LAYOUT[col]
+    return ((keys >> np.uint64(shift)) & np.uint64((1 << width) - 1)).astype(np.uint8)
+
+
+class PackedRows:
+    """
+    Binned rows packed for counting: the integer codes (see `_column_domain`) of the
+    ROW_KEY_COLS of each row are bit-packed into one uint64 key, kept alongside the taxi ids,
+    which takes 16 bytes per row instead of the 100 or so of a dataframe.
+
+    When packed by epsilon the rows are sorted by epsilon (in order of appearance) and
+    `offsets` marks where each epsilon's rows start, so that `partitions` yields each epsilon's
+    rows as views without copying. Otherwise all rows are under the epsilon `None`.
+    """
+
+    # the bit offset and width of the codes of each column within a key
+    LAYOUT = _row_key_layout()
+
+    def __init__(self, keys, taxi_ids, epsilons=(None,), offsets=None):
+        self.keys = keys
+        self.taxi_ids = taxi_ids
+        self.epsilons = list(epsilons)
+        self.offsets = np.array([0, len(keys)]) if offsets is None else offsets
+
+    @classmethod
+    def from_frame(cls, df, by_epsilon=True):
+        """ Pack a binned dataframe, partitioned by its epsilon column if `by_epsilon`. """
+        keys = np.zeros(len(df), dtype=np.uint64)
+        for col, (shift, _) in cls.LAYOUT.items():
+            offset, size = _column_domain(col)
+            codes = df[col].to_numpy().astype(np.int16) - offset
+            if len(codes) and (codes.min() < 0 or codes.max() >= size):
+                raise ValueError(
+                    f"column {col} contains values outside of the expected range "
+                    f"[{offset}, {offset + size - 1}]"
+                )
+            keys |= codes.astype(np.uint64) << np.uint64(shift)
+        taxi_ids = df["taxi_id"].to_numpy()
+        if not by_epsilon or "epsilon" not in df.columns:
+            return cls(keys, taxi_ids)
+
+        groups, epsilons = pd.factorize(df["epsilon"])
+        offsets = np.r_[0, np.cumsum(np.bincount(groups, minlength=len(epsilons)))]
+        if len(epsilons) > 1:
+            order = np.argsort(groups, kind="stable")
+            keys, taxi_ids = keys[order], taxi_ids[order]
+        return cls(keys, taxi_ids, epsilons.tolist(), offsets)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def codes(self, col):
+        return _unpack(self.keys, col)
+
+    def partitions(self):
+        """ Yield each epsilon with its rows. """
+        for i, epsilon in enumerate(self.epsilons):
+            rows = slice(self.offsets[i], self.offsets[i + 1])
+            yield epsilon, PackedRows(self.keys[rows], self.taxi_ids[rows])
+
+    def select(self, mask):
+        """ The rows where the boolean `mask` is set, keeping the partitions. """
+        offsets = np.r_[0, np.cumsum(mask)][self.offsets]
+        return PackedRows(self.keys[mask], self.taxi_ids[mask], self.epsilons, offsets)
+
+    @classmethod
+    def concat(cls, parts):
+        """ Concatenate the rows of unpartitioned `PackedRows`. """
+        return cls(
+            np.concatenate([part.keys for part in parts]),
+            np.concatenate([part.taxi_ids for part in parts]),
+        )
+
+
+class MarginalCounter:
+    """
+    Counts `PackedRows` over any combination of columns. Each column is unpacked once as
+    compact integer codes; a combination of columns is then mixed-radix encoded into a single
+    integer key per row and histogrammed with `np.bincount` into a dense array with one axis
+    per column.
+
+    Rows may also be assigned to one of `n_groups` groups (e.g., one per epsilon) by passing an
+    integer group code for every row in `groups`; the counts then get a leading group axis so
+    that every group is counted in the same pass.
+    """
+
+    def __init__(self, rows, groups=None, n_groups=None):
+        self.rows = rows
+        self.n_rows = len(rows)
+        self.groups = groups
+        self.n_groups = n_groups
+        self._codes = {}
+
+    def codes(self, col):
+        if col not in self._codes:
+            self._codes[col] = self.rows.codes(col)
+        return self._codes[col]
+
+    @property
+    def n_leading_axes(self):
+        return 0 if self.groups is None else 1
+
+    def _keys(self, cols):
+        shape = tuple(_column_domain(col)[1] for col in cols)
+        codes = [self.codes(col) for col in cols]
+        if self.groups is not None:
+            shape = (self.n_groups,) + shape
+            codes = [self.groups] + codes
+        return np.ravel_multi_index(codes, shape), shape
+
+    def count(self, cols):
+        keys, shape = self._keys(cols)
+        counts = np.bincount(keys, minlength=int(np.prod(shape)))
+        return counts.astype(COUNT_DTYPE).reshape(shape)
+
+    def count_sparse(self, cols):
+        """ `count` as `SparseCounts`, for counts with too many cells to hold densely. """
+        keys, shape = self._keys(cols)
+        keys, counts = np.unique(keys, return_counts=True)
+        return SparseCounts(keys, counts.astype(COUNT_DTYPE), shape)
+
+
+def _distinct_column_sets(perms):
+    """
+    Map each permutation of columns to the first permutation with the same set of columns,
+    which is the only one that needs counting.
+    """
+    first_by_set = {}
+    return {
+        perm: first_by_set.setdefault(frozenset(perm), perm) for perm in map(tuple, perms)
+    }
+
+
+def _expand_permutations(counts, perms, n_leading_axes=0):
+    """
+    Given counts for each distinct set of columns, return counts for every permutation, using
+    transposed views for permutations that reorder already counted columns.
+    """
+    leading = list(range(n_leading_axes))
+    return {
+        perm: counts[counted]
+        if perm == counted
+        else counts[counted].transpose(
+            leading + [n_leading_axes + counted.index(c) for c in perm]
+        )
+        for perm, counted in _distinct_column_sets(perms).items()
+    }
+
+
+def _n_cells_of_shape(shape):
+    return int(np.prod(shape, dtype=np.int64))
+
+
+def _n_cells(cols):
+    """ The number of cells in the dense counts over `cols`. """
+    return _n_cells_of_shape([_column_domain(col)[1] for col in cols])
+
+
+def _cover_with_cubes(column_sets, max_cells=MAX_CUBE_CELLS):
+    """
+    Greedily choose the higher order sets of columns ("cubes") to count so that each of
+    `column_sets` is a subset of a cube, and no cube has more than `max_cells` cells unless it
+    is just one of `column_sets`. Each cube starts as the largest set not yet covered and
+    repeatedly takes in the uncovered set that adds the fewest cells while it stays within
+    `max_cells`; every set inside it is then covered.
+    """
+    uncovered = sorted(dict.fromkeys(map(tuple, column_sets)), key=_n_cells, reverse=True)
+    cubes = []
+    while uncovered:
+        cube = list(uncovered[0])
+        while True:
+            uncovered = [cols for cols in uncovered if not set(cols) <= set(cube)]
+            grown = [cube + [col for col in cols if col not in cube] for cols in uncovered]
+            grown = [cols for cols in grown if _n_cells(cols) <= max_cells]
+            if not grown:
+                break
+            cube = min(grown, key=_n_cells)
+        cubes.append(tuple(cube))
+    return cubes
+
+
+def _marginals_from_cubes(cube_counts, perms, n_leading_axes=0):
+    """
+    Given the counts of each cube (see `_cover_with_cubes`), return counts for every
+    permutation of columns, summing out the other columns of the smallest cube containing
+    each distinct set of columns, and using transposed views for the other permutations.
+    """
+    leading = list(range(n_leading_axes))
+    counts = {}
+    for perm in dict.fromkeys(_distinct_column_sets(perms).values()):
+        cube = min((c for c in cube_counts if set(perm) <= set(c)), key=_n_cells)
+        other_axes = tuple(n_leading_axes + i for i, col in enumerate(cube) if col not in perm)
+        summed = cube_counts[cube]
+        if other_axes:
+            summed = summed.sum(axis=other_axes, dtype=summed.dtype)
+        kept = tuple(col for col in cube if col in perm)
+        if kept != perm:
+            summed = summed.transpose(leading + [n_leading_axes + kept.index(c) for c in perm])
+        counts[perm] = summed
+    return _expand_permutations(counts, perms, n_leading_axes)
+
+
+class SparseCounts:
+    """
+    Counts over columns with too many cells to count densely (see MAX_DENSE_CELLS): the
+    indices (`keys`) into the flattened dense array of shape `shape` of the cells with any
+    rows, in order, and their counts.
+    """
+
+    def __init__(self, keys, counts, shape):
+        self.keys = keys
+        self.counts = counts
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_row_keys(cls, row_keys, weights, cols):
+        """ Count packed row keys (see `PackedRows`) with a weight each over `cols`. """
+        rows = PackedRows(row_keys, None)
+        shape = tuple(_column_domain(col)[1] for col in cols)
+        keys = np.ravel_multi_index([rows.codes(col) for col in cols], shape)
+        keys, inverse = np.unique(keys, return_inverse=True)
+        counts = np.rint(np.bincount(inverse, weights=weights, minlength=len(keys)))
+        nonzero = counts != 0
+        return cls(keys[nonzero], counts[nonzero].astype(COUNT_DTYPE), shape)
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.counts.nbytes
+
+    def group_sums(self, n_group_axes):
+        """ The total count of each group, indexed by the leading `n_group_axes` axes. """
+        group_shape = self.shape[:n_group_axes]
+        groups = self.keys // _n_cells_of_shape(self.shape[n_group_axes:])
+        sums = np.bincount(
+            groups, weights=self.counts, minlength=_n_cells_of_shape(group_shape)
+        )
+        return sums.astype(np.int64).reshape(group_shape)
+
+    def select_groups(self, groups, n_group_axes):
+        """
+        The counts of only the groups with the (sorted) flat indices `groups` into the leading
+        `n_group_axes` axes, which are replaced by one axis indexing `groups`.
+        """
+        n_cells = _n_cells_of_shape(self.shape[n_group_axes:])
+        key_groups = self.keys // n_cells
+        positions = np.searchsorted(groups, key_groups)
+        kept = positions < len(groups)
+        kept[kept] = groups[positions[kept]] == key_groups[kept]
+        keys = positions[kept] * n_cells + self.keys[kept] % n_cells
+        return SparseCounts(keys, self.counts[kept], (len(groups),) + self.shape[n_group_axes:])
+
+
+def _sparse_marginals(row_keys, weights, perms):
+    """
+    `SparseCounts` for each of `perms` from packed row keys (see `PackedRows`), which may
+    repeat, with a weight each. The distinct rows are found once and every marginal is summed
+    out of them.
+    """
+    row_keys, inverse = np.unique(row_keys, return_inverse=True)
+    weights = np.bincount(inverse, weights=weights, minlength=len(row_keys))
+    return {
+        tuple(perm): SparseCounts.from_row_keys(row_keys, weights, perm) for perm in tqdm(perms)
+    }
+
+
+class MarginalSpec:
+    """
+    The marginals compared by the k-marginal metric: ALWAYS_GROUP_BY together with each
+    combination of `order` of the columns `cols` (any of MARGINAL_COLS). Every ordering of the
+    same columns gets the same score, so each combination is compared once, with its columns
+    in the order of `cols`.
+
+    These and the pickup-dropoff counts make up the marginals counted for each data set
+    (`to_count`). Those of at most `max_dense_cells` cells are counted as dense arrays: rather
+    than once per marginal, the rows are counted once per cube of `cubes` (see
+    `_cover_with_cubes`), and the marginals are summed out of the cubes. The others (`sparse`)
+    are summed out of the counts of the distinct rows as `SparseCounts`.
+    """
+
+    def __init__(
+        self,
+        order=MARGINAL_ORDER,
+        cols=MARGINAL_COLS,
+        max_cube_cells=MAX_CUBE_CELLS,
+        max_dense_cells=MAX_DENSE_CELLS,
+    ):
+        cols = list(dict.fromkeys(cols))
+        unknown = [col for col in cols if col not in MARGINAL_COLS]
+        if unknown:
+            raise ValueError(f"marginal columns must be among {MARGINAL_COLS}, not {unknown}")
+        if not 1 <= order <= len(cols):
+            raise ValueError(f"marginal order must be from 1 to {len(cols)}, not {order}")
+        self.order = order
+        self.cols = cols
+        self.permutations = [
+            ALWAYS_GROUP_BY + list(combination) for combination in combinations(cols, order)
+        ]
+        self.to_count = self.permutations + [PICKUP_DROPOFF_COLS]
+        self.dense = [perm for perm in self.to_count if _n_cells(perm) <= max_dense_cells]
+        self.sparse = [perm for perm in self.to_count if _n_cells(perm) > max_dense_cells]
+        self.cubes = _cover_with_cubes(self.dense, max_cube_cells)
+
+    def group_counts(self, marginals):
+        """ The number of rows in each place/time, from the `marginals` of some `Counts`. """
+        counts = marginals[tuple(self.permutations[0])]
+        if isinstance(counts, SparseCounts):
+            return counts.group_sums(len(ALWAYS_GROUP_BY))
+        cell_axes = tuple(range(len(ALWAYS_GROUP_BY), counts.ndim))
+        return counts.sum(axis=cell_axes, dtype=np.int64)
+
+
+DEFAULT_MARGINALS = MarginalSpec()
+PERMUTATIONS = DEFAULT_MARGINALS.permutations
+# counts that do not depend on the submission (every permutation plus the pickup/dropoff counts)
+MARGINALS_TO_COUNT = DEFAULT_MARGINALS.to_count
+# counts of every submitted row when scoring approximately (see `SubmissionSample`): the place/time
+# and dropoff of each row, out of which the rows in each place/time and the pickup-dropoff counts
+# are summed
+UNSAMPLED_MARGINALS = MarginalSpec(1, ["dropoff_community_area"])
+
+
+def _apply_metric(dp, gt, n_group_axes=0):
+    """
+    Compare the submitted and ground truth counts within every group at once. The leading
+    `n_group_axes` axes of the dense count arrays index the groups and the remaining axes the
+    cells within each group. For each group this is the sum over cells of the absolute
+    difference between the normalized counts, with a penalty of 2.0 (the maximum) for groups
+    where either the submission or the ground truth has no rows.
+    """
+    if isinstance(dp, SparseCounts) or isinstance(gt, SparseCounts):
+        return _apply_sparse_metric(dp, gt, n_group_axes)
+    cell_axes = tuple(range(n_group_axes, dp.ndim))
+    dp_sums = dp.sum(axis=cell_axes, dtype=np.int64)
+    gt_sums = gt.sum(axis=cell_axes, dtype=np.int64)
+    penalized = np.minimum(dp_sums, gt_sums) < 1
+    # broadcast the (non-zero) group sums over the cells of each group
+    expand = (Ellipsis,) + (None,) * len(cell_axes)
+    dp_props = dp / np.where(penalized, 1, dp_sums)[expand]
+    gt_props = gt / np.where(penalized, 1, gt_sums)[expand]
+    scores = np.abs(gt_props - dp_props).sum(axis=cell_axes)
+    return np.where(penalized, 2.0, scores)
+
+
+def _apply_sparse_metric(dp, gt, n_group_axes=0):
+    """
+    `_apply_metric` for `SparseCounts`, over only the cells that have rows in either the
+    submission or the ground truth since the others add nothing to the scores.
+    """
+    n_cells = _n_cells_of_shape(dp.shape[n_group_axes:])
+    keys = np.union1d(dp.keys, gt.keys)
+    groups = keys // n_cells
+    dp_sums = dp.group_sums(n_group_axes).ravel()
+    gt_sums = gt.group_sums(n_group_axes).ravel()
+    penalized = np.minimum(dp_sums, gt_sums) < 1
+    diffs = np.zeros(len(keys))
+    diffs[np.searchsorted(keys, dp.keys)] -= dp.counts / np.where(penalized, 1, dp_sums)[
+        dp.keys // n_cells
+    ]
+    diffs[np.searchsorted(keys, gt.keys)] += gt.counts / np.where(penalized, 1, gt_sums)[
+        gt.keys // n_cells
+    ]
+    scores = np.bincount(groups, weights=np.abs(diffs), minlength=len(dp_sums))
+    return np.where(penalized, 2.0, scores).reshape(dp.shape[:n_group_axes])
+
+
+def _file_digest(path, chunk_size=1 << 20):
+    path = Path(path)
+    digest = hashlib.sha256()
+    # directories (e.g., of .npy columns) are hashed file by file in name order
+    for file_path in sorted(path.iterdir()) if path.is_dir() else [path]:
+        digest.update(file_path.name.encode())
+        with file_path.open("rb") as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _splitmix64(values, seed=0):
+    """ Hash integers with `seed` (splitmix64) to pseudo-random unsigned 64-bit integers. """
+    golden, mix1, mix2 = [
+        np.uint64(c) for c in (0x9E3779B97F4A7C15, 0xBF58476D1CE4E5B9, 0x94D049BB133111EB)
+    ]
+    with np.errstate(over="ignore"):
+        x = np.asarray(values).astype(np.uint64) + np.uint64(seed + 1) * golden
+        x = (x ^ (x >> np.uint64(30))) * mix1
+        x = (x ^ (x >> np.uint64(27))) * mix2
+        return x ^ (x >> np.uint64(31))
+
+
+def _count_definitions(marginals=DEFAULT_MARGINALS):
+    """
+    Everything besides the data that counts depend on: the column types and bins used to read
+    and bin it, the value ranges of the count arrays, the marginals of the `MarginalSpec`
+    counted (and which of them are sparse) and the version of the metric.
+    """
+    return {
+        "version": METRIC_VERSION,
+        "col_types": COL_TYPES,
+        "bins": {col: bins.tolist() for col, bins in BINS.items()},
+        "ranges": CATEGORICAL_RANGES,
+        "marginals": marginals.to_count,
+        "sparse": marginals.sparse,
+        "row_key": ROW_KEY_COLS,
+    }
+
+
+def ground_truth_cache_key(ground_truth_path, marginals=DEFAULT_MARGINALS):
+    """
+    Key identifying the ground truth counts computed from a file: a hash of the file contents
+    and of the `_count_definitions`.
+    """
+    digest = hashlib.sha256(_file_digest(ground_truth_path).encode())
+    digest.update(json.dumps(_count_definitions(marginals), sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class Counts:
+    """
+    Everything the metric needs from one data set: counts for every marginal (dense arrays, or
+    `SparseCounts` for those with too many cells) and the per-individual shift and pickup
+    counts used by the higher order conjunction.
+
+    The latter (`hoc_counts`) has a row per taxi, in the order of the sorted `taxi_ids`, and a
+    column per value in the domain of shift followed by one per value in the domain of
+    pickup_community_area, so the columns of any two data sets line up.
+    """
+
+    def __init__(self, marginals, hoc_counts, taxi_ids):
+        self.marginals = marginals
+        self.hoc_counts = hoc_counts
+        self.taxi_ids = taxi_ids
+        # the directory these counts were loaded from, if any
+        self.path = None
+        # the higher order conjunction draws and their counts, by seed (see `hoc_reference`)
+        self._hoc_references = {}
+
+    @property
+    def n_rows(self):
+        return int(self.marginals[tuple(PICKUP_DROPOFF_COLS)].sum(dtype=np.int64))
+
+    def hoc_reference(self, seed, n_iters=HIGHER_ORDER_CONJUNCTION_ITERS, use_index=False):
+        """
+        Return what the higher order conjunction needs from these counts as the ground truth,
+        which does not depend on the submission: the columns compared (the shifts and pickup
+        locations observed), `n_iters` draws of an archetypal individual and of the maximum
+        differences to count as similar to it, and the number of taxis similar to each.
+        This is computed once per seed and shared by every submission (or epsilon) scored
+        against these counts.
+
+        All draws are made up front in the same order as one draw per iteration so the
+        result for a given seed does not depend on how the draws are batched; see
+        `SimilarityCounter` for `use_index`.
+        """
+        key = (seed, n_iters, use_index)
+        with _HOC_REFERENCE_LOCK:
+            if key in self._hoc_references:
+                return self._hoc_references[key]
+
+            rng = np.random.RandomState(seed=seed)
+            counts_gt = self.hoc_counts
+            observed = np.flatnonzero(counts_gt.any(axis=0))
+            n_gt, n_cols = len(counts_gt), len(observed)
+            assert n_cols == 99
+
+            random_individuals = np.empty((n_iters, n_cols), dtype=np.int64)
+            max_diffs_to_qualify_as_similar = np.empty((n_iters, n_cols), dtype=np.int64)
+            for i in range(n_iters):
+                # choose an individual from the ground truth to represent an archetypal
+                # individual
+                random_individuals[i] = counts_gt[rng.randint(low=0, high=n_gt), observed]
+                # come up with varying "difficulties" for each feature of the count vector to
+                # count as similar to the randomly selected individual
+                max_diffs_to_qualify_as_similar[i] = rng.randint(
+                    MIN_HOC_DIFF, MAX_HOC_DIFF + 1, size=n_cols
+                )
+            max_value = random_individuals.max(initial=0)
+            n_similar_gt = SimilarityCounter(
+                counts_gt, max_value, columns=observed, use_index=use_index
+            ).count(random_individuals, max_diffs_to_qualify_as_similar)
+
+            reference = (
+                observed,
+                random_individuals,
+                max_diffs_to_qualify_as_similar,
+                n_similar_gt,
+            )
+            self._hoc_references[key] = reference
+            return reference
+
+    @classmethod
+    def from_frame(cls, df, marginals=DEFAULT_MARGINALS):
+        accumulator = CountsAccumulator(by_epsilon=False, marginals=marginals)
+        (counts,) = accumulator.update(df).finalize().values()
+        return cls(counts.marginals, counts.hoc_counts, counts.taxi_ids)
+
+    def save(self, path, marginals_only=False):
+        """
+        Write each distinct set of counts to a `.npy` file (or a pair of them, of the keys and
+        counts of `SparseCounts`) in a new directory at `path`. The directory is written under
+        a temporary name and renamed into place so that concurrent runs never see a partial
+        cache entry.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_dir = Path(tempfile.mkdtemp(prefix=f".{path.name}-", dir=path.parent))
+        manifest = {"marginals": {}}
+        saved = {}
+        for i, (perm, counts) in enumerate(self.marginals.items()):
+            key = tuple(sorted(perm))
+            if key in saved:
+                manifest["marginals"]["-".join(perm)] = saved[key]
+                continue
+            if isinstance(counts, SparseCounts):
+                saved[key] = {
+                    "keys": f"marginal-{i}-keys.npy",
+                    "counts": f"marginal-{i}-counts.npy",
+                    "shape": list(counts.shape),
+                    "cols": list(perm),
+                }
+                np.save(tmp_dir / saved[key]["keys"], counts.keys)
+                np.save(tmp_dir / saved[key]["counts"], counts.counts)
+            else:
+                filename = f"marginal-{i}.npy"
+                np.save(tmp_dir / filename, np.ascontiguousarray(counts))
+                saved[key] = {"file": filename, "cols": list(perm)}
+            manifest["marginals"]["-".join(perm)] = saved[key]
+        if not marginals_only:
+            np.save(tmp_dir / "hoc-counts.npy", self.hoc_counts)
+            np.save(tmp_dir / "hoc-taxi-ids.npy", self.taxi_ids)
+        (tmp_dir / "manifest.json").write_text(json.dumps(manifest))
+        try:
+            os.rename(tmp_dir, path)
+        except OSError:
+            # another run already saved the same counts
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load counts saved with `save`, memory-mapping the count arrays. The per-taxi counts are
+        None if only the marginals were saved.
+        """
+        path = Path(path)
+        manifest = json.loads((path / "manifest.json").read_text())
+        marginals = {}
+        for perm, entry in manifest["marginals"].items():
+            perm = tuple(perm.split("-"))
+            if "keys" in entry:
+                # sparse counts are only kept in the order they were counted in
+                marginals[perm] = SparseCounts(
+                    np.load(path / entry["keys"], mmap_mode="r"),
+                    np.load(path / entry["counts"], mmap_mode="r"),
+                    entry["shape"],
+                )
+                continue
+            counts = np.load(path / entry["file"], mmap_mode="r")
+            marginals[perm] = counts.transpose([entry["cols"].index(c) for c in perm])
+        hoc_counts = taxi_ids = None
+        if (path / "hoc-counts.npy").exists():
+            hoc_counts = np.load(path / "hoc-counts.npy", mmap_mode="r")
+            taxi_ids = np.load(path / "hoc-taxi-ids.npy", mmap_mode="r")
+        counts = cls(marginals, hoc_counts, taxi_ids)
+        counts.path = path
+        return counts
+
+
+class _TaxiCounts:
+    """
+    Per-taxi counts of each shift and pickup location (see `Counts`) in a preallocated
+    matrix, with rows added as new taxis are seen so that they can be accumulated over chunks.
+    """
+
+    def __init__(self):
+        self.n_shifts = _column_domain("shift")[1]
+        self.n_cols = self.n_shifts + _column_domain("pickup_community_area")[1]
+        self.taxi_ids = pd.Index([], dtype=np.int64)
+        self._counts = np.zeros((0, self.n_cols), dtype=COUNT_DTYPE)
+
+    def _rows_for(self, taxi_ids):
+        """Return the rows for the given (unique) taxi ids, adding rows for new taxis."""
+        rows = self.taxi_ids.get_indexer(taxi_ids)
+        new = rows < 0
+        if new.any():
+            n_taxis = len(self.taxi_ids)
+            self.taxi_ids = self.taxi_ids.append(pd.Index(taxi_ids[new]))
+            rows[new] = np.arange(n_taxis, len(self.taxi_ids))
+            if len(self.taxi_ids) > len(self._counts):
+                # grow geometrically so that the copies are amortized over the chunks
+                grown = np.zeros(
+                    (max(len(self.taxi_ids), 2 * len(self._counts)), self.n_cols),
+                    dtype=COUNT_DTYPE,
+                )
+                grown[: len(self._counts)] = self._counts
+                self._counts = grown
+        return rows
+
+    def update(self, taxi_ids, shift_codes, pickup_codes):
+        codes, uniques = pd.factorize(taxi_ids)
+        rows = self._rows_for(uniques)
+        # count blocks of rows with bincount over the taxis seen in each block, keeping the
+        # dense per-block counts to at most HOC_BLOCK_BYTES
+        block_size = max(1, HOC_BLOCK_BYTES // (8 * self.n_cols))
+        for start in range(0, len(codes), block_size):
+            stop = start + block_size
+            block_codes, block_taxis = pd.factorize(codes[start:stop])
+            keys = block_codes * self.n_cols
+            counts = np.bincount(
+                keys + shift_codes[start:stop], minlength=len(block_taxis) * self.n_cols
+            ) + np.bincount(
+                keys + self.n_shifts + pickup_codes[start:stop],
+                minlength=len(block_taxis) * self.n_cols,
+            )
+            self._counts[rows[block_taxis]] += counts.reshape(-1, self.n_cols).astype(
+                COUNT_DTYPE
+            )
+
+    def finalize(self):
+        """Return the sorted taxi ids and their rows of counts."""
+        order = np.argsort(self.taxi_ids.values, kind="stable")
+        return self.taxi_ids.values[order], self._counts[: len(self.taxi_ids)][order]
+
+
+class CountsAccumulator:
+    """
+    Folds chunks of a binned submission (or ground truth) into running marginal counts and
+    per-taxi shift and pickup counts for each epsilon, so that the memory needed depends on the
+    size of the counts rather than on the number of rows. Data without an epsilon column (or
+    all data if `by_epsilon` is False) is counted under the epsilon `None`.
+
+    The dense marginals of the `MarginalSpec` `marginals` are summed out of running counts of
+    its cubes. If it has sparse marginals, the distinct packed rows of each chunk are kept
+    with their counts too, from which those are summed out.
+    """
+
+    def __init__(self, by_epsilon=True, marginals=DEFAULT_MARGINALS):
+        self.by_epsilon = by_epsilon
+        self.marginals = marginals
+        self.epsilons = []
+        self._n_rows = {}
+        self._cubes = {}
+        self._distinct_rows = {}
+        self._taxi_counts = {}
+
+    @property
+    def row_counts(self):
+        return pd.Series(self._n_rows, dtype=np.int64)
+
+    def update(self, chunk):
+        """ Count a binned dataframe or `PackedRows`. """
+        if isinstance(chunk, PackedRows):
+            rows = chunk if self.by_epsilon else PackedRows(chunk.keys, chunk.taxi_ids)
+        else:
+            rows = PackedRows.from_frame(chunk, by_epsilon=self.by_epsilon)
+        epsilons = rows.epsilons
+        n_rows_per_epsilon = np.diff(rows.offsets)
+
+        for epsilon, n_rows in zip(epsilons, n_rows_per_epsilon):
+            if epsilon not in self._n_rows:
+                self.epsilons.append(epsilon)
+                self._n_rows[epsilon] = 0
+                self._cubes[epsilon] = {}
+                self._distinct_rows[epsilon] = []
+                self._taxi_counts[epsilon] = _TaxiCounts()
+            self._n_rows[epsilon] += int(n_rows)
+
+        # count every epsilon in the chunk at once
+        groups = np.repeat(np.arange(len(epsilons), dtype=np.intp), n_rows_per_epsilon)
+        counter = MarginalCounter(rows, groups=groups, n_groups=len(epsilons))
+        for cube in self.marginals.cubes:
+            counts = counter.count(cube)
+            for i, epsilon in enumerate(epsilons):
+                running = self._cubes[epsilon]
+                if cube in running:
+                    running[cube] += counts[i]
+                else:
+                    running[cube] = counts[i].copy()
+        if self.marginals.sparse:
+            # the distinct rows of each epsilon, as sparse counts of the highest order
+            for i, epsilon in enumerate(epsilons):
+                rows_i = slice(rows.offsets[i], rows.offsets[i + 1])
+                distinct = np.unique(rows.keys[rows_i], return_counts=True)
+                self._distinct_rows[epsilon].append(distinct)
+
+        # each epsilon's rows are a contiguous slice of the packed rows
+        shift_codes = counter.codes("shift")
+        pickup_codes = counter.codes("pickup_community_area")
+        for i, epsilon in enumerate(epsilons):
+            rows_i = slice(rows.offsets[i], rows.offsets[i + 1])
+            self._taxi_counts[epsilon].update(
+                rows.taxi_ids[rows_i], shift_codes[rows_i], pickup_codes[rows_i]
+            )
+        return self
+
+    def finalize(self):
+        """Return a dict mapping each epsilon (in order of appearance) to its `Counts`."""
+        finalized = {}
+        for epsilon in self.epsilons:
+            taxi_ids, hoc_counts = self._taxi_counts[epsilon].finalize()
+            marginals = _marginals_from_cubes(self._cubes[epsilon], self.marginals.dense)
+            if self.marginals.sparse:
+                keys, counts = zip(*self._distinct_rows[epsilon])
+                marginals.update(
+                    _sparse_marginals(
+                        np.concatenate(keys), np.concatenate(counts), self.marginals.sparse
+                    )
+                )
+            finalized[epsilon] = Counts(marginals, hoc_counts, taxi_ids)
+        return finalized
+
+
+def count_submission_by_epsilon(submission_df):
+    """
+    Count a binned submission for all of its epsilons in a single pass with the epsilon as an
+    extra leading axis of every count array. Returns a dict mapping each epsilon (in order of
+    appearance) to its `Counts`.
+    """
+    return CountsAccumulator().update(submission_df).finalize()
+
+
+class SubmissionValidator:
+    """
+    Validates a submission against parameters.json one chunk at a time.
+
+    The schema is compiled once into lookup tables: a boolean mask over the range of each column
+    with a list of accepted values, and min/max bounds for the others. Each chunk is then checked
+    with a handful of vectorized comparisons, and the rows for each epsilon and for each
+    (epsilon, taxi_id) pair are counted as the chunks go by so that the `max_records` and
+    `max_records_per_individual` limits of the runs can be enforced without holding the
+    submission in memory. Errors are raised as a ValueError as soon as they are found, naming
+    the offending values and how many rows contain them.
+    """
+
+    # the number of offending values to show in an error message
+    MAX_VALUES_SHOWN = 10
+
+    def __init__(self, parameters):
+        self.schema = {
+            col: conds
+            for col, conds in parameters["schema"].items()
+            if col not in NOT_USED_IN_SUBMISSION
+        }
+        self.runs = {run["epsilon"]: run for run in parameters["runs"]}
+
+        # col -> (offset, mask) where mask[value - offset] says whether value is accepted
+        self.lookups = {}
+        for col, conds in self.schema.items():
+            if "values" in conds:
+                values = np.asarray(conds["values"], dtype=np.int64)
+                offset = values.min()
+                mask = np.zeros(values.max() - offset + 1, dtype=bool)
+                mask[values - offset] = True
+                self.lookups[col] = (offset, mask)
+
+        self.n_rows = 0
+        self.rows_per_epsilon = defaultdict(int)
+        self.rows_per_taxi = {}
+
+    def _describe(self, values, offending):
+        n_rows = int(offending.sum())
+        shown = np.unique(values[offending])[: self.MAX_VALUES_SHOWN].tolist()
+        first_row = self.n_rows + int(np.argmax(offending))
+        return f"{shown} in {n_rows:,} rows (first at row {first_row:,})"
+
+    def _schema_errors(self, chunk):
+        schema_errors = defaultdict(list)
+        for col, conds in self.schema.items():
+            if col not in chunk.columns:
+                schema_errors[col] += [
+                    f"expected column {col} in data but it was not present"
+                ]
+                continue
+            values = chunk[col].to_numpy()
+
+            if col in self.lookups:
+                offset, mask = self.lookups[col]
+                codes = values.astype(np.int64) - offset
+                in_range = (codes >= 0) & (codes < len(mask))
+                accepted = in_range & mask[np.clip(codes, 0, len(mask) - 1)]
+                if not accepted.all():
+                    schema_errors[col] += [
+                        "invalid values {} (accepted values '{}')".format(
+                            self._describe(values, ~accepted), conds["values"],
+                        )
+                    ]
+
+            if conds.get("min") is not None:
+                too_small = values < conds["min"]
+                if too_small.any():
+                    schema_errors[col] += [
+                        "contains values less than minimum ({}): {}".format(
+                            conds["min"], self._describe(values, too_small)
+                        )
+                    ]
+
+            if conds.get("max") is not None:
+                too_large = values > conds["max"]
+                if too_large.any():
+                    schema_errors[col] += [
+                        "contains values greater than maximum ({}): {}".format(
+                            conds["max"], self._describe(values, too_large)
+                        )
+                    ]
+        return schema_errors
+
+    def _count_rows(self, chunk):
+        if "epsilon" not in chunk.columns:
+            raise ValueError("expected column epsilon in data but it was not present")
+
+        codes, epsilons = pd.factorize(chunk["epsilon"])
+        invalid_epsilons = [e for e in epsilons if e not in self.runs]
+        if (codes < 0).any():
+            invalid_epsilons.append(np.nan)
+        if invalid_epsilons:
+            raise ValueError(
+                "Submission has invalid epsilon: {}".format(invalid_epsilons)
+            )
+
+        # sorting by epsilon lets each run's taxi ids be taken as a contiguous slice
+        order = np.argsort(codes, kind="stable")
+        bounds = np.cumsum(np.bincount(codes, minlength=len(epsilons)))
+        taxi_ids = chunk["taxi_id"].to_numpy()[order]
+
+        too_many_rows, too_many_per_taxi = [], []
+        for i, epsilon in enumerate(epsilons):
+            run = self.runs[epsilon]
+            start = bounds[i - 1] if i else 0
+            run_taxi_ids = taxi_ids[start:][: bounds[i] - start]
+
+            self.rows_per_epsilon[epsilon] += len(run_taxi_ids)
+            if self.rows_per_epsilon[epsilon] > run["max_records"]:
+                too_many_rows.append(epsilon)
+
+            per_taxi = pd.Series(run_taxi_ids).value_counts(sort=False)
+            if epsilon in self.rows_per_taxi:
+                per_taxi = self.rows_per_taxi[epsilon].add(per_taxi, fill_value=0)
+            self.rows_per_taxi[epsilon] = per_taxi.astype(np.int64)
+
+            over_limit = per_taxi[per_taxi > run["max_records_per_individual"]]
+            if len(over_limit):
+                worst = over_limit.sort_values(ascending=False).head(
+                    self.MAX_VALUES_SHOWN
+                )
+                too_many_per_taxi.append(
+                    f"epsilon {epsilon} - {len(over_limit):,} taxi_ids have more than "
+                    f"{run['max_records_per_individual']} records "
+                    f"(taxi_id: records {worst.to_dict()})"
+                )
+
+        if too_many_rows:
+            raise ValueError(
+                "Some epsilon runs have too many individuals. Epsilons are: {}".format(
+                    too_many_rows
+                )
+            )
+        if too_many_per_taxi:
+            raise ValueError(
+                "Some individuals have too many records:\n  "
+                + ";\n  ".join(too_many_per_taxi)
+            )
+
+    def update(self, chunk):
+        """ Check a chunk of the submission, raising a ValueError if any errors are found. """
+        schema_errors = self._schema_errors(chunk)
+        if schema_errors:
+            errors = ";\n  ".join(
+                "{} - {}".format(col, ", ".join(col_errs),)
+                for col, col_errs in schema_errors.items()
+            )
+            raise ValueError("Errors were found in your submission:\n  " + errors)
+        self._count_rows(chunk)
+        self.n_rows += len(chunk)
+
+    def finalize(self):
+        """ Check that every epsilon in the runs was present once all chunks have been seen. """
+        missing_epsilons = set(self.runs) - set(self.rows_per_epsilon)
+        if missing_epsilons:
+            raise ValueError(
+                f"Submission expected to have all epsilons {list(self.runs)} "
+                f"but the following are not present: {list(missing_epsilons)}"
+            )
+
+
+def _check_cancelled(cancelled):
+    """ Stop reading a file between chunks once `cancelled` (a `threading.Event`) is set. """
+    if cancelled is not None and cancelled.is_set():
+        raise CancelledError()
+
+
+def read_submission_counts(
+    submission_path,
+    parameters=None,
+    chunk_size=CHUNK_SIZE,
+    cancelled=None,
+    marginals=DEFAULT_MARGINALS,
+):
+    """
+    Stream a submission file (in any of `FILE_FORMATS`) in chunks of `chunk_size` rows. Each
+    chunk is checked by a `SubmissionValidator` built from `parameters` (if given), binned and
+    folded into a `CountsAccumulator` of the `MarginalSpec` `marginals`. Reading stops with a
+    `CancelledError` once the `cancelled` event is set, if given.
+    """
+    validator = None if parameters is None else SubmissionValidator(parameters)
+    accumulator = CountsAccumulator(marginals=marginals)
+    # the validator checks the raw values, so only bin them as they are read without one
+    chunks = read_chunks(submission_path, chunk_size, binned=validator is None)
+    for chunk in tqdm(chunks, unit="chunk"):
+        _check_cancelled(cancelled)
+        if validator is not None:
+            validator.update(chunk)
+            chunk = bin_numerics(chunk)
+        accumulator.update(chunk)
+    if validator is not None:
+        validator.finalize()
+    return accumulator
+
+
+class GroundTruthCounts(Counts):
+    """
+    Counts for the ground truth. These do not depend on the submission so they can be computed
+    once, saved and reused.
+    """
+
+    @classmethod
+    def from_frame(cls, df, marginals=DEFAULT_MARGINALS):
+        logger.info("precomputing ground truth counts for each permutations ...")
+        counts = Counts.from_frame(df, marginals=marginals)
+        return cls(counts.marginals, counts.hoc_counts, counts.taxi_ids)
+
+    @classmethod
+    def from_file(
+        cls,
+        ground_truth_path,
+        cache_dir=CACHE_DIR,
+        chunk_size=CHUNK_SIZE,
+        cancelled=None,
+        marginals=DEFAULT_MARGINALS,
+    ):
+        """
+        Load the counts of the `MarginalSpec` `marginals` for a ground truth file (in any of
+        `FILE_FORMATS`) from the cache in `cache_dir`, computing and caching them first if this
+        file has not been seen before. Pass `cache_dir=None` to always compute the counts.
+        Counting stops with a `CancelledError` once the `cancelled` event is set, if given.
+        """
+        if cache_dir is not None:
+            cache_key = ground_truth_cache_key(ground_truth_path, marginals)
+            cache_path = Path(cache_dir) / f"gt-{cache_key}"
+            if (cache_path / "manifest.json").exists():
+                logger.info(f"loading cached ground truth counts from {cache_path}")
+                return cls.load(cache_path)
+
+        logger.info(f"reading in, binning and counting ground truth from {ground_truth_path}")
+        accumulator = CountsAccumulator(by_epsilon=False, marginals=marginals)
+        for chunk in tqdm(read_chunks(ground_truth_path, chunk_size, binned=True), unit="chunk"):
+            _check_cancelled(cancelled)
+            accumulator.update(chunk)
+        (ground_truth,) = accumulator.finalize().values()
+        counts = cls(ground_truth.marginals, ground_truth.hoc_counts, ground_truth.taxi_ids)
+        if cache_dir is not None:
+            logger.info(f"caching ground truth counts at {cache_path}")
+            counts.save(cache_path)
+            counts.path = cache_path
+        return counts
+
+
+def _marginals_from_row_keys(keys, weights, marginals):
+    """
+    Dense counts (as int64) for each of the dense marginals of the `MarginalSpec` `marginals`
+    from packed row keys (see `PackedRows`) and a possibly negative weight for each of them,
+    summed out of a count of each of its cubes.
+    """
+    counter = MarginalCounter(PackedRows(keys, None))
+    cube_counts = {}
+    for cube in marginals.cubes:
+        cube_shape = tuple(_column_domain(col)[1] for col in cube)
+        cube_keys = np.ravel_multi_index([counter.codes(col) for col in cube], cube_shape)
+        counts = np.bincount(cube_keys, weights=weights, minlength=_n_cells_of_shape(cube_shape))
+        cube_counts[cube] = np.rint(counts).astype(np.int64).reshape(cube_shape)
+    return _marginals_from_cubes(cube_counts, marginals.dense)
+
+
+class _ShardCounts:
+    """
+    Sparse counts of the rows of one shard of taxis in one epsilon of a submission: each
+    distinct packed row key (see `PackedRows`) with its number of rows, and the per-taxi counts of
+    those taxis (see `Counts`), accumulated over chunks and saved as a single `.npz` file.
+    """
+
+    def __init__(self, keys=None, counts=None, taxi_ids=None, hoc_counts=None):
+        self.keys = np.zeros(0, dtype=np.uint64) if keys is None else keys
+        self.counts = np.zeros(0, dtype=np.int64) if counts is None else counts
+        self.taxi_ids = taxi_ids
+        self.hoc_counts = hoc_counts
+        self._taxi_counts = _TaxiCounts()
+
+    def update(self, keys, taxi_ids, shift_codes, pickup_codes):
+        keys, inverse = np.unique(np.concatenate([self.keys, keys]), return_inverse=True)
+        weights = np.concatenate([self.counts, np.ones(len(inverse) - len(self.counts))])
+        self.keys = keys
+        self.counts = np.bincount(inverse, weights=weights).astype(np.int64)
+        self._taxi_counts.update(taxi_ids, shift_codes, pickup_codes)
+
+    def finalize(self):
+        self.taxi_ids, self.hoc_counts = self._taxi_counts.finalize()
+        return self
+
+    def save(self, path):
+        tmp_path = path.with_name(f".{path.name}-{os.getpid()}-{threading.get_ident()}")
+        with tmp_path.open("wb") as fp:
+            np.savez(
+                fp,
+                keys=self.keys,
+                counts=self.counts,
+                taxi_ids=self.taxi_ids,
+                hoc_counts=self.hoc_counts,
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(**{name: arrays[name] for name in arrays.files})
+
+
+class _ShardDigests:
+    """
+    Order-independent digests of the rows of each shard of taxis (by taxi id modulo
+    `n_shards`) in each epsilon of a submission, from the sum of two 64-bit hashes of every
+    row of raw values and the number of rows, so that reordering the rows keeps the digests
+    and changing, adding or removing rows only changes those of the shards they belong to.
+    """
+
+    HASHED_COLS = ["taxi_id"] + ROW_KEY_COLS
+
+    def __init__(self, n_shards=SUBMISSION_SHARDS, marginals=DEFAULT_MARGINALS):
+        self.n_shards = n_shards
+        self.marginals = marginals
+        # the running sums and number of rows of each shard for each epsilon
+        self._sums = {}
+
+    @property
+    def epsilons(self):
+        return list(self._sums)
+
+    def update(self, chunk):
+        hashes = pd.util.hash_pandas_object(chunk[self.HASHED_COLS], index=False).to_numpy()
+        mixed = _splitmix64(hashes)
+        groups, epsilons = pd.factorize(chunk["epsilon"])
+        epsilons = epsilons.tolist()
+        keys = groups * self.n_shards + chunk["taxi_id"].to_numpy() % self.n_shards
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        n_rows = np.diff(np.r_[starts, len(keys)])
+        with np.errstate(over="ignore"):
+            hash_sums = np.add.reduceat(hashes[order], starts)
+            mixed_sums = np.add.reduceat(mixed[order], starts)
+        for key, rows, hash_sum, mixed_sum in zip(keys[starts], n_rows, hash_sums, mixed_sums):
+            epsilon = epsilons[key // self.n_shards]
+            if epsilon not in self._sums:
+                self._sums[epsilon] = [[0, 0, 0] for _ in range(self.n_shards)]
+            sums = self._sums[epsilon][key % self.n_shards]
+            sums[0] += int(rows)
+            sums[1] = (sums[1] + int(hash_sum)) % 2 ** 64
+            sums[2] = (sums[2] + int(mixed_sum)) % 2 ** 64
+        return self
+
+    def digests(self, epsilon):
+        """ The digest of each shard of `epsilon`, including the `_count_definitions`. """
+        definitions = json.dumps(_count_definitions(self.marginals), sort_keys=True)
+        return [
+            hashlib.sha256(
+                f"{pd.__version__}-{definitions}-{epsilon!r}-{shard}-{sums}".encode()
+            ).hexdigest()
+            for shard, sums in enumerate(self._sums[epsilon])
+        ]
+
+
+class SubmissionCache:
+    """
+    Submission counts cached under `cache_dir` by the content of each epsilon's rows, so that
+    rescoring a submission only counts the parts of it that changed.
+
+    The rows of each epsilon are split into shards of taxis with a digest each (see
+    `_ShardDigests`). The counts of an epsilon are kept in full under a digest of its shards'
+    digests, and the sparse counts of every shard are kept too. An epsilon whose rows are
+    unchanged is loaded as is. Otherwise, if an earlier version of the same submission file
+    was cached, only its changed shards are counted and their differences from the old shards
+    are added to its counts, since all of the counts are sums over rows; the per-taxi counts
+    are assembled from the shards. Failing that, the shards not yet cached are counted.
+    Sparse marginals of the `MarginalSpec` `marginals` are summed out of all of the shards.
+    Each read then removes the counts that are no longer a base for any file (see `_prune`).
+    """
+
+    def __init__(self, cache_dir, n_shards=SUBMISSION_SHARDS, marginals=DEFAULT_MARGINALS):
+        self.path = Path(cache_dir) / "submissions"
+        self.n_shards = n_shards
+        self.marginals = marginals
+
+    def _epsilon_path(self, digests):
+        digest = hashlib.sha256("-".join(digests).encode()).hexdigest()
+        return self.path / f"eps-{digest}"
+
+    def _shard_path(self, digest):
+        return self.path / f"shard-{digest}.npz"
+
+    def _latest_path(self, submission_path):
+        # the last version is kept per set of marginals, as it is only a base for the same ones
+        definitions = json.dumps(_count_definitions(self.marginals), sort_keys=True)
+        key = f"{Path(submission_path).resolve()}-{definitions}"
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return self.path / f"latest-{digest}.json"
+
+    def _base(self, submission_path, epsilon):
+        """ The shard digests of the last cached version of an epsilon of this file, if any. """
+        latest_path = self._latest_path(submission_path)
+        if not latest_path.exists():
+            return None
+        digests = json.loads(latest_path.read_text()).get(repr(epsilon))
+        if digests is None or not (self._epsilon_path(digests) / "manifest.json").exists():
+            return None
+        if not all(self._shard_path(digest).exists() for digest in digests):
+            return None
+        return digests
+
+    def read(self, submission_path, parameters=None, chunk_size=CHUNK_SIZE, cancelled=None):
+        """
+        Return a dict mapping each epsilon of a submission (in order of appearance) to its
+        `Counts`, validating the submission against `parameters` (if given) in the first of at
+        most two passes over it; the second counts the shards that are not cached. Either
+        stops like `read_submission_counts` once the `cancelled` event is set.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        validator = None if parameters is None else SubmissionValidator(parameters)
+        shard_digests = _ShardDigests(self.n_shards, self.marginals)
+        for chunk in tqdm(read_chunks(submission_path, chunk_size), unit="chunk"):
+            _check_cancelled(cancelled)
+            if validator is not None:
+                validator.update(chunk)
+            shard_digests.update(chunk)
+        if validator is not None:
+            validator.finalize()
+
+        digests, bases, to_count = {}, {}, {}
+        for epsilon in shard_digests.epsilons:
+            digests[epsilon] = shard_digests.digests(epsilon)
+            epsilon_path = self._epsilon_path(digests[epsilon])
+            if (epsilon_path / "manifest.json").exists():
+                # mark the counts as used so that a concurrent `_prune` keeps them
+                os.utime(epsilon_path)
+                continue
+            bases[epsilon] = self._base(submission_path, epsilon)
+            to_count[epsilon] = np.array(
+                [not self._shard_path(digest).exists() for digest in digests[epsilon]]
+            )
+            for digest, flag in zip(digests[epsilon], to_count[epsilon]):
+                if not flag:
+                    os.utime(self._shard_path(digest))
+        new_shards = self._count_shards(
+            submission_path, digests, to_count, chunk_size, cancelled=cancelled
+        )
+
+        submitted_counts = {}
+        for epsilon, epsilon_digests in digests.items():
+            epsilon_path = self._epsilon_path(epsilon_digests)
+            if epsilon in bases:
+                counts = self._update(
+                    bases[epsilon], epsilon_digests, new_shards.get(epsilon, {})
+                )
+                logger.info(f"caching counts for epsilon={epsilon} at {epsilon_path}")
+                counts.save(epsilon_path)
+            else:
+                logger.info(f"loading cached counts for epsilon={epsilon} from {epsilon_path}")
+            submitted_counts[epsilon] = Counts.load(epsilon_path)
+
+        latest_path = self._latest_path(submission_path)
+        latest = {repr(epsilon): epsilon_digests for epsilon, epsilon_digests in digests.items()}
+        tmp_path = latest_path.with_name(f".{latest_path.name}-{os.getpid()}")
+        tmp_path.write_text(json.dumps(latest))
+        os.replace(tmp_path, latest_path)
+        self._prune()
+        return submitted_counts
+
+    def _prune(self):
+        """
+        Remove the cached counts of epsilons and shards that the latest version of no
+        submission file refers to, and the temporary files of interrupted runs, once they have
+        not been written or used for `SUBMISSION_CACHE_GRACE` seconds, so that those of
+        concurrent runs are kept.
+        """
+        kept = set()
+        for latest_path in self.path.glob("latest-*.json"):
+            try:
+                latest = json.loads(latest_path.read_text())
+            except (OSError, ValueError):
+                continue
+            for digests in latest.values():
+                kept.add(self._epsilon_path(digests).name)
+                kept.update(self._shard_path(digest).name for digest in digests)
+
+        cutoff = time.time() - SUBMISSION_CACHE_GRACE
+        for path in self.path.iterdir():
+            if path.name in kept or path.name.startswith("latest-"):
+                continue
+            try:
+                if path.stat().st_mtime > cutoff:
+                    continue
+                if path.is_dir():
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    path.unlink()
+            except FileNotFoundError:
+                continue
+            logger.info(f"removed unused cached submission counts {path}")
+
+    def _count_shards(self, submission_path, digests, to_count, chunk_size, cancelled=None):
+        """ Count and cache the shards flagged in `to_count`, by epsilon and shard number. """
+        new_shards = {
+            epsilon: {shard: _ShardCounts() for shard in np.flatnonzero(flags)}
+            for epsilon, flags in to_count.items()
+            if flags.any()
+        }
+        if not new_shards:
+            return {}
+
+        n_shards = sum(len(shards) for shards in new_shards.values())
+        logger.info(f"counting {n_shards} changed shards of taxis in {submission_path}")
+        for chunk in tqdm(read_chunks(submission_path, chunk_size), unit="chunk"):
+            _check_cancelled(cancelled)
+            shards = chunk["taxi_id"].to_numpy() % self.n_shards
+            for epsilon, epsilon_shards in new_shards.items():
+                rows = (chunk["epsilon"].to_numpy() == epsilon) & to_count[epsilon][shards]
+                if not rows.any():
+                    continue
+                packed = PackedRows.from_frame(bin_numerics(chunk[rows]), by_epsilon=False)
+                counter = MarginalCounter(packed)
+                keys, taxi_ids = packed.keys, packed.taxi_ids
+                shift_codes = counter.codes("shift")
+                pickup_codes = counter.codes("pickup_community_area")
+                for shard, shard_counts in epsilon_shards.items():
+                    in_shard = shards[rows] == shard
+                    shard_counts.update(
+                        keys[in_shard],
+                        taxi_ids[in_shard],
+                        shift_codes[in_shard],
+                        pickup_codes[in_shard],
+                    )
+
+        for epsilon, epsilon_shards in new_shards.items():
+            for shard, shard_counts in epsilon_shards.items():
+                shard_counts.finalize().save(self._shard_path(digests[epsilon][shard]))
+        return new_shards
+
+    def _update(self, base_digests, digests, new_shards):
+        """
+        The counts of an epsilon with the given shard `digests`: those of the base version
+        plus the differences of its changed shards, or the sum of all shards without a base.
+        `new_shards` holds the shards just counted; the others are loaded from the cache.
+        """
+        shards = [
+            new_shards[shard] if shard in new_shards else _ShardCounts.load(self._shard_path(d))
+            for shard, d in enumerate(digests)
+        ]
+        if base_digests is None:
+            changed, old_shards, marginals = range(len(digests)), [], None
+        else:
+            changed = [shard for shard, d in enumerate(digests) if d != base_digests[shard]]
+            old_shards = [
+                _ShardCounts.load(self._shard_path(base_digests[shard])) for shard in changed
+            ]
+            marginals = Counts.load(self._epsilon_path(base_digests)).marginals
+        delta = _marginals_from_row_keys(
+            np.concatenate(
+                [shards[shard].keys for shard in changed] + [old.keys for old in old_shards]
+            ),
+            np.concatenate(
+                [shards[shard].counts for shard in changed]
+                + [-old.counts for old in old_shards]
+            ).astype(np.float64),
+            self.marginals,
+        )
+        if marginals is not None:
+            delta = {perm: delta[perm] + marginals[perm] for perm in delta}
+        counts = {perm: counts.astype(COUNT_DTYPE) for perm, counts in delta.items()}
+        if self.marginals.sparse:
+            counts.update(
+                _sparse_marginals(
+                    np.concatenate([shard.keys for shard in shards]),
+                    np.concatenate([shard.counts for shard in shards]),
+                    self.marginals.sparse,
+                )
+            )
+
+        taxi_ids = np.concatenate([shard.taxi_ids for shard in shards])
+        order = np.argsort(taxi_ids, kind="stable")
+        hoc_counts = np.concatenate([shard.hoc_counts for shard in shards])[order]
+        return Counts(
+            counts,
+            hoc_counts,
+            taxi_ids[order],
+        )
+
+
+class SimilarityCounter:
+    """
+    Counts, for many draws of an archetypal individual and the maximum differences allowed in
+    each column, how many rows of a matrix of per-individual counts are within those limits of
+    the archetype in every column.
+
+    The counts are stored in the smallest integer type that holds them after clipping at
+    `max_value + MAX_HOC_DIFF + 1`, where `max_value` bounds the archetype values; a clipped
+    count is still further than any allowed difference from every archetype so the results are
+    exact. Only the given `columns` are compared, if any are given (selecting them as part of
+    the same copy). Draws are compared in batches against blocks of rows whose size is bounded by
+    `block_bytes`. With `use_index`, each column is also sorted once so that each draw only
+    checks the rows within range in its most selective column.
+    """
+
+    def __init__(
+        self,
+        counts,
+        max_value,
+        columns=None,
+        use_index=False,
+        block_bytes=HOC_BLOCK_BYTES,
+    ):
+        clip = int(max_value) + MAX_HOC_DIFF + 1
+        self.dtype = np.int16 if clip <= np.iinfo(np.int16).max else np.int32
+        if columns is not None:
+            counts = np.take(counts, columns, axis=1)
+        self.counts = np.minimum(counts, clip).astype(self.dtype)
+        self.clip = clip
+        self.block_bytes = block_bytes
+        self.use_index = use_index
+        if use_index:
+            n_rows, n_cols = self.counts.shape
+            # rows ordered by each column and the sorted values of all columns in one flat
+            # array, each column offset so that the whole array is sorted
+            self._order = np.argsort(self.counts, axis=0, kind="stable").T
+            offsets = np.arange(n_cols, dtype=np.int64) * (clip + 1)
+            self._offsets = offsets
+            self._flat = (
+                np.take_along_axis(self.counts, self._order.T, axis=0).T + offsets[:, None]
+            ).ravel()
+
+    def count(self, archetypes, max_diffs):
+        archetypes = np.asarray(archetypes, dtype=self.dtype)
+        max_diffs = np.asarray(max_diffs, dtype=self.dtype)
+        if self.use_index:
+            return self._count_with_index(archetypes, max_diffs)
+        return self._count_dense(archetypes, max_diffs)
+
+    def _count_dense(self, archetypes, max_diffs):
+        n_rows, n_cols = self.counts.shape
+        n_similar = np.zeros(len(archetypes), dtype=np.int64)
+        for start in range(0, len(archetypes), HOC_DRAWS_PER_BATCH):
+            batch = slice(start, start + HOC_DRAWS_PER_BATCH)
+            arr, limits = archetypes[batch], max_diffs[batch]
+            # the abs diffs and booleans for a block take about 3 bytes per cell
+            block_rows = max(1, self.block_bytes // (3 * len(arr) * n_cols))
+            for row in range(0, n_rows, block_rows):
+                block = self.counts[row:][:block_rows, None, :]
+                within_limits = np.abs(block - arr) <= limits
+                n_similar[batch] += within_limits.all(axis=2).sum(axis=0)
+        return n_similar
+
+    def _count_with_index(self, archetypes, max_diffs):
+        n_rows, n_cols = self.counts.shape
+        # the range of sorted positions within the limits for every draw and column (the
+        # limits are clipped to the range of the counts so they stay within their column)
+        archetypes = archetypes.astype(np.int64)
+        low = np.clip(archetypes - max_diffs, 0, self.clip) + self._offsets
+        high = np.clip(archetypes + max_diffs, 0, self.clip) + self._offsets
+        starts = np.searchsorted(self._flat, low, side="left")
+        stops = np.searchsorted(self._flat, high, side="right")
+        n_similar = np.zeros(len(archetypes), dtype=np.int64)
+        for i, col in enumerate(np.argmin(stops - starts, axis=1)):
+            first = starts[i, col] - col * n_rows
+            last = stops[i, col] - col * n_rows
+            candidates = self.counts[self._order[col, first:last]].astype(np.int64)
+            within_limits = np.abs(candidates - archetypes[i]) <= max_diffs[i]
+            n_similar[i] = within_limits.all(axis=1).sum()
+        return n_similar
+
+
+def _peak_rss_bytes():
+    """ The peak resident set size of this process so far (ru_maxrss is in KiB on Linux). """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+class StageProfiler:
+    """
+    Records the wall time, CPU time, peak RSS and rows processed of each stage of scoring.
+
+    A profiler may be bound to extra tags (e.g., `profiler.bind(epsilon=1.0)`) which are added
+    to the records of its stages; bound profilers share the records of the profiler they came
+    from, so stages run concurrently in threads for different epsilons end up in one list. CPU
+    time is that of the calling thread, and peak RSS is the peak of the whole process up to the
+    end of the stage. If `events_path` is given, each record is also appended to that file as
+    a JSON line as soon as its stage finishes.
+    """
+
+    def __init__(self, events_path=None, **tags):
+        self.tags = tags
+        self.records = []
+        self._lock = threading.Lock()
+        self._events = None if events_path is None else open(events_path, "a")
+
+    def bind(self, **tags):
+        profiler = copy.copy(self)
+        profiler.tags = {**self.tags, **tags}
+        return profiler
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """
+        Profile the body of the `with` block as the stage `name`. The record is yielded so that
+        the block may add to it (e.g., the usage of worker processes).
+        """
+        record = {"stage": name, **self.tags, "pid": os.getpid(), "rows": rows}
+        start, start_cpu = time.perf_counter(), time.thread_time()
+        yield record
+        record["wall_seconds"] = time.perf_counter() - start
+        record["cpu_seconds"] = time.thread_time() - start_cpu
+        record["peak_rss_bytes"] = _peak_rss_bytes()
+        with self._lock:
+            self.records.append(record)
+            if self._events is not None:
+                self._events.write(json.dumps(record) + "\n")
+                self._events.flush()
+
+    def close(self):
+        if self._events is not None:
+            self._events.close()
+
 
-# higher order conjunction constants
-HIGHER_ORDER_CONJUNCTION_ITERS = 50
-MIN_HOC_DIFF = 5
-MAX_HOC_DIFF = 50
+def _profile_stage(profiler, name, rows=None):
+    """ `profiler.stage(...)`, or a stand-in yielding a throwaway record if not profiling. """
+    if profiler is None:
+        return nullcontext({})
+    return profiler.stage(name, rows=rows)
 
 
-def bin_numerics(df):
-    for col in df.columns:
-        if col in BINS:
-            df.loc[:, col] = pd.cut(df[col], BINS[col], right=False, labels=False)
-            if len(BINS[col]) < 255:
-                df.loc[:, col] = df[col].astype(np.uint8)
-    return df
+@contextmanager
+def shared_counts(counts, marginals_only=False):
+    """
+    Yield a directory from which worker processes can `Counts.load` (memory-map) `counts`
+    without copying them: the directory they were loaded from, if any, or else a new private
+    one (under /dev/shm when it has room, so the files never leave memory) that is removed
+    afterwards. Each run gets its own directory so concurrent runs on one host never collide.
+    """
+    if counts.path is not None:
+        yield counts.path
+        return
+
+    needed_bytes = sum(marginal.nbytes for marginal in counts.marginals.values())
+    shared_dir = SHARED_MEMORY_DIR
+    if shared_dir is not None and shutil.disk_usage(shared_dir).free < 2 * needed_bytes:
+        shared_dir = None
+    run_dir = Path(tempfile.mkdtemp(prefix="kmarginal-run-", dir=shared_dir))
+    try:
+        counts.save(run_dir / "counts", marginals_only=marginals_only)
+        yield run_dir / "counts"
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
 
+# counts shared with the worker processes that score each permutation
+_WORKER_COUNTS = {}
 
-def _get_counts(perm):
-    filename = "-".join(perm)
-    index_cols = list(range(len(perm)))
-    dp = pd.read_csv(PRECALC_DP_DIR / filename, index_col=index_cols)
-    gt = pd.read_csv(PRECALC_GT_DIR / filename, index_col=index_cols)
-    counts = dp.join(gt, how="outer").fillna(0).astype(np.int)
-    return counts
+
+def _init_worker(gt_path):
+    """ Memory-map the ground truth marginal counts saved (see `shared_counts`) at `gt_path`. """
+    _WORKER_COUNTS["gt"] = Counts.load(gt_path).marginals
 
 
 def _kmarginal_from_precomputed(perm):
-    counts = _get_counts(perm)
-    return counts.groupby(ALWAYS_GROUP_BY).apply(_apply_metric).rename("-".join(perm))
+    """ Score `perm` in a worker, also returning the worker's pid, CPU time and peak RSS. """
+    perm = tuple(perm)
+    start_cpu = time.process_time()
+    scores = _apply_metric(
+        _WORKER_COUNTS["dp"][perm],
+        _WORKER_COUNTS["gt"][perm],
+        n_group_axes=len(ALWAYS_GROUP_BY),
+    )
+    usage = (os.getpid(), time.process_time() - start_cpu, _peak_rss_bytes())
+    return scores, usage
+
+
+def _kmarginal_against_worker_ground_truth(args):
+    """
+    Score a permutation of the submitted counts shared at `dp_path`, against the ground truth
+    counts a `WorkerPool`'s workers were started with.
+    """
+    dp_path, perm = args
+    loaded = _WORKER_COUNTS.setdefault("dp_by_path", {})
+    if dp_path not in loaded:
+        # submissions scored at the same time (such as the epsilons of one run) take turns in
+        # the workers, so keep the last few memory-mapped rather than reloading at each turn
+        if len(loaded) >= WORKER_SUBMISSIONS_KEPT:
+            loaded.pop(next(iter(loaded)))
+        loaded[dp_path] = Counts.load(dp_path).marginals
+    _WORKER_COUNTS["dp"] = loaded[dp_path]
+    return _kmarginal_from_precomputed(perm)
+
+
+class WorkerPool:
+    """
+    A pool of `processes` workers holding the marginal counts of the ground truth, which may be
+    reused to score any number of submissions against it. The ground truth and each submission
+    are shared with the workers through `shared_counts`, so only paths are sent with tasks.
+    """
+
+    def __init__(self, ground_truth_counts, processes):
+        self._exit_stack = ExitStack()
+        gt_path = self._exit_stack.enter_context(
+            shared_counts(ground_truth_counts, marginals_only=True)
+        )
+        self.pool = multiprocessing.Pool(
+            processes=processes, initializer=_init_worker, initargs=(str(gt_path),),
+        )
+
+    def imap_kmarginal(self, submitted_counts, perms):
+        """ Score each of `perms` of `submitted_counts`, as `_kmarginal_from_precomputed`. """
+        with shared_counts(submitted_counts, marginals_only=True) as dp_path:
+            tasks = [(str(dp_path), perm) for perm in perms]
+            iters = self.pool.imap(_kmarginal_against_worker_ground_truth, tasks)
+            return list(tqdm(iters, total=len(tasks)))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self._exit_stack.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 
+def _init_scoring_worker(ground_truth_counts, parameters, chunk_size):
+    """ Set up a worker for `_score_submission_file`, given counts or a path to load them. """
+    if not isinstance(ground_truth_counts, Counts):
+        ground_truth_counts = GroundTruthCounts.load(ground_truth_counts)
+    _WORKER_COUNTS["gt_counts"] = ground_truth_counts
+    _WORKER_COUNTS["parameters"] = parameters
+    _WORKER_COUNTS["chunk_size"] = chunk_size
 
-def _apply_metric(counts):
-    if counts.shape[1] < 2:
-        return 2.0
-    sums = counts.sum(axis=0)
-    if np.min(sums) < 1:
-        return 2.0
-    return (counts / sums).diff(axis=1).sum(axis=1).abs().sum()
+
+def _score_submission_file(submission_path):
+    """
+    Read, validate, count and score a whole submission in a worker started by
+    `_init_scoring_worker`, returning a record of the scores for each epsilon (or one record
+    with the error if the submission could not be scored).
+    """
+    try:
+        accumulator = read_submission_counts(
+            submission_path,
+            parameters=_WORKER_COUNTS["parameters"],
+            chunk_size=_WORKER_COUNTS["chunk_size"],
+        )
+        submitted_counts = accumulator.finalize()
+        _, report = score_counts(_WORKER_COUNTS["gt_counts"], submitted_counts)
+    except (ValueError, TypeError, OSError) as e:
+        logger.error(f"could not score {submission_path}: {e}")
+        return [{"submission": str(submission_path), "error": str(e)}]
+
+    return [
+        {
+            "submission": str(submission_path),
+            "epsilon": epsilon,
+            "n_rows": counts.n_rows,
+            **epsilon_report,
+            # the same as `TidyFormatKMarginalMetric.overall_score`
+            "score": 1000.0
+            * np.mean(
+                [
+                    epsilon_report["k_marginal_score"],
+                    epsilon_report["pickup_dropoff_score"],
+                    epsilon_report["higher_order_conjunction"],
+                ]
+            ),
+        }
+        for (epsilon, counts), epsilon_report in zip(
+            submitted_counts.items(), report["per_epsilon"]
+        )
+    ]
+
+
+def _summarize_worker_usage(usages):
+    """ Total the CPU time and tasks, and take the peak RSS, of each worker process. """
+    workers = {}
+    for pid, cpu_seconds, peak_rss_bytes in usages:
+        worker = workers.setdefault(
+            pid, {"pid": pid, "tasks": 0, "cpu_seconds": 0.0, "peak_rss_bytes": 0}
+        )
+        worker["tasks"] += 1
+        worker["cpu_seconds"] += cpu_seconds
+        worker["peak_rss_bytes"] = max(worker["peak_rss_bytes"], peak_rss_bytes)
+    return list(workers.values())
 
 
 class TidyFormatKMarginalMetric:
@@ -121,59 +1844,47 @@ class TidyFormatKMarginalMetric:
     """
 
     def __init__(
-        self, raw_actual_df, raw_submitted_df, random_seed=None, processes=1,
+        self,
+        raw_actual_df,
+        raw_submitted_df,
+        random_seed=None,
+        processes=1,
+        ground_truth_counts=None,
+        submitted_counts=None,
+        profiler=None,
+        pool=None,
+        marginals=DEFAULT_MARGINALS,
     ):
         self.random_seed = random_seed or 123456
         self.processes = processes
         self.report = {}
 
+        # the `MarginalSpec` of the marginals compared, which the counts must have been
+        # counted with
+        self.marginals = marginals
+
+        # a StageProfiler to record the stages of `overall_score` in, if any, and the usage of
+        # each worker process from the last parallel k-marginal run
+        self.profiler = profiler
+        self.worker_usage = None
+
+        # a warm `WorkerPool` for the same ground truth counts, if any
+        self.pool = pool
+
         self.ground_truth = raw_actual_df
         self.submitted = raw_submitted_df
 
-        PRECALC_GT_DIR.mkdir(exist_ok=True, parents=True)
-        logger.info(f"created working directory at {PRECALC_DIR}")
-        if PRECALC_DP_DIR.exists():
-            logger.warning("found existing submission counts; removing")
-            shutil.rmtree(PRECALC_DP_DIR)
-        PRECALC_DP_DIR.mkdir()
+        # the ground truth counts may be passed in (e.g., loaded from the cache) instead of a
+        # ground truth dataframe, and likewise the submitted counts instead of the submission
+        self.ground_truth_counts = ground_truth_counts
+        self.submitted_counts = submitted_counts
+        self._gt_counts = None
+        self._dp_counts = None
 
     @staticmethod
     def _assert_sub_matches_schema(submission_df, parameters):
-        schema = parameters["schema"]
-        schema_errors = defaultdict(list)
-        for c, conds in schema.items():
-            if c in NOT_USED_IN_SUBMISSION:
-                continue
-            if c not in submission_df.columns:
-                schema_errors[c] += [
-                    f"expected column {c} in data but it was not present"
-                ]
-                continue
-            if "values" in conds:
-                invalid_values = list(
-                    set(submission_df[c].tolist()) - set(conds["values"])
-                )
-                if invalid_values:
-                    schema_errors[c] += [
-                        "invalid values '{}' (accepted values '{}')".format(
-                            invalid_values, conds["values"],
-                        )
-                    ]
-
-            if "min" in conds:
-                if submission_df[c].min() < conds["min"]:
-                    schema_errors[c] += [
-                        "contains values less than minimum ({})".format(conds["min"],)
-                    ]
-
-            if "max" in conds:
-                if submission_df[c].max() > conds["max"]:
-                    schema_errors[c] += [
-                        "contains values greater than maximum ({})".format(
-                            conds["max"],
-                        )
-                    ]
-
+        validator = SubmissionValidator(parameters)
+        schema_errors = validator._schema_errors(submission_df)
         if schema_errors:
             errors = ";\n  ".join(
                 "{} - {}".format(col, ", ".join(col_errs),)
@@ -183,76 +1894,79 @@ class TidyFormatKMarginalMetric:
 
     @staticmethod
     def _assert_sub_less_than_limit_and_epsilons_valid(submission_df, parameters):
-        # get parameters for the runs by epsilon value
-        runs_df = pd.DataFrame(parameters["runs"]).set_index("epsilon")
-
-        # calculate the sizes of each epsilon run and add to the df
-        runs_df = pd.concat(
-            [runs_df, submission_df.groupby("epsilon").size().rename("row_count")],
-            axis=1,
-        )
-
-        # max_records + delta are nan for epsilons in submission but not in parameters.json
-        invalid_epsilons = runs_df[runs_df.max_records.isnull()].index.tolist()
-        if invalid_epsilons:
-            raise ValueError(
-                "Submission has invalid epsilon: {}".format(invalid_epsilons)
-            )
+        validator = SubmissionValidator(parameters)
+        validator._count_rows(submission_df)
+        validator.finalize()
 
-        # if the observed rows for an epsilon (row_count) larger than max records, error
-        invalid_counts = runs_df[runs_df.row_count > runs_df.max_records].index.tolist()
-        if invalid_counts:
-            raise ValueError(
-                "Some epsilon runs have too many individuals. Epsilons are: {}".format(
-                    invalid_counts
-                )
+    def _get_ground_truth_counts(self):
+        if self.ground_truth_counts is None:
+            self.ground_truth_counts = GroundTruthCounts.from_frame(
+                self.ground_truth, marginals=self.marginals
             )
+        return self.ground_truth_counts
 
-        present_epsilons = set(submission_df["epsilon"].unique())
-        expected_epsilons = set([run["epsilon"] for run in parameters["runs"]])
-        missing_epsilons = expected_epsilons - present_epsilons
-        if missing_epsilons:
-            raise ValueError(
-                f"Submission expected to have all epsilons {list(expected_epsilons)} "
-                f"but the following are not present: {list(missing_epsilons)}"
-            )
+    def _get_submitted_counts(self):
+        if self.submitted_counts is None:
+            logger.info("precomputing submitted counts for each permutation ...")
+            self.submitted_counts = Counts.from_frame(self.submitted, marginals=self.marginals)
+        return self.submitted_counts
 
     def _precompute_marginal_counts(self):
-        todo = PERMUTATIONS + [
-            # for the pickup/dropoff part of the metric
-            PICKUP_DROPOFF_COLS,
-        ]
-        logger.info("precomputing ground truth counts for each permutations ...")
-        for perm in tqdm(todo):
-            filename = "-".join(perm)
-            gt_path = PRECALC_GT_DIR / filename
-            if gt_path.exists():
-                # avoid doing this if it has already been done
-                continue
-            self.ground_truth.loc[:, perm].value_counts().rename(1).to_csv(gt_path)
-        logger.info("precomputing submitted counts for each permutation ...")
-        for perm in tqdm(todo):
-            filename = "-".join(perm)
-            dp_path = PRECALC_DP_DIR / filename
-            self.submitted.loc[:, perm].value_counts().rename(0).to_csv(dp_path)
+        if self._gt_counts is not None and self._dp_counts is not None:
+            return
+        self._gt_counts = self._get_ground_truth_counts().marginals
+        self._dp_counts = self._get_submitted_counts().marginals
 
     def k_marginal_scores(self):
         self._precompute_marginal_counts()
-        logger.info(
-            f"running k-marginal count comparisons in parallel with {self.processes} processes..."
+        permutations = self.marginals.permutations
+        if self.pool is not None:
+            logger.info("running k-marginal count comparisons in the worker pool ...")
+            results = self.pool.imap_kmarginal(self._get_submitted_counts(), permutations)
+            scores = [perm_scores for perm_scores, _ in results]
+            self.worker_usage = _summarize_worker_usage(usage for _, usage in results)
+        elif self.processes is not None and self.processes > 1:
+            logger.info(
+                f"running k-marginal count comparisons in parallel with {self.processes} processes..."
+            )
+            with WorkerPool(self._get_ground_truth_counts(), self.processes) as pool:
+                results = pool.imap_kmarginal(self._get_submitted_counts(), permutations)
+            scores = [perm_scores for perm_scores, _ in results]
+            self.worker_usage = _summarize_worker_usage(usage for _, usage in results)
+        else:
+            logger.info("running k-marginal count comparisons ...")
+            scores = [
+                _apply_metric(
+                    self._dp_counts[tuple(perm)],
+                    self._gt_counts[tuple(perm)],
+                    n_group_axes=len(ALWAYS_GROUP_BY),
+                )
+                for perm in tqdm(permutations)
+            ]
+        # only the place/times observed in either the ground truth or submission are scored
+        group_counts = self.marginals.group_counts(self._gt_counts)
+        group_counts = group_counts + self.marginals.group_counts(self._dp_counts)
+        groups = np.nonzero(group_counts)
+        index = pd.MultiIndex.from_arrays(
+            [
+                codes.astype(np.int64) + _column_domain(col)[0]
+                for col, codes in zip(ALWAYS_GROUP_BY, groups)
+            ],
+            names=ALWAYS_GROUP_BY,
+        )
+        # a row for each place/time and a column for each of the k-marginal permutations
+        score_df = pd.DataFrame(
+            np.column_stack([perm_scores[groups] for perm_scores in scores]),
+            index=index,
+            columns=["-".join(perm) for perm in permutations],
         )
-        with multiprocessing.Pool(processes=self.processes) as pool:
-            iters = pool.imap(_kmarginal_from_precomputed, PERMUTATIONS)
-            iters = tqdm(iters, total=len(PERMUTATIONS))
-            scores = list(iters)
-        # join all the place/time-respective scores horizontally into a dataframe with a row for
-        # each place/time and a column for each of the k-marginal permutations
-        score_df = pd.concat(scores, axis=1, ignore_index=False, join="outer")
         return score_df
 
-    def scaled_k_marginal_score(self):
-        # get the matrix of scores for each place/time (row) and k-col permutation (col)
-        score_df = self.k_marginal_scores()
+    def scaled_k_marginal_score(self, score_df=None):
+        # get the matrix of scores for each place/time (row) and k-col permutation (col),
+        # unless given one (e.g., merged from the shards of a sharded run)
+        if score_df is None:
+            score_df = self.k_marginal_scores()
         # take the row-wise mean to get the score per place/time
         self._scores = score_df.mean(axis=1)
         # get the mean of the scores per place/time for an overall score
@@ -262,102 +1976,43 @@ class TidyFormatKMarginalMetric:
         return scaled_score
 
     def pickup_dropoff_score(self):
-        counts = _get_counts(PICKUP_DROPOFF_COLS)
-        raw_score = _apply_metric(counts)
+        self._precompute_marginal_counts()
+        perm = tuple(PICKUP_DROPOFF_COLS)
+        raw_score = float(_apply_metric(self._dp_counts[perm], self._gt_counts[perm]))
         # scale to [0, 1] and reverse direction so higher is better
         scaled_score = (2.0 - raw_score) / 2.0
         return scaled_score
 
-    def higher_order_conjunction(self, n_iters=HIGHER_ORDER_CONJUNCTION_ITERS):
+    def higher_order_conjunction(
+        self, n_iters=HIGHER_ORDER_CONJUNCTION_ITERS, use_index=False
+    ):
         """
         Competition-specific implementation of the Higher Order Conjunction metric.
+
+        The draws and the ground truth's side of the comparison come from
+        `Counts.hoc_reference`, so they are only computed once for the ground truth counts.
         """
+        # per-individual counts for the ground truth and the privatized, whose columns line up
+        counts_gt = self._get_ground_truth_counts()
+        counts_dp = self._get_submitted_counts().hoc_counts
+        (
+            observed,
+            random_individuals,
+            max_diffs_to_qualify_as_similar,
+            n_similar_gt,
+        ) = counts_gt.hoc_reference(self.random_seed, n_iters, use_index)
+        n_gt, n_dp = len(counts_gt.hoc_counts), len(counts_dp)
 
-        def _count_shift_and_pickup_areas(df):
-            """
-            For each individual (row), count up the number of times each shift is observed
-            and each pickup location is observed and concatenate them into a single count
-            dataframe representing the "kind" of individual this is by WHEN they work (shift) and
-            WHERE they work (pickup_community_area).
-            """
-            by_shift = pd.pivot_table(
-                df.assign(n=1),
-                values="n",
-                index="taxi_id",
-                columns="shift",
-                aggfunc="count",
-                fill_value=0,
-            )
-            by_pickup = pd.pivot_table(
-                df.assign(n=1),
-                values="n",
-                index="taxi_id",
-                columns="pickup_community_area",
-                aggfunc="count",
-                fill_value=0,
-            )
-            return by_shift.join(by_pickup, rsuffix="p")
-
-        def _count_up_how_many_rows_are_similar(raw_counts, arr, max_diffs):
-            """
-            Given a pivot matrix of counts and a single row, figure out how many rows are within the allowable
-            limits of similarity for each column.
-            """
-            # let M be the number of taxi IDs and N be the number of columns
-            abs_err = np.abs(raw_counts - arr)  # MxN matrix of absolute diffs from arr
-            cells_within_limit = (
-                abs_err <= max_diffs
-            )  # MxN matrix of booleans saying whether diff is allowable
-            entire_row_within_limits = cells_within_limit.all(
-                axis=1
-            )  # Mx1 array of bools for whether row is similar
-            n_rows_within_limits = (
-                entire_row_within_limits.sum()
-            )  # scalar count of how many rows were similar
-            return n_rows_within_limits
-
-        # set a random seed for reproducibility
-        rng = np.random.RandomState(seed=self.random_seed)
-
-        # pivot the counts for the ground truth
-        pivoted_gt = _count_shift_and_pickup_areas(self.ground_truth)
-        n_gt, n_cols = pivoted_gt.shape
-        assert n_cols == 99
-        # pivot the counts for the privatized
-        pivoted_dp = _count_shift_and_pickup_areas(self.submitted)
-        # make sure the submitted has the same columns as the ground truth
-        pivoted_dp = (
-            pivoted_dp.reindex(columns=pivoted_gt.columns)
-            .fillna(0)
-            .values.astype(np.int)
-        )
-        pivoted_gt = pivoted_gt.values
-        n_dp, n_cols = pivoted_dp.shape
-        assert n_cols == 99
-
-        # initialize holders for counting how many individuals are similar in each data set
-        n_similar_gt = np.zeros(n_iters, dtype=np.int)
-        n_similar_dp = np.zeros(n_iters, dtype=np.int)
-        for i in trange(n_iters):
-            # choose an individual from the ground truth to represent an archetypal individual
-            random_individual = pivoted_gt[rng.randint(low=0, high=n_gt)]
-            # come up with varying "difficulties" for each feature of the count vector to count as similar
-            # to the randomly selected individual
-            max_diff_to_qualify_as_similar = rng.randint(
-                MIN_HOC_DIFF, MAX_HOC_DIFF + 1, size=n_cols
-            )
-            # number of rows in the ground truth "like" this row
-            n_similar_gt[i] = _count_up_how_many_rows_are_similar(
-                pivoted_gt, random_individual, max_diff_to_qualify_as_similar
-            )
-            # number of rows in the privatized "like" this row
-            n_similar_dp[i] = _count_up_how_many_rows_are_similar(
-                pivoted_dp, random_individual, max_diff_to_qualify_as_similar
-            )
+        # number of rows in the privatized "like" each archetypal individual
+        max_value = random_individuals.max(initial=0)
+        n_similar_dp = SimilarityCounter(
+            counts_dp, max_value, columns=observed, use_index=use_index
+        ).count(random_individuals, max_diffs_to_qualify_as_similar)
 
         # normalize the absolute counts into proportions of all individuals who are similar
         prop_gt = n_similar_gt / n_gt
-        prop_dp = n_similar_dp / n_dp
+        # (a submission with no taxis has none similar, rather than 0/0)
+        prop_dp = n_similar_dp / max(n_dp, 1)
         logger.debug(
             f"proportion errors for each of {n_iters} iterations: {(prop_gt - prop_dp).round(4)}"
         )
@@ -367,18 +2022,27 @@ class TidyFormatKMarginalMetric:
         return 1.0 - mean_absolute_error
 
     def overall_score(self):
+        with _profile_stage(self.profiler, "precompute_marginal_counts"):
+            self._precompute_marginal_counts()
+        n_rows = self.submitted_counts.n_rows
+
         logger.info("computing k-marginals...")
-        k_marginal_score = self.scaled_k_marginal_score()
+        with _profile_stage(self.profiler, "k_marginal", n_rows) as record:
+            k_marginal_score = self.scaled_k_marginal_score()
+            if self.worker_usage is not None:
+                record["workers"] = self.worker_usage
         self.report["k_marginal_score"] = k_marginal_score
         logger.success(f"RESULT [KMARGINAL]: {k_marginal_score}")
 
         logger.info("computing pickup-dropoff marginal...")
-        pickup_dropoff_score = self.pickup_dropoff_score()
+        with _profile_stage(self.profiler, "pickup_dropoff", n_rows):
+            pickup_dropoff_score = self.pickup_dropoff_score()
         self.report["pickup_dropoff_score"] = pickup_dropoff_score
         logger.success(f"RESULT [SPATIAL]: {pickup_dropoff_score}")
 
         logger.info("computing higher order conjunction...")
-        higher_order_conjunction_score = self.higher_order_conjunction()
+        with _profile_stage(self.profiler, "higher_order_conjunction", n_rows):
+            higher_order_conjunction_score = self.higher_order_conjunction()
         self.report["higher_order_conjunction"] = higher_order_conjunction_score
         logger.success(f"RESULT [HOC]: {higher_order_conjunction_score}")
 
@@ -389,84 +2053,427 @@ class TidyFormatKMarginalMetric:
         return overall_score
 
 
-def score_submission(
-    ground_truth_csv: Path,
-    submission_csv: Path,
-    parameters_json: Path = typer.Option(
-        None,
-        help="Path to parameters.json; if provided, validates the submission using the schema",
-    ),
-    report_path: Path = typer.Option(
-        None,
-        help="Output path to save a JSON report file detailing scores at the place/time level",
-    ),
-    processes: int = typer.Option(None, help="Number of parallel processes to run"),
+def _place_times(rows):
+    """ The flat index of the place/time (the codes of ALWAYS_GROUP_BY) of `PackedRows`. """
+    return np.ravel_multi_index(
+        [rows.codes(col) for col in ALWAYS_GROUP_BY],
+        [_column_domain(col)[1] for col in ALWAYS_GROUP_BY],
+    )
+
+
+def _kmarginal_place_time_scores(ground_truth_counts, rows, place_times, marginals):
+    """
+    The scores of the place/times with the (sorted) flat indices `place_times` for each
+    permutation of `marginals`, as an array with a row per place/time and a column per
+    permutation, given `PackedRows` of every submitted row in those place/times. Only those
+    place/times are compared, so unlike `k_marginal_scores` this takes time in proportion to
+    how many there are.
+    """
+    n_group_axes = len(ALWAYS_GROUP_BY)
+    group_shape = tuple(_column_domain(col)[1] for col in ALWAYS_GROUP_BY)
+    positions = np.searchsorted(place_times, _place_times(rows))
+    counter = MarginalCounter(rows, groups=positions, n_groups=len(place_times))
+    scores = []
+    for perm in marginals.permutations:
+        gt = ground_truth_counts.marginals[tuple(perm)]
+        cols = perm[n_group_axes:]
+        if isinstance(gt, SparseCounts):
+            gt = gt.select_groups(place_times, n_group_axes)
+            dp = counter.count_sparse(cols)
+        else:
+            gt = gt[np.unravel_index(place_times, group_shape)]
+            dp = counter.count(cols)
+        scores.append(_apply_metric(dp, gt, n_group_axes=1))
+    return np.column_stack(scores)
+
+
+class SubmissionSample:
+    """
+    The counts of a submission needed to estimate its scores, taken while it is streamed.
+
+    Every row is counted over `UNSAMPLED_MARGINALS` and per taxi, which is enough to score
+    the pickup-dropoff and higher order conjunction exactly, and to know which place/times
+    (pickup_community_area and shift) the k-marginal scores average over. The k-marginal
+    scores of a place/time only depend on its own rows, so they are estimated from a random
+    sample of place/times, and only those rows are kept. The place/times with ground truth rows
+    are put in a random order and the rows of the first `max_fraction` of them (but at least
+    APPROXIMATE_MIN_STRATA) are kept, so the sample at any smaller fraction is the first ones
+    of those. The others always score the maximum penalty, whatever the submission has there.
+    """
+
+    def __init__(self, ground_truth_counts, max_fraction, seed=0, marginals=DEFAULT_MARGINALS):
+        self.max_fraction = max_fraction
+        self.marginals = marginals
+        self.accumulator = CountsAccumulator(marginals=UNSAMPLED_MARGINALS)
+        # the `Counts` of every row of each epsilon, once every chunk has been counted
+        self.counts = None
+        # the packed rows kept for each epsilon, concatenated on first use
+        self._rows = defaultdict(list)
+        # ground truth rows in each place/time, indexed by `_place_times`
+        self.gt_group_counts = marginals.group_counts(ground_truth_counts.marginals).ravel()
+        observed = np.flatnonzero(self.gt_group_counts)
+        self.order = np.random.RandomState(seed=seed).permutation(observed)
+        self.n_kept = self.n_sampled(max_fraction, len(observed))
+        self._kept = np.zeros(len(self.gt_group_counts), dtype=bool)
+        self._kept[self.order[: self.n_kept]] = True
+
+    @staticmethod
+    def n_sampled(fraction, n_place_times):
+        """ The number of place/times sampled out of `n_place_times` at a `fraction`. """
+        n_sampled = max(int(np.ceil(fraction * n_place_times)), APPROXIMATE_MIN_STRATA)
+        return min(n_sampled, n_place_times)
+
+    @property
+    def row_counts(self):
+        return self.accumulator.row_counts.to_dict()
+
+    def update(self, chunk):
+        """ Count a binned chunk and keep its rows in the sampled place/times. """
+        rows = PackedRows.from_frame(chunk)
+        self.accumulator.update(rows)
+        for epsilon, epsilon_rows in rows.select(self._kept[_place_times(rows)]).partitions():
+            self._rows[epsilon].append(epsilon_rows)
+        return self
+
+    def finalize(self):
+        self.counts = self.accumulator.finalize()
+        return self
+
+    def rows(self, epsilon, place_times):
+        """ The rows of `epsilon` in the `place_times`, which must all be kept. """
+        if len(self._rows[epsilon]) != 1:
+            self._rows[epsilon] = [PackedRows.concat(self._rows[epsilon])]
+        (rows,) = self._rows[epsilon]
+        selected = np.zeros(len(self._kept), dtype=bool)
+        selected[place_times] = True
+        return rows.select(selected[_place_times(rows)])
+
+    def compared(self, epsilon):
+        """
+        The place/times of `epsilon` with both ground truth and submitted rows, which are the
+        ones the k-marginal compares, in the sample's random order, and how many of them are
+        kept.
+        """
+        counts = UNSAMPLED_MARGINALS.group_counts(self.counts[epsilon].marginals).ravel()
+        compared = self.order[counts[self.order] > 0]
+        return compared, int((counts[self.order[: self.n_kept]] > 0).sum())
+
+
+def read_submission_sample(
+    submission_path,
+    ground_truth_counts,
+    parameters=None,
+    chunk_size=CHUNK_SIZE,
+    max_fraction=APPROXIMATE_MAX_FRACTION,
+    seed=0,
+    marginals=DEFAULT_MARGINALS,
 ):
     """
-    Given the ground truth and a valid submission, compute the k-marginal score which the user would receive.
+    Stream a submission like `read_submission_counts`, validating and counting every row but
+    keeping only the rows of a `SubmissionSample` of its place/times.
     """
-    logger.info(f"reading in submission from {submission_csv}")
+    validator = None if parameters is None else SubmissionValidator(parameters)
+    sample = SubmissionSample(ground_truth_counts, max_fraction, seed=seed, marginals=marginals)
+    chunks = read_chunks(submission_path, chunk_size, binned=validator is None)
+    for chunk in tqdm(chunks, unit="chunk"):
+        if validator is not None:
+            validator.update(chunk)
+            chunk = bin_numerics(chunk)
+        sample.update(chunk)
+    if validator is not None:
+        validator.finalize()
+    return sample.finalize()
 
-    try:
-        submission_df = pd.read_csv(submission_csv, dtype=COL_TYPES)
-    except TypeError as e:
-        logger.error(f"Column {e} could not be read in as the expected data type")
-        raise typer.Exit(1)
 
-    if parameters_json is not None:
-        logger.debug("validating submission ...")
-        parameters = json.loads(parameters_json.read_text())
-        logger.debug("checking that submission matches schema ...")
-        TidyFormatKMarginalMetric._assert_sub_matches_schema(submission_df, parameters)
-        logger.debug(
-            "checking that submission meets length limits and has proper epsilons ..."
+def approximate_score(
+    ground_truth_counts,
+    sample,
+    epsilon,
+    tolerance=APPROXIMATE_TOLERANCE,
+    initial_fraction=APPROXIMATE_INITIAL_FRACTION,
+):
+    """
+    Estimate the scores for `epsilon` from a `SubmissionSample`, doubling the fraction of the
+    place/times the k-marginal scores are compared in from `initial_fraction` up to the
+    sample's `max_fraction` until the 95% interval for the overall score is at most
+    `tolerance` either side of the estimate.
+
+    The pickup-dropoff and higher order conjunction scores are exact. The k-marginal score is
+    the mean of the scores of the place/times, which are exact for those sampled, so their mean
+    is an unbiased estimate, and its interval is that of the mean of a simple random sample.
+    The place/times with rows in only one of the data sets score the maximum penalty, so they
+    are counted in exactly rather than sampled.
+    """
+    names = ["k_marginal_score", "pickup_dropoff_score", "higher_order_conjunction"]
+    metric = TidyFormatKMarginalMetric(
+        raw_actual_df=None,
+        raw_submitted_df=None,
+        ground_truth_counts=ground_truth_counts,
+        submitted_counts=sample.counts[epsilon],
+        marginals=UNSAMPLED_MARGINALS,
+    )
+    pickup_dropoff_score = metric.pickup_dropoff_score()
+    higher_order_conjunction_score = metric.higher_order_conjunction()
+
+    # every place/time with rows in either data set is scored, with the maximum penalty of 2.0
+    # for those with rows in only one
+    compared, n_kept = sample.compared(epsilon)
+    n_scored = np.count_nonzero(
+        sample.gt_group_counts
+        + UNSAMPLED_MARGINALS.group_counts(sample.counts[epsilon].marginals).ravel()
+    )
+    n_penalized = n_scored - len(compared)
+
+    fraction = min(initial_fraction, sample.max_fraction)
+    while True:
+        n_sampled = min(sample.n_sampled(fraction, len(compared)), n_kept)
+        place_times = np.sort(compared[:n_sampled])
+        rows = sample.rows(epsilon, place_times)
+        scores = _kmarginal_place_time_scores(
+            ground_truth_counts, rows, place_times, sample.marginals
+        ).mean(axis=1)
+        mean_score = scores.mean() if n_sampled else 0.0
+        raw_score = (2.0 * n_penalized + len(compared) * mean_score) / n_scored
+        if n_sampled == len(compared):
+            raw_half_width = 0.0
+        elif n_sampled < 2:
+            raw_half_width = np.inf
+        else:
+            variance = (1 - n_sampled / len(compared)) * scores.var(ddof=1) / n_sampled
+            raw_half_width = APPROXIMATE_Z * len(compared) / n_scored * np.sqrt(variance)
+        # scale to [0, 1] and reverse direction so higher is better, like
+        # `scaled_k_marginal_score`, and then to the overall score
+        k_marginal_score = (2.0 - raw_score) / 2.0
+        estimates = dict(
+            zip(names, [k_marginal_score, pickup_dropoff_score, higher_order_conjunction_score])
         )
-        TidyFormatKMarginalMetric._assert_sub_less_than_limit_and_epsilons_valid(
-            submission_df, parameters
+        estimates["overall"] = 1000.0 * np.mean(list(estimates.values()))
+        half_width = 1000.0 * raw_half_width / 2.0 / len(names)
+        logger.info(
+            f"epsilon={epsilon}: estimated score {estimates['overall']:.1f} ± {half_width:.1f} "
+            f"from {n_sampled:,} of {len(compared):,} place/times ({len(rows):,} rows)"
         )
-        logger.success("... submission is valid ✓")
+        # stop once every kept place/time is sampled, since no larger sample can be drawn
+        if half_width <= tolerance or n_sampled == n_kept or fraction >= sample.max_fraction:
+            break
+        fraction = min(2 * fraction, sample.max_fraction)
+
+    intervals = {name: [score, score] for name, score in estimates.items()}
+    for name, name_half_width in [
+        ("k_marginal_score", raw_half_width / 2.0),
+        ("overall", half_width),
+    ]:
+        intervals[name] = [estimates[name] - name_half_width, estimates[name] + name_half_width]
+
+    report = {name: estimates[name] for name in names}
+    report["confidence_intervals"] = intervals
+    report["sampled_place_times"] = n_sampled
+    report["compared_place_times"] = len(compared)
+    report["sampled_rows"] = len(rows)
+    report["rows"] = sample.row_counts[epsilon]
+    return estimates["overall"], half_width, report
 
-    logger.debug("binning submission")
-    submission_df = bin_numerics(submission_df)
 
-    logger.info(f"reading in ground truth from {ground_truth_csv}")
-    ground_truth_df = pd.read_csv(ground_truth_csv, dtype=COL_TYPES)
-    logger.debug("binning ground truth")
-    ground_truth_df = bin_numerics(ground_truth_df)
+def score_sample(ground_truth_counts, sample, tolerance=APPROXIMATE_TOLERANCE):
+    """
+    Estimate the score of each epsilon in a `SubmissionSample` with `approximate_score`,
+    returning the mean estimate and the run report, like `score_counts`. The report also has a
+    95% interval for the mean, combining the independent intervals of the epsilons.
+    """
+    epsilons = list(sample.row_counts)
+
+    def _score_epsilon(epsilon):
+        return approximate_score(ground_truth_counts, sample, epsilon, tolerance=tolerance)
+
+    with ThreadPoolExecutor(max_workers=len(epsilons)) as executor:
+        results = list(executor.map(_score_epsilon, epsilons))
+
+    mean_score = np.mean([epsilon_score for epsilon_score, _, _ in results])
+    half_width = np.sqrt(sum(h ** 2 for _, h, _ in results)) / len(results)
+    report = {
+        "details": [],
+        "per_epsilon": [epsilon_report for _, _, epsilon_report in results],
+        "approximate": True,
+        "confidence_interval": [mean_score - half_width, mean_score + half_width],
+    }
+    logger.success(
+        f"finished estimating all epsilons: OVERALL SCORE ≈ {mean_score} ± {half_width:.2f}"
+    )
+    return mean_score, report
+
 
-    if "epsilon" not in submission_df.columns:
-        submission_df["epsilon"] = None  # placeholder
+def score_counts(
+    ground_truth_counts,
+    submitted_counts,
+    processes=None,
+    pool=None,
+    profiler=None,
+    marginals=DEFAULT_MARGINALS,
+):
+    """
+    Score the counts of each epsilon of a submission (as from `CountsAccumulator.finalize`)
+    against the ground truth counts, both of the `MarginalSpec` `marginals`, returning the
+    mean score and the run report. The epsilons are scored concurrently; `pool` may be a warm
+    `WorkerPool` for the same ground truth counts to run the k-marginal comparisons in.
+    """
+    n_rows = sum(counts.n_rows for counts in submitted_counts.values())
+    epsilons = list(submitted_counts)
 
-    epsilons = submission_df["epsilon"].unique()
-    scores_per_epsilon = []
-    report = {"details": [], "per_epsilon": []}
-    for epsilon in epsilons:
-        epsilon_mask = submission_df.epsilon == epsilon
-        n_rows = epsilon_mask.sum()
+    def _score_epsilon(epsilon):
         logger.info(
-            f"initializing metric for epsilon={epsilon} ({n_rows:,} rows of {len(submission_df):,} in submission)"
+            f"initializing metric for epsilon={epsilon} "
+            f"({submitted_counts[epsilon].n_rows:,} rows of {n_rows:,} in submission)"
         )
         metric = TidyFormatKMarginalMetric(
-            raw_actual_df=ground_truth_df,
-            raw_submitted_df=submission_df.loc[epsilon_mask, :],
+            raw_actual_df=None,
+            raw_submitted_df=None,
             processes=processes,
+            ground_truth_counts=ground_truth_counts,
+            submitted_counts=submitted_counts[epsilon],
+            pool=pool,
+            profiler=None if profiler is None else profiler.bind(epsilon=epsilon),
+            marginals=marginals,
         )
 
         logger.info(f"starting calculation for epsilon={epsilon}")
         epsilon_score = metric.overall_score()
+        logger.success(f"score for epsilon {epsilon}: {epsilon_score}")
+        return epsilon_score, metric.report
 
-        # save out some records from this run if the user would like to output a report
-        if report_path is not None:
-            report["per_epsilon"].append(metric.report)
+    # the ground truth counts are shared and every epsilon is scored concurrently, in one pool
+    # of workers started before the threads (rather than a pool forked by each of them)
+    with ExitStack() as stack:
+        if pool is None and processes is not None and processes > 1:
+            logger.info(f"starting a pool of {processes} workers")
+            pool = stack.enter_context(WorkerPool(ground_truth_counts, processes))
+        with ThreadPoolExecutor(max_workers=len(epsilons)) as executor:
+            results = list(executor.map(_score_epsilon, epsilons))
 
-        logger.success(f"score for epsilon {epsilon}: {epsilon_score}")
-        scores_per_epsilon.append(epsilon_score)
+    scores_per_epsilon = [epsilon_score for epsilon_score, _ in results]
+    # save out some records from this run if the user would like to output a report
+    report = {
+        "details": [],
+        "per_epsilon": [epsilon_report for _, epsilon_report in results],
+    }
 
     score_dict = dict(zip(epsilons, scores_per_epsilon))
     mean_score = np.mean(scores_per_epsilon)
     logger.success(
         f"finished scoring all epsilons: OVERALL SCORE = {mean_score} (per epsilon: {score_dict})"
     )
+    return mean_score, report
+
+
+def score_submission(
+    ground_truth_csv: Path,
+    submission_csv: Path,
+    parameters_json: Path = typer.Option(
+        None,
+        help="Path to parameters.json; if provided, validates the submission using the schema",
+    ),
+    report_path: Path = typer.Option(
+        None,
+        help="Output path to save a JSON report file detailing scores at the place/time level",
+    ),
+    processes: int = typer.Option(
+        None,
+        help="Number of parallel processes to run; by default scores in a single process",
+    ),
+    cache_dir: Path = typer.Option(
+        CACHE_DIR,
+        help="Directory in which ground truth counts are cached between runs",
+    ),
+    no_cache: bool = typer.Option(
+        False, "--no-cache", help="Always recompute the ground truth counts"
+    ),
+    chunk_size: int = typer.Option(
+        CHUNK_SIZE, help="Number of submission rows to read and count at a time"
+    ),
+    profile: bool = typer.Option(
+        False,
+        "--profile",
+        help="Record the time, CPU, peak memory and rows of each stage in the report",
+    ),
+    profile_events: Path = typer.Option(
+        None, help="Path to also append each profiled stage to as a JSON line; implies --profile"
+    ),
+    approximate: bool = typer.Option(
+        False,
+        "--approximate",
+        help="Estimate the scores from a sample of the place/times, with 95% intervals",
+    ),
+    tolerance: float = typer.Option(
+        APPROXIMATE_TOLERANCE,
+        help="With --approximate, stop sampling once the interval is within this many points",
+    ),
+    incremental: bool = typer.Option(
+        False,
+        "--incremental",
+        help="Cache the submission's counts and only recount the parts of it that changed",
+    ),
+    marginal_order: int = typer.Option(
+        MARGINAL_ORDER,
+        help="Number of marginal columns in each k-marginal, besides the place and time",
+    ),
+    marginal_cols: List[str] = typer.Option(
+        None,
+        "--marginal-col",
+        help="Column to take the k-marginals over; may be given more than once (default: all)",
+    ),
+):
+    """
+    Given the ground truth and a valid submission, compute the k-marginal score which the user would receive.
+
+    Either file may be CSV, Parquet (.parquet), Feather (.feather) or a directory of
+    memory-mapped .npy columns (.npy), chosen by its extension.
+    """
+    parameters = None
+    if parameters_json is not None:
+        parameters = json.loads(parameters_json.read_text())
+
+    try:
+        marginals = MarginalSpec(marginal_order, marginal_cols or MARGINAL_COLS)
+    except ValueError as e:
+        logger.error(str(e))
+        raise typer.Exit(1)
+
+    profiler = None
+    if profile or profile_events is not None:
+        profiler = StageProfiler(events_path=profile_events)
+
+    if approximate:
+        mean_score, report = _score_submission_sample(
+            ground_truth_csv,
+            submission_csv,
+            parameters=parameters,
+            cache_dir=None if no_cache else cache_dir,
+            chunk_size=chunk_size,
+            tolerance=tolerance,
+            profiler=profiler,
+            marginals=marginals,
+        )
+    else:
+        mean_score, report = _score_submission_counts(
+            ground_truth_csv,
+            submission_csv,
+            parameters=parameters,
+            processes=processes,
+            cache_dir=None if no_cache else cache_dir,
+            chunk_size=chunk_size,
+            profiler=profiler,
+            incremental=incremental,
+            marginals=marginals,
+        )
+    if profiler is not None:
+        profiler.close()
+        report["profile"] = profiler.records
+        for record in profiler.records:
+            logger.info(
+                f"profile: {record['stage']} (epsilon={record.get('epsilon')}, "
+                f"rows={record['rows']}): {record['wall_seconds']:.2f}s wall, "
+                f"{record['cpu_seconds']:.2f}s cpu, "
+                f"{record['peak_rss_bytes'] / 2 ** 20:.0f} MiB peak RSS"
+            )
 
     if report_path is not None:
         with report_path.open("w") as fp:
@@ -476,5 +2483,246 @@ def score_submission(
     return mean_score
 
 
+def _score_submission_counts(
+    ground_truth_csv,
+    submission_csv,
+    parameters,
+    processes,
+    cache_dir,
+    chunk_size,
+    profiler,
+    incremental=False,
+    marginals=DEFAULT_MARGINALS,
+):
+    """
+    Read and count the whole submission (or with `incremental`, the parts of it that are not
+    in the `SubmissionCache`) and score it exactly for `score_submission`.
+    """
+    if incremental and cache_dir is None:
+        logger.warning("--incremental needs the cache; counting the whole submission")
+        incremental = False
+    # set as soon as reading either file fails, so that the other stops at its next chunk
+    cancelled = threading.Event()
+
+    def _read_ground_truth_counts():
+        try:
+            with _profile_stage(profiler, "read_ground_truth_counts") as record:
+                ground_truth_counts = GroundTruthCounts.from_file(
+                    ground_truth_csv,
+                    cache_dir=cache_dir,
+                    chunk_size=chunk_size,
+                    cancelled=cancelled,
+                    marginals=marginals,
+                )
+                record["rows"] = ground_truth_counts.n_rows
+            return ground_truth_counts
+        except BaseException:
+            cancelled.set()
+            raise
+
+    logger.info(
+        f"reading in, validating and counting submission from {submission_csv} "
+        f"in chunks of {chunk_size:,} rows, and the ground truth from {ground_truth_csv} "
+        "alongside it"
+    )
+    accumulator = None
+    # the ground truth does not depend on the submission, so it is read, binned and counted
+    # in the background while the submission is
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        ground_truth_future = executor.submit(_read_ground_truth_counts)
+        try:
+            with _profile_stage(profiler, "read_submission_counts") as record:
+                if incremental:
+                    submitted_counts = SubmissionCache(cache_dir, marginals=marginals).read(
+                        submission_csv,
+                        parameters=parameters,
+                        chunk_size=chunk_size,
+                        cancelled=cancelled,
+                    )
+                    record["rows"] = sum(
+                        counts.n_rows for counts in submitted_counts.values()
+                    )
+                else:
+                    accumulator = read_submission_counts(
+                        submission_csv,
+                        parameters=parameters,
+                        chunk_size=chunk_size,
+                        cancelled=cancelled,
+                        marginals=marginals,
+                    )
+                    record["rows"] = int(accumulator.row_counts.sum())
+        except CancelledError:
+            # reading the ground truth failed first; raise its error
+            ground_truth_future.result()
+            raise
+        except TypeError as e:
+            cancelled.set()
+            logger.error(f"Column {e} could not be read in as the expected data type")
+            raise typer.Exit(1)
+        except BaseException:
+            cancelled.set()
+            raise
+        if parameters is not None:
+            logger.success("... submission is valid ✓")
+        ground_truth_counts = ground_truth_future.result()
+
+    if accumulator is not None:
+        with _profile_stage(profiler, "finalize_submission_counts"):
+            submitted_counts = accumulator.finalize()
+
+    return score_counts(
+        ground_truth_counts,
+        submitted_counts,
+        processes=processes,
+        profiler=profiler,
+        marginals=marginals,
+    )
+
+
+def _score_submission_sample(
+    ground_truth_csv,
+    submission_csv,
+    parameters,
+    cache_dir,
+    chunk_size,
+    tolerance,
+    profiler,
+    marginals=DEFAULT_MARGINALS,
+):
+    """
+    Estimate the scores of the submission from a sample of its place/times for
+    `score_submission`. The ground truth counts are read first since the place/times are
+    sampled from theirs.
+    """
+    with _profile_stage(profiler, "read_ground_truth_counts") as record:
+        ground_truth_counts = GroundTruthCounts.from_file(
+            ground_truth_csv, cache_dir=cache_dir, chunk_size=chunk_size, marginals=marginals
+        )
+        record["rows"] = ground_truth_counts.n_rows
+
+    logger.info(
+        f"reading in, validating and sampling submission from {submission_csv} "
+        f"in chunks of {chunk_size:,} rows"
+    )
+    try:
+        with _profile_stage(profiler, "read_submission_sample") as record:
+            sample = read_submission_sample(
+                submission_csv,
+                ground_truth_counts,
+                parameters=parameters,
+                chunk_size=chunk_size,
+                marginals=marginals,
+            )
+            record["rows"] = sum(sample.row_counts.values())
+    except TypeError as e:
+        logger.error(f"Column {e} could not be read in as the expected data type")
+        raise typer.Exit(1)
+    if parameters is not None:
+        logger.success("... submission is valid ✓")
+
+    with _profile_stage(profiler, "approximate_score"):
+        return score_sample(ground_truth_counts, sample, tolerance=tolerance)
+
+
+def _submission_files(paths):
+    """ Expand any directories in `paths` into the files in them in a supported format. """
+    for path in paths:
+        if path.is_dir() and path.suffix.lower() not in FILE_FORMATS:
+            yield from sorted(
+                child for child in path.iterdir() if child.suffix.lower() in FILE_FORMATS
+            )
+        else:
+            yield path
+
+
+def score_many(
+    ground_truth_csv: Path,
+    submissions: List[Path] = typer.Argument(
+        ..., help="Submission files, or directories of submission files, to score"
+    ),
+    parameters_json: Path = typer.Option(
+        None,
+        help="Path to parameters.json; if provided, validates each submission using the schema",
+    ),
+    output_path: Path = typer.Option(
+        None,
+        help="Path to save the table of scores per submission and epsilon (CSV, Parquet, ...)",
+    ),
+    processes: int = typer.Option(
+        None,
+        help="Number of parallel processes to score submissions in; by default uses one",
+    ),
+    cache_dir: Path = typer.Option(
+        CACHE_DIR,
+        help="Directory in which ground truth counts are cached between runs",
+    ),
+    no_cache: bool = typer.Option(
+        False, "--no-cache", help="Always recompute the ground truth counts"
+    ),
+    chunk_size: int = typer.Option(
+        CHUNK_SIZE, help="Number of submission rows to read and count at a time"
+    ),
+):
+    """
+    Score many submissions against the same ground truth, whose counts are computed once and
+    shared by a single pool of worker processes that each score whole submissions.
+    """
+    parameters = None
+    if parameters_json is not None:
+        parameters = json.loads(parameters_json.read_text())
+    submission_paths = list(_submission_files(submissions))
+
+    ground_truth_counts = GroundTruthCounts.from_file(
+        ground_truth_csv,
+        cache_dir=None if no_cache else cache_dir,
+        chunk_size=chunk_size,
+    )
+
+    logger.info(f"scoring {len(submission_paths):,} submissions against {ground_truth_csv}")
+    if processes is not None and processes > 1:
+        # the workers memory-map the ground truth counts rather than each getting a copy
+        with shared_counts(ground_truth_counts) as gt_path, multiprocessing.Pool(
+            processes=processes,
+            initializer=_init_scoring_worker,
+            initargs=(str(gt_path), parameters, chunk_size),
+        ) as pool:
+            iters = pool.imap(_score_submission_file, submission_paths)
+            results = list(tqdm(iters, total=len(submission_paths), unit="submission"))
+    else:
+        _init_scoring_worker(ground_truth_counts, parameters, chunk_size)
+        results = [_score_submission_file(path) for path in submission_paths]
+
+    columns = [
+        "submission",
+        "epsilon",
+        "n_rows",
+        "k_marginal_score",
+        "pickup_dropoff_score",
+        "higher_order_conjunction",
+        "score",
+        "error",
+    ]
+    scores_df = pd.DataFrame(
+        [record for records in results for record in records], columns=columns
+    ).astype({"n_rows": "Int64"})
+    mean_scores = scores_df.groupby("submission", sort=False)["score"].mean()
+    logger.success(
+        f"finished scoring {len(submission_paths):,} submissions; OVERALL SCORES:\n"
+        + mean_scores.to_string()
+    )
+
+    if output_path is not None:
+        logger.info(f"writing out scores to {output_path}")
+        write_table(scores_df, output_path)
+        logger.success(f"wrote out scores to {output_path}")
+    return scores_df
+
+
 if __name__ == "__main__":
-    typer.run(score_submission)
+    # `metric.py score-many GROUND_TRUTH SUBMISSION...` scores a batch of submissions;
+    # otherwise the arguments are those of `score_submission`
+    if sys.argv[1:2] == ["score-many"]:
+        del sys.argv[1]
+        typer.run(score_many)
+    else:
+        typer.run(score_submission)
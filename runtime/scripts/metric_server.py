@@ -0,0 +1,203 @@
+"""
+Serve the scoring metric in `metric.py` over HTTP, keeping the ground truth counts in memory.
+
+The ground truth is read, binned and counted (or loaded from the cache) once when the server
+starts, along with a warm worker pool holding its counts if `--processes` is more than one,
+so each request only pays for reading and counting its submission. Endpoints:
+
+    GET  /health  the ground truth being scored against and the number of its rows
+    POST /score   score a submission and return the report `metric.py --report-path` writes,
+                  with the mean score under "score". The body is either JSON naming a file
+                  on this machine, `{"submission_path": "/path/to/submission.csv"}`, or the
+                  submission file itself with a `?format=csv|parquet|feather` query (CSV by
+                  default). Invalid submissions get a 400 response with the error.
+"""
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from pathlib import Path
+import signal
+import sys
+import tempfile
+from urllib.parse import parse_qs, urlparse
+
+from loguru import logger
+import numpy as np
+import typer
+
+from metric import (
+    CACHE_DIR,
+    CHUNK_SIZE,
+    GroundTruthCounts,
+    WorkerPool,
+    read_submission_counts,
+    score_counts,
+)
+
+UPLOAD_FORMATS = ("csv", "parquet", "feather")
+
+
+class ScoringService:
+    """
+    Scores submissions against one ground truth whose counts are computed (or loaded from the
+    cache in `cache_dir`) once, validating them against `parameters` if given.
+    """
+
+    def __init__(
+        self,
+        ground_truth_path,
+        parameters=None,
+        processes=None,
+        cache_dir=CACHE_DIR,
+        chunk_size=CHUNK_SIZE,
+    ):
+        self.ground_truth_path = ground_truth_path
+        self.parameters = parameters
+        self.processes = processes
+        self.chunk_size = chunk_size
+
+        self.ground_truth_counts = GroundTruthCounts.from_file(
+            ground_truth_path, cache_dir=cache_dir, chunk_size=chunk_size
+        )
+        self.pool = None
+        if processes is not None and processes > 1:
+            logger.info(f"starting a pool of {processes} workers")
+            self.pool = WorkerPool(self.ground_truth_counts, processes)
+
+    def score(self, submission_path):
+        """ Return the report for the submission at `submission_path`, with its mean score. """
+        accumulator = read_submission_counts(
+            submission_path, parameters=self.parameters, chunk_size=self.chunk_size
+        )
+        mean_score, report = score_counts(
+            self.ground_truth_counts,
+            accumulator.finalize(),
+            processes=self.processes,
+            pool=self.pool,
+        )
+        return {"score": mean_score, **report}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """ Handles requests for the `ScoringService` held by the server as `server.service`. """
+
+    def _send_json(self, status, body):
+        content = json.dumps(body, default=_to_json).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        service = self.server.service
+        if urlparse(self.path).path != "/health":
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": f"unknown path {self.path}"})
+            return
+        self._send_json(
+            HTTPStatus.OK,
+            {
+                "status": "ok",
+                "ground_truth": str(service.ground_truth_path),
+                "ground_truth_rows": service.ground_truth_counts.n_rows,
+            },
+        )
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/score":
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": f"unknown path {self.path}"})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        try:
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                report = self.server.service.score(
+                    Path(json.loads(body)["submission_path"])
+                )
+            else:
+                file_format = parse_qs(url.query).get("format", ["csv"])[0]
+                if file_format not in UPLOAD_FORMATS:
+                    raise ValueError(
+                        f"format must be one of {UPLOAD_FORMATS}, not {file_format!r}"
+                    )
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    submission_path = Path(tmp_dir) / f"submission.{file_format}"
+                    submission_path.write_bytes(body)
+                    report = self.server.service.score(submission_path)
+        except (KeyError, ValueError, OSError) as e:
+            logger.error(f"could not score submission: {e}")
+            self._send_json(HTTPStatus.BAD_REQUEST, {"error": str(e)})
+        except TypeError as e:
+            message = f"Column {e} could not be read in as the expected data type"
+            logger.error(message)
+            self._send_json(HTTPStatus.BAD_REQUEST, {"error": message})
+        else:
+            self._send_json(HTTPStatus.OK, report)
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} - {format % args}")
+
+
+def _to_json(value):
+    """ Convert the numpy scalars in a report to plain Python for `json.dumps`. """
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def main(
+    ground_truth_csv: Path,
+    parameters_json: Path = typer.Option(
+        None,
+        help="Path to parameters.json; if provided, validates each submission using the schema",
+    ),
+    host: str = typer.Option("127.0.0.1", help="Address to listen on"),
+    port: int = typer.Option(8000, help="Port to listen on"),
+    processes: int = typer.Option(
+        None, help="Number of worker processes to keep running for the k-marginal scores"
+    ),
+    cache_dir: Path = typer.Option(
+        CACHE_DIR, help="Directory in which ground truth counts are cached between runs"
+    ),
+    no_cache: bool = typer.Option(
+        False, "--no-cache", help="Always recompute the ground truth counts"
+    ),
+    chunk_size: int = typer.Option(
+        CHUNK_SIZE, help="Number of submission rows to read and count at a time"
+    ),
+):
+    """
+    Serve k-marginal scores for submissions against the ground truth until interrupted.
+    """
+    parameters = None
+    if parameters_json is not None:
+        parameters = json.loads(parameters_json.read_text())
+
+    service = ScoringService(
+        ground_truth_csv,
+        parameters=parameters,
+        processes=processes,
+        cache_dir=None if no_cache else cache_dir,
+        chunk_size=chunk_size,
+    )
+    server = ThreadingHTTPServer((host, port), ScoringRequestHandler)
+    server.service = service
+    # shut down cleanly when stopped by a process manager as well as by ctrl-c
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.success(f"scoring submissions against {ground_truth_csv} at http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("shutting down")
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    typer.run(main)
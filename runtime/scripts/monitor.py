@@ -0,0 +1,289 @@
+"""
+Run one phase of a submission run (a command) while sampling the resources it uses, and add
+what it used to a JSON summary.
+
+`entrypoint.sh` runs each phase (unpacking the submission, running it, copying its
+`submission.csv` and validating it) through this script, so the summary written next to
+`log.txt` shows whether a slow run was CPU-bound (CPU time close to wall time), I/O-bound
+(little CPU time, many bytes read or written) or swapping (swap in use, major page faults).
+The command and every process it starts are sampled from /proc every `--interval` seconds for
+their CPU time, resident and swapped memory, bytes read and written and number of processes.
+If a wall-clock or memory limit is given and the phase goes over it, the whole process group
+is stopped, the limit is reported (and written to `--limit-file`, if given, since the command
+could exit with any status itself) and this script exits with `LIMIT_EXIT_CODE`.
+
+Only the standard library is used because this runs with the base Python of the image rather
+than the submission's environment.
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+import resource
+import signal
+import subprocess
+import sys
+import time
+
+LIMIT_EXIT_CODE = 124
+SAMPLE_INTERVAL = 0.5
+# seconds between asking the process group to stop and killing it
+STOP_GRACE_PERIOD = 10
+MIB = 2 ** 20
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def _read_proc(pid, name):
+    try:
+        return Path(f"/proc/{pid}/{name}").read_text()
+    except OSError:
+        # the process exited between listing and reading it, or belongs to another user
+        return None
+
+
+def _session_pids(sid):
+    """ Return the ids of the live processes in session `sid`. """
+    pids = []
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        stat = _read_proc(entry.name, "stat")
+        # the command name in parentheses may contain spaces, so split after its closing one
+        if stat is not None and int(stat.rsplit(")", 1)[1].split()[3]) == sid:
+            pids.append(int(entry.name))
+    return pids
+
+
+def _process_sample(pid):
+    """
+    Return the CPU seconds, resident and swapped bytes and the cumulative bytes read and written
+    by process `pid`, or None if it has gone.
+    """
+    stat = _read_proc(pid, "stat")
+    status = _read_proc(pid, "status")
+    if stat is None or status is None:
+        return None
+    fields = stat.rsplit(")", 1)[1].split()
+    sample = {
+        "cpu_seconds": (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+        "rss_bytes": int(fields[21]) * PAGE_SIZE,
+        "swap_bytes": 0,
+        "read_bytes": 0,
+        "write_bytes": 0,
+    }
+    for line in status.splitlines():
+        if line.startswith("VmSwap:"):
+            sample["swap_bytes"] = int(line.split()[1]) * 1024
+    io = _read_proc(pid, "io")
+    if io is not None:
+        counters = dict(line.split(": ") for line in io.splitlines())
+        sample["read_bytes"] = int(counters["read_bytes"])
+        sample["write_bytes"] = int(counters["write_bytes"])
+    return sample
+
+
+class ResourceMonitor:
+    """
+    Accumulates samples of the processes in one session. Cumulative counters (CPU time, bytes
+    read and written) are kept per process at their last sampled value so that processes which
+    have exited still count; memory and process counts are kept at their peak.
+    """
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.cumulative = {}
+        self.peak_rss_bytes = 0
+        self.peak_swap_bytes = 0
+        self.peak_processes = 0
+        self.processes_seen = set()
+        self.samples = 0
+
+    def sample(self):
+        rss_bytes = swap_bytes = 0
+        pids = _session_pids(self.sid)
+        for pid in pids:
+            sample = _process_sample(pid)
+            if sample is None:
+                continue
+            self.cumulative[pid] = {
+                k: sample[k] for k in ("cpu_seconds", "read_bytes", "write_bytes")
+            }
+            rss_bytes += sample["rss_bytes"]
+            swap_bytes += sample["swap_bytes"]
+        self.processes_seen.update(pids)
+        self.peak_rss_bytes = max(self.peak_rss_bytes, rss_bytes)
+        self.peak_swap_bytes = max(self.peak_swap_bytes, swap_bytes)
+        self.peak_processes = max(self.peak_processes, len(pids))
+        self.samples += 1
+        return rss_bytes
+
+    def total(self, name):
+        return sum(counters[name] for counters in self.cumulative.values())
+
+
+def _stop(process):
+    """ Stop the process group led by `process`, killing it if it has not exited in time. """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(STOP_GRACE_PERIOD)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def monitor(command, time_limit=None, memory_limit=None, interval=SAMPLE_INTERVAL):
+    """
+    Run `command`, sampling it every `interval` seconds and stopping it if it runs for more than
+    `time_limit` seconds or its processes together hold more than `memory_limit` bytes.
+    Return its exit code (`LIMIT_EXIT_CODE` if it was stopped) and what it used.
+    """
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.monotonic()
+    # a new session, so that everything the command starts can be found and stopped together
+    process = subprocess.Popen(command, start_new_session=True)
+    sampler = ResourceMonitor(process.pid)
+    limit_exceeded = None
+
+    while process.poll() is None:
+        rss_bytes = sampler.sample()
+        elapsed = time.monotonic() - start
+        if time_limit is not None and elapsed > time_limit:
+            limit_exceeded = f"the wall-clock limit of {time_limit:g} seconds"
+        elif memory_limit is not None and rss_bytes > memory_limit:
+            limit_exceeded = (
+                f"the memory limit of {memory_limit / MIB:.0f} MiB "
+                f"(its processes held {rss_bytes / MIB:.0f} MiB)"
+            )
+        if limit_exceeded is not None:
+            _stop(process)
+            break
+        try:
+            process.wait(interval)
+        except subprocess.TimeoutExpired:
+            pass
+    returncode = process.wait()
+    wall_seconds = time.monotonic() - start
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    # rusage covers every process that was waited for, including those that exited between
+    # samples, but its peak RSS is that of the largest single process
+    user_seconds = usage.ru_utime - usage_before.ru_utime
+    system_seconds = usage.ru_stime - usage_before.ru_stime
+    cpu_seconds = max(user_seconds + system_seconds, sampler.total("cpu_seconds"))
+    summary = {
+        "command": command,
+        "returncode": returncode,
+        "wall_seconds": wall_seconds,
+        "user_seconds": user_seconds,
+        "system_seconds": system_seconds,
+        "cpu_seconds": cpu_seconds,
+        "cpu_utilization": cpu_seconds / wall_seconds if wall_seconds > 0 else 0.0,
+        "peak_rss_bytes": max(sampler.peak_rss_bytes, usage.ru_maxrss * 1024),
+        "peak_swap_bytes": sampler.peak_swap_bytes,
+        "major_page_faults": usage.ru_majflt - usage_before.ru_majflt,
+        "read_bytes": sampler.total("read_bytes"),
+        "write_bytes": sampler.total("write_bytes"),
+        "peak_processes": sampler.peak_processes,
+        "processes": len(sampler.processes_seen),
+        "samples": sampler.samples,
+        "limit_exceeded": limit_exceeded,
+    }
+    if (
+        limit_exceeded is None
+        and memory_limit is not None
+        and summary["peak_rss_bytes"] > memory_limit
+    ):
+        # a peak between samples, only seen once the command has exited
+        limit_exceeded = (
+            f"the memory limit of {memory_limit / MIB:.0f} MiB "
+            f"(a process held {summary['peak_rss_bytes'] / MIB:.0f} MiB)"
+        )
+        summary["limit_exceeded"] = limit_exceeded
+    if limit_exceeded is not None:
+        summary["returncode"] = LIMIT_EXIT_CODE
+    return summary
+
+
+def add_to_summary(summary_path, phase, phase_summary):
+    """ Add the resources used by `phase` to the JSON summary at `summary_path`. """
+    summary = {"phases": {}}
+    if summary_path.exists():
+        summary = json.loads(summary_path.read_text())
+    summary["phases"][phase] = phase_summary
+    phases = summary["phases"].values()
+    summary["wall_seconds"] = sum(p["wall_seconds"] for p in phases)
+    summary["cpu_seconds"] = sum(p["cpu_seconds"] for p in phases)
+    summary["peak_rss_bytes"] = max(p["peak_rss_bytes"] for p in phases)
+    summary_path.write_text(json.dumps(summary, indent=2))
+
+
+def _size(value):
+    """ Parse a size in bytes with an optional K, M, G or T suffix (powers of 1024). """
+    suffixes = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in suffixes:
+        return int(float(value[:-1]) * suffixes[value[-1]])
+    return int(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--phase", required=True, help="Name of the phase in the summary")
+    parser.add_argument(
+        "--summary", type=Path, required=True, help="JSON file to add the phase's resources to"
+    )
+    parser.add_argument(
+        "--time-limit", type=float, help="Stop the phase after this many seconds"
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=_size,
+        help="Stop the phase if its processes together hold more resident memory, e.g. 16G",
+    )
+    parser.add_argument(
+        "--interval", type=float, default=SAMPLE_INTERVAL, help="Seconds between samples"
+    )
+    parser.add_argument(
+        "--limit-file",
+        type=Path,
+        help="File to write the limit exceeded to, only if the phase is stopped for it",
+    )
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="Command to run, after --")
+    args = parser.parse_args(argv)
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    if not command:
+        parser.error("no command to run")
+
+    phase_summary = monitor(
+        command,
+        time_limit=args.time_limit,
+        memory_limit=args.memory_limit,
+        interval=args.interval,
+    )
+    add_to_summary(args.summary, args.phase, phase_summary)
+    print(
+        f"[{args.phase}] {phase_summary['wall_seconds']:.1f}s wall, "
+        f"{phase_summary['cpu_seconds']:.1f}s CPU, "
+        f"{phase_summary['peak_rss_bytes'] / MIB:.0f} MiB peak RSS, "
+        f"{phase_summary['read_bytes'] / MIB:.0f} MiB read, "
+        f"{phase_summary['write_bytes'] / MIB:.0f} MiB written, "
+        f"{phase_summary['peak_processes']} processes at most",
+        flush=True,
+    )
+    if phase_summary["limit_exceeded"] is not None:
+        print(
+            f"ERROR: {args.phase} was stopped after exceeding {phase_summary['limit_exceeded']}.",
+            flush=True,
+        )
+        if args.limit_file is not None:
+            args.limit_file.write_text(phase_summary["limit_exceeded"] + "\n")
+    returncode = phase_summary["returncode"]
+    # like the shell, report a command killed by a signal as 128 plus the signal number
+    return returncode if returncode >= 0 else 128 - returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
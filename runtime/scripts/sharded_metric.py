@@ -0,0 +1,360 @@
+"""
+Score a submission in shards of place (`pickup_community_area`), so that the work, and the
+ground truth, can be spread over several processes or machines.
+
+Every k-marginal score is computed within one place/time, the pickup-dropoff counts of a place
+only come from rows picked up there, and each taxi's shift and pickup counts are sums over its
+rows, so scoring each shard of places separately and merging the results gives the same scores
+as `metric.py`:
+
+    partition    split the ground truth and submission into a directory per shard, validating
+                 the submission against parameters.json on the way
+    score-shard  score one shard directory (on any machine), writing its `result.npz`
+    merge        combine the results of every shard into the scores and report of `metric.py`
+    run          all of the above on this machine, with `--processes` standing in for nodes
+"""
+from contextlib import ExitStack
+import json
+import multiprocessing
+from pathlib import Path
+
+from loguru import logger
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+import typer
+
+from metric import (
+    ALWAYS_GROUP_BY,
+    CHUNK_SIZE,
+    COUNT_DTYPE,
+    PICKUP_DROPOFF_COLS,
+    PERMUTATIONS,
+    Counts,
+    CountsAccumulator,
+    GroundTruthCounts,
+    PackedRows,
+    SubmissionValidator,
+    TidyFormatKMarginalMetric,
+    _column_domain,
+    read_chunks,
+    read_submission_counts,
+)
+
+app = typer.Typer()
+
+MANIFEST = "manifest.json"
+RESULT = "result.npz"
+
+
+def shard_of(pickup_community_area, n_shards):
+    """ The shard of each pickup location: its code (see `_column_domain`) modulo `n_shards`. """
+    offset, _ = _column_domain("pickup_community_area")
+    return (np.asarray(pickup_community_area).astype(np.int64) - offset) % n_shards
+
+
+def _shard_dirs(output_dir, n_shards):
+    return [Path(output_dir) / f"shard-{shard:03d}" for shard in range(n_shards)]
+
+
+def _split(path, shard_paths, chunk_size, validator=None):
+    """
+    Stream `path` into a CSV file per shard, returning the epsilons (if any) in order of
+    appearance. Every shard file gets a header even if none of the rows belong to it.
+    """
+    epsilons = []
+    with ExitStack() as stack:
+        files = [stack.enter_context(shard_path.open("w")) for shard_path in shard_paths]
+        for i, chunk in enumerate(tqdm(read_chunks(path, chunk_size), unit="chunk")):
+            if validator is not None:
+                validator.update(chunk)
+            if "epsilon" in chunk.columns:
+                epsilons.extend(e for e in chunk["epsilon"].unique() if e not in epsilons)
+            shards = shard_of(chunk["pickup_community_area"], len(files))
+            for shard, fp in enumerate(files):
+                chunk[shards == shard].to_csv(fp, header=i == 0, index=False)
+    if validator is not None:
+        validator.finalize()
+    return [float(epsilon) for epsilon in epsilons]
+
+
+def partition_files(
+    ground_truth_path,
+    submission_path,
+    output_dir,
+    n_shards,
+    parameters=None,
+    chunk_size=CHUNK_SIZE,
+):
+    """
+    Split a ground truth and submission (in any of the formats `metric.py` reads) into
+    `n_shards` directories of CSV files by pickup location, along with a manifest listing the
+    shards and the epsilons of the submission.
+    """
+    output_dir = Path(output_dir)
+    shard_dirs = _shard_dirs(output_dir, n_shards)
+    for shard_dir in shard_dirs:
+        shard_dir.mkdir(parents=True, exist_ok=True)
+
+    logger.info(f"splitting submission {submission_path} into {n_shards} shards")
+    validator = None if parameters is None else SubmissionValidator(parameters)
+    epsilons = _split(
+        submission_path,
+        [shard_dir / "submission.csv" for shard_dir in shard_dirs],
+        chunk_size,
+        validator=validator,
+    )
+    logger.info(f"splitting ground truth {ground_truth_path} into {n_shards} shards")
+    _split(
+        ground_truth_path,
+        [shard_dir / "ground_truth.csv" for shard_dir in shard_dirs],
+        chunk_size,
+    )
+
+    manifest = {
+        "ground_truth": str(ground_truth_path),
+        "submission": str(submission_path),
+        "shards": [shard_dir.name for shard_dir in shard_dirs],
+        "epsilons": epsilons,
+    }
+    (output_dir / MANIFEST).write_text(json.dumps(manifest, indent=2))
+    return shard_dirs
+
+
+def _empty_counts():
+    """ Counts with no rows, for an epsilon with no rows in a shard. """
+    no_rows = PackedRows(np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))
+    (counts,) = CountsAccumulator(by_epsilon=False).update(no_rows).finalize().values()
+    return counts
+
+
+def score_shard_dir(shard_dir, epsilons, chunk_size=CHUNK_SIZE):
+    """
+    Score the ground truth and submission in a shard directory for each of `epsilons`, saving
+    what the merge needs to `result.npz` in it: the k-marginal scores of every place/time in
+    the shard, the shard's pickup-dropoff counts, and the shard's part of each taxi's counts.
+    """
+    shard_dir = Path(shard_dir)
+    logger.info(f"scoring shard {shard_dir}")
+    ground_truth_counts = GroundTruthCounts.from_file(
+        shard_dir / "ground_truth.csv", cache_dir=None, chunk_size=chunk_size
+    )
+    submitted_counts = read_submission_counts(
+        shard_dir / "submission.csv", chunk_size=chunk_size
+    ).finalize()
+
+    perm = tuple(PICKUP_DROPOFF_COLS)
+    result = {
+        "epsilons": np.array(epsilons, dtype=np.float64),
+        "gt_pickup_dropoff": ground_truth_counts.marginals[perm],
+        "gt_taxi_ids": ground_truth_counts.taxi_ids,
+        "gt_hoc_counts": ground_truth_counts.hoc_counts,
+    }
+    for i, epsilon in enumerate(epsilons):
+        counts = submitted_counts.get(epsilon) or _empty_counts()
+        metric = TidyFormatKMarginalMetric(
+            raw_actual_df=None,
+            raw_submitted_df=None,
+            ground_truth_counts=ground_truth_counts,
+            submitted_counts=counts,
+        )
+        score_df = metric.k_marginal_scores()
+        result[f"scores_{i}"] = score_df.to_numpy()
+        result[f"groups_{i}"] = score_df.index.to_frame().to_numpy()
+        result[f"dp_pickup_dropoff_{i}"] = counts.marginals[perm]
+        result[f"dp_taxi_ids_{i}"] = counts.taxi_ids
+        result[f"dp_hoc_counts_{i}"] = counts.hoc_counts
+
+    result_path = shard_dir / RESULT
+    tmp_path = shard_dir / f".{RESULT}"
+    with tmp_path.open("wb") as fp:
+        np.savez(fp, **result)
+    tmp_path.replace(result_path)
+    return result_path
+
+
+def _sum_taxi_counts(parts):
+    """ Sum the per-taxi counts of the shards, as `(taxi_ids, hoc_counts)` pairs, by taxi. """
+    taxi_ids = np.unique(np.concatenate([ids for ids, _ in parts]))
+    hoc_counts = np.zeros((len(taxi_ids), parts[0][1].shape[1]), dtype=COUNT_DTYPE)
+    for ids, counts in parts:
+        hoc_counts[np.searchsorted(taxi_ids, ids)] += counts
+    return taxi_ids, hoc_counts
+
+
+def merge_results(shard_dirs, epsilons):
+    """
+    Merge the results of every shard into the mean score and a report like that of
+    `metric.py`. The place/times of every shard are put back in order so the k-marginal scores
+    are averaged exactly as for the whole data, and the pickup-dropoff and per-taxi counts of
+    the shards are summed.
+    """
+    results = []
+    for shard_dir in shard_dirs:
+        with np.load(Path(shard_dir) / RESULT) as result:
+            results.append({name: result[name] for name in result.files})
+
+    perm = tuple(PICKUP_DROPOFF_COLS)
+    taxi_ids, hoc_counts = _sum_taxi_counts(
+        [(result["gt_taxi_ids"], result["gt_hoc_counts"]) for result in results]
+    )
+    ground_truth_counts = Counts(
+        {perm: sum(result["gt_pickup_dropoff"] for result in results)}, hoc_counts, taxi_ids
+    )
+
+    scores_per_epsilon, per_epsilon = [], []
+    for i, epsilon in enumerate(epsilons):
+        taxi_ids, hoc_counts = _sum_taxi_counts(
+            [(result[f"dp_taxi_ids_{i}"], result[f"dp_hoc_counts_{i}"]) for result in results]
+        )
+        submitted_counts = Counts(
+            {perm: sum(result[f"dp_pickup_dropoff_{i}"] for result in results)},
+            hoc_counts,
+            taxi_ids,
+        )
+        score_df = pd.DataFrame(
+            np.concatenate([result[f"scores_{i}"] for result in results]),
+            index=pd.MultiIndex.from_arrays(
+                np.concatenate([result[f"groups_{i}"] for result in results]).T,
+                names=ALWAYS_GROUP_BY,
+            ),
+            columns=["-".join(p) for p in PERMUTATIONS],
+        ).sort_index()
+
+        metric = TidyFormatKMarginalMetric(
+            raw_actual_df=None,
+            raw_submitted_df=None,
+            ground_truth_counts=ground_truth_counts,
+            submitted_counts=submitted_counts,
+        )
+        report = {
+            "k_marginal_score": metric.scaled_k_marginal_score(score_df),
+            "pickup_dropoff_score": metric.pickup_dropoff_score(),
+            "higher_order_conjunction": metric.higher_order_conjunction(),
+        }
+        epsilon_score = 1000.0 * np.mean(list(report.values()))
+        logger.success(f"score for epsilon {epsilon}: {epsilon_score}")
+        scores_per_epsilon.append(epsilon_score)
+        per_epsilon.append(report)
+
+    mean_score = np.mean(scores_per_epsilon)
+    logger.success(f"finished merging {len(results)} shards: OVERALL SCORE = {mean_score}")
+    return mean_score, {"details": [], "per_epsilon": per_epsilon}
+
+
+def _write_report(report, report_path):
+    if report_path is not None:
+        logger.info(f"writing out run report to {report_path}")
+        report_path.write_text(json.dumps(report))
+
+
+@app.command()
+def partition(
+    ground_truth_csv: Path,
+    submission_csv: Path,
+    output_dir: Path = typer.Option(..., help="Directory to write a directory per shard to"),
+    shards: int = typer.Option(8, help="Number of shards of pickup locations"),
+    parameters_json: Path = typer.Option(
+        None,
+        help="Path to parameters.json; if provided, validates the submission using the schema",
+    ),
+    chunk_size: int = typer.Option(CHUNK_SIZE, help="Number of rows to read at a time"),
+):
+    """
+    Split the ground truth and submission into shards of pickup locations.
+    """
+    parameters = None
+    if parameters_json is not None:
+        parameters = json.loads(parameters_json.read_text())
+    partition_files(
+        ground_truth_csv,
+        submission_csv,
+        output_dir,
+        shards,
+        parameters=parameters,
+        chunk_size=chunk_size,
+    )
+
+
+@app.command("score-shard")
+def score_shard(
+    shard_dir: Path,
+    chunk_size: int = typer.Option(CHUNK_SIZE, help="Number of rows to read at a time"),
+):
+    """
+    Score one shard written by `partition`, which must still be next to its manifest.
+    """
+    manifest = json.loads((shard_dir.parent / MANIFEST).read_text())
+    score_shard_dir(shard_dir, manifest["epsilons"], chunk_size=chunk_size)
+
+
+@app.command()
+def merge(
+    output_dir: Path,
+    report_path: Path = typer.Option(
+        None,
+        help="Output path to save a JSON report file detailing scores at the place/time level",
+    ),
+):
+    """
+    Merge the results of every shard in `output_dir` into the overall score.
+    """
+    manifest = json.loads((output_dir / MANIFEST).read_text())
+    shard_dirs = [output_dir / name for name in manifest["shards"]]
+    _, report = merge_results(shard_dirs, manifest["epsilons"])
+    _write_report(report, report_path)
+
+
+def _score_shard_dir(args):
+    return score_shard_dir(*args)
+
+
+@app.command()
+def run(
+    ground_truth_csv: Path,
+    submission_csv: Path,
+    output_dir: Path = typer.Option(..., help="Directory to write a directory per shard to"),
+    shards: int = typer.Option(8, help="Number of shards of pickup locations"),
+    processes: int = typer.Option(
+        None, help="Number of processes scoring shards at once; by default one at a time"
+    ),
+    parameters_json: Path = typer.Option(
+        None,
+        help="Path to parameters.json; if provided, validates the submission using the schema",
+    ),
+    report_path: Path = typer.Option(
+        None,
+        help="Output path to save a JSON report file detailing scores at the place/time level",
+    ),
+    chunk_size: int = typer.Option(CHUNK_SIZE, help="Number of rows to read at a time"),
+):
+    """
+    Partition, score every shard and merge on this machine.
+    """
+    parameters = None
+    if parameters_json is not None:
+        parameters = json.loads(parameters_json.read_text())
+    shard_dirs = partition_files(
+        ground_truth_csv,
+        submission_csv,
+        output_dir,
+        shards,
+        parameters=parameters,
+        chunk_size=chunk_size,
+    )
+    epsilons = json.loads((output_dir / MANIFEST).read_text())["epsilons"]
+
+    tasks = [(shard_dir, epsilons, chunk_size) for shard_dir in shard_dirs]
+    if processes is not None and processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            list(pool.imap_unordered(_score_shard_dir, tasks))
+    else:
+        for task in tasks:
+            _score_shard_dir(task)
+
+    _, report = merge_results(shard_dirs, epsilons)
+    _write_report(report, report_path)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,228 @@
+"""
+Read and write tables of records as CSV, Parquet, Feather or a directory of `.npy` files, chosen
+by the file extension (see `FILE_FORMATS`).
+
+This is shared by the metric scripts and, through a link in `benchmark/`, by the benchmark
+submission, so it only depends on numpy and pandas (and pyarrow for Parquet and Feather).
+"""
+from contextlib import contextmanager
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# file formats, selected by extension; ".npy" is a directory holding one .npy file per column,
+# which is read memory-mapped so that several processes can share the same pages
+FILE_FORMATS = {
+    ".csv": "csv",
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".feather": "feather",
+    ".arrow": "feather",
+    ".npy": "npy",
+}
+
+
+def file_format(path):
+    suffix = Path(path).suffix.lower()
+    if suffix not in FILE_FORMATS:
+        raise ValueError(
+            f"unsupported file type '{suffix}' for {path}; expected one of {list(FILE_FORMATS)}"
+        )
+    return FILE_FORMATS[suffix]
+
+
+def import_pyarrow(path):
+    try:
+        import pyarrow
+        import pyarrow.feather  # noqa: F401
+        import pyarrow.ipc  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        raise ImportError(f"pyarrow is required to read or write {path}")
+    return pyarrow
+
+
+def _astype(values, dtype, col):
+    """
+    Cast the values of `col` to `dtype`, without copying if they match, raising a ValueError
+    rather than letting integers that do not fit in `dtype` wrap around.
+    """
+    values, dtype = np.asarray(values), np.dtype(dtype)
+    if dtype.kind in "iu" and values.dtype != dtype and values.dtype.kind in "iuf" and len(values):
+        if values.dtype.kind == "f" and not (np.isfinite(values) & (values % 1 == 0)).all():
+            raise ValueError(f"column {col} has values that are not integers, expected {dtype}")
+        low, high, info = values.min(), values.max(), np.iinfo(dtype)
+        if low < info.min or high > info.max:
+            raise ValueError(
+                f"column {col} has values from {low} to {high}, outside the range of {dtype} "
+                f"[{info.min}, {info.max}]"
+            )
+    return values.astype(dtype, copy=False)
+
+
+def _as_types(df, dtypes, exclude=()):
+    """Cast the columns in `dtypes` to their types (see `_astype`)."""
+    for col, dtype in dtypes.items():
+        if col in df.columns and col not in exclude and df[col].dtype != dtype:
+            df[col] = _astype(df[col].to_numpy(), dtype, col)
+    return df
+
+
+def _read_csv_types(dtypes):
+    """
+    The types to read CSV columns as, with integers read as 64-bit so that `_as_types` can
+    check they fit in narrower types rather than the parser wrapping them around.
+    """
+    return {
+        col: np.int64 if np.dtype(dtype).kind in "iu" else dtype for col, dtype in dtypes.items()
+    }
+
+
+def _column_chunks(path, fmt, chunk_size):
+    """
+    Yield the columns of a Parquet, Feather or .npy table a chunk of at most `chunk_size` rows
+    at a time (or all at once if `chunk_size` is None), as a dict of numpy or pyarrow arrays,
+    and always at least one (possibly empty) chunk.
+    """
+    if fmt == "npy":
+        columns = json.loads((path / "columns.json").read_text())
+        arrays = {col: np.load(path / f"{col}.npy", mmap_mode="r") for col in columns}
+        n_rows = len(arrays[columns[0]]) if columns else 0
+        step = max(n_rows if chunk_size is None else chunk_size, 1)
+        for start in range(0, max(n_rows, 1), step):
+            yield {col: arr[start:][:step] for col, arr in arrays.items()}
+        return
+
+    pyarrow = import_pyarrow(path)
+    if fmt == "parquet":
+        if chunk_size is None:
+            table = pyarrow.parquet.read_table(path, memory_map=True)
+            yield dict(zip(table.column_names, table.columns))
+            return
+        # stream the file a batch at a time, so that at most a row group is decoded at once
+        parquet_file = pyarrow.parquet.ParquetFile(path, memory_map=True)
+        empty = True
+        for batch in parquet_file.iter_batches(batch_size=chunk_size):
+            empty = False
+            yield dict(zip(batch.schema.names, batch.columns))
+        if empty:
+            table = parquet_file.schema_arrow.empty_table()
+            yield dict(zip(table.column_names, table.columns))
+        return
+
+    # uncompressed Feather files are memory-mapped, so slicing them copies nothing
+    table = pyarrow.ipc.open_file(pyarrow.memory_map(str(path))).read_all()
+    step = max(table.num_rows if chunk_size is None else chunk_size, 1)
+    for start in range(0, max(table.num_rows, 1), step):
+        sliced = table.slice(start, step)
+        yield dict(zip(sliced.column_names, sliced.columns))
+
+
+def read_chunks(path, dtypes, chunk_size=None, converters=None):
+    """
+    Read a table of records in chunks of at most `chunk_size` rows (or all at once if
+    `chunk_size` is None) with the column types in `dtypes`. `converters` may map columns to
+    functions that replace their values (as numpy arrays of the type in `dtypes`, if any) as
+    each chunk is read; Parquet, Feather and .npy columns are converted straight from the file
+    rather than from a frame. The format is chosen by the file extension (see `FILE_FORMATS`).
+    """
+    path = Path(path)
+    fmt = file_format(path)
+    converters = converters or {}
+    if fmt == "csv":
+        read_types = _read_csv_types(dtypes)
+        if chunk_size is None:
+            chunks = [pd.read_csv(path, dtype=read_types)]
+        else:
+            chunks = pd.read_csv(path, dtype=read_types, chunksize=chunk_size)
+        for chunk in chunks:
+            chunk = _as_types(chunk, dtypes)
+            for col, convert in converters.items():
+                if col in chunk.columns:
+                    # replace the column rather than writing into it, as its type may change
+                    chunk[col] = convert(chunk[col].to_numpy())
+            yield chunk
+        return
+
+    for columns in _column_chunks(path, fmt, chunk_size):
+        column_names = list(columns)
+        converted = {}
+        for col, convert in converters.items():
+            if col in columns:
+                values = np.asarray(columns.pop(col))
+                if col in dtypes:
+                    values = _astype(values, dtypes[col], col)
+                converted[col] = convert(values)
+        if fmt == "npy":
+            chunk = pd.DataFrame(columns)
+        else:
+            chunk = import_pyarrow(path).table(columns).to_pandas()
+        # put the converted columns back where they were
+        for i, col in enumerate(column_names):
+            if col in converted:
+                chunk.insert(i, col, converted[col])
+        yield _as_types(chunk, dtypes, exclude=converted)
+
+
+def read_table(path, dtypes):
+    """Read a whole table of records; see `read_chunks`."""
+    return next(read_chunks(path, dtypes))
+
+
+def write_table(df, path):
+    """Write a table of records in the format given by the file extension of `path`."""
+    path = Path(path)
+    fmt = file_format(path)
+    if fmt == "csv":
+        df.to_csv(path, index=False)
+    elif fmt == "npy":
+        path.mkdir(parents=True, exist_ok=True)
+        for col in df.columns:
+            np.save(path / f"{col}.npy", df[col].to_numpy())
+        (path / "columns.json").write_text(json.dumps(df.columns.tolist()))
+    else:
+        pyarrow = import_pyarrow(path)
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        if fmt == "parquet":
+            pyarrow.parquet.write_table(table, path)
+        else:
+            pyarrow.feather.write_feather(table, path, compression="uncompressed")
+
+
+@contextmanager
+def table_writer(path):
+    """
+    Open a CSV, Parquet or Feather file, chosen by its extension, and yield a function that
+    appends a dataframe to it, so the file is written in one pass.
+    """
+    path = Path(path)
+    fmt = file_format(path)
+    if fmt in ("parquet", "feather"):
+        pyarrow = import_pyarrow(path)
+        writers = []
+
+        def write(df):
+            table = pyarrow.Table.from_pandas(df, preserve_index=False)
+            if not writers:
+                if fmt == "parquet":
+                    writers.append(pyarrow.parquet.ParquetWriter(str(path), table.schema))
+                else:
+                    writers.append(pyarrow.ipc.new_file(str(path), table.schema))
+            writers[0].write_table(table)
+
+        try:
+            yield write
+        finally:
+            for writer in writers:
+                writer.close()
+    elif fmt == "csv":
+        with path.open("w", newline="") as fp:
+
+            def write(df):
+                df.to_csv(fp, index=False, header=fp.tell() == 0)
+
+            yield write
+    else:
+        raise ValueError(f"{path} cannot be written a chunk at a time")
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import metric
+
+
+def _trips(rng, n_rows, n_taxis, pickup_areas):
+    """ Random trips, most of them in shifts 16-20, from `pickup_areas` only. """
+    shifts = np.arange(21)
+    shift_weights = np.where(shifts >= 16, 10.0, 1.0)
+    df = pd.DataFrame(
+        {
+            "taxi_id": rng.randint(0, n_taxis, n_rows),
+            "shift": rng.choice(shifts, n_rows, p=shift_weights / shift_weights.sum()),
+            "company_id": rng.randint(0, 5, n_rows),
+            "pickup_community_area": rng.choice(pickup_areas, n_rows),
+            "dropoff_community_area": rng.choice(pickup_areas, n_rows),
+            "payment_type": rng.randint(0, 3, n_rows),
+            "trip_day_of_week": rng.randint(0, 7, n_rows),
+            "trip_hour_of_day": rng.randint(0, 24, n_rows),
+            "fare": rng.randint(0, 60, n_rows),
+            "tips": rng.randint(0, 10, n_rows),
+            "trip_total": rng.randint(0, 70, n_rows),
+            "trip_seconds": rng.randint(0, 3000, n_rows),
+            "trip_miles": rng.randint(0, 30, n_rows),
+        }
+    )
+    return df.astype({c: t for c, t in metric.COL_TYPES.items() if c in df})
+
+
+def test_higher_order_conjunction_counts_shifts_that_are_also_pickup_areas():
+    """
+    The submission has no pickups from areas 16-20, which are also shift values, but a lot of
+    trips in shifts 16-20. The ground truth has a single pickup from each of those areas, so
+    every one of its 99 columns is observed. Before the per-taxi counts had a fixed column for
+    each shift and pickup area, the submission's counts of shifts 16-20 were dropped, and the
+    score was 0.4228.
+    """
+    rng = np.random.RandomState(0)
+    pickup_areas = np.r_[-1, 1:16, 21:78]
+    actual = _trips(rng, 5000, 50, pickup_areas)
+    actual.loc[:4, "pickup_community_area"] = np.arange(16, 21)
+    submitted = _trips(rng, 5000, 50, pickup_areas)
+
+    scorer = metric.TidyFormatKMarginalMetric(
+        metric.bin_numerics(actual), metric.bin_numerics(submitted)
+    )
+    assert scorer.higher_order_conjunction() == pytest.approx(0.9696)
@@ -13,11 +13,100 @@ SUBMISSION_PATH = ROOT_DIRECTORY / "submission.csv"
 
 NOT_USED_IN_SUBMISSION = ("trip_hour_of_day", "trip_day_of_week")
 
+# number of submission rows read at a time
+CHUNK_SIZE = 1_000_000
+
+
+def _fold(running, key, value, combine):
+    """ Fold a chunk's statistic `value` into `running[key]` with `combine`. """
+    running[key] = value if key not in running else combine(running[key], value)
+
+
+class SubmissionStats:
+    """
+    Everything the tests check about a submission, collected one chunk at a time so that the
+    memory used does not grow with the size of the submission. Each statistic of a chunk is
+    folded into that of the chunks before it by its own rule: the values seen and the columns
+    that are uncastable or not finite by set union, the minimum and maximum by min and max
+    (over the values that are numbers, since any others make the column uncastable) and the
+    rows of each epsilon and individual by sum.
+    """
+
+    def __init__(self, columns, schema):
+        self.columns = columns
+        self.schema = {c: entry for c, entry in schema.items() if c not in NOT_USED_IN_SUBMISSION}
+        self.values = {c: set() for c, entry in self.schema.items() if "values" in entry}
+        self.min = {}
+        self.max = {}
+        self.uncastable = set()
+        self.nonfinite = set()
+        self.row_counts = pd.Series(dtype=np.int64)
+        # the number of rows of each (epsilon, taxi_id)
+        self.rows_per_individual = None
+
+    def update(self, chunk):
+        for c, entry in self.schema.items():
+            if c not in chunk.columns or chunk.empty:
+                continue
+            values = chunk[c]
+            if c in self.values:
+                self.values[c] |= set(values.unique().tolist())
+            numbers = pd.to_numeric(values, errors="coerce").dropna()
+            if not numbers.empty:
+                _fold(self.min, c, numbers.min(), min)
+                _fold(self.max, c, numbers.max(), max)
+            try:
+                cast = values.astype(entry["dtype"])
+            except (ValueError, TypeError):
+                self.uncastable.add(c)
+                continue
+            if "float" in entry["dtype"] and not np.isfinite(cast.values).all():
+                self.nonfinite.add(c)
+
+        if "epsilon" in chunk.columns:
+            self.row_counts = (
+                self.row_counts.add(chunk.groupby("epsilon").size(), fill_value=0)
+                .astype(np.int64)
+            )
+            if "taxi_id" in chunk.columns:
+                counts = chunk.groupby(["epsilon", "taxi_id"]).size()
+                if self.rows_per_individual is not None:
+                    counts = self.rows_per_individual.add(counts, fill_value=0)
+                self.rows_per_individual = counts.astype(np.int64)
+
+
+def read_submission_stats(path, schema, chunk_size=CHUNK_SIZE):
+    """
+    Collect `SubmissionStats` in one pass over the submission, reading each column as the
+    64-bit type of the kind of its schema dtype (narrower integer types would silently wrap
+    values out of their range). If a column cannot be read that way the submission is read
+    again with inferred types, so that the tests can report which column is the problem.
+    """
+    columns = pd.read_csv(path, nrows=0).columns.tolist()
+    dtypes = {
+        c: {"i": "int64", "u": "int64", "f": "float64"}.get(np.dtype(entry["dtype"]).kind)
+        for c, entry in schema.items()
+        if c in columns
+    }
+    stats = SubmissionStats(columns, schema)
+    chunks = pd.read_csv(
+        path,
+        dtype={c: dtype for c, dtype in dtypes.items() if dtype is not None},
+        chunksize=chunk_size,
+    )
+    while True:
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return stats
+        except (ValueError, TypeError, OverflowError):
+            break
+        stats.update(chunk)
 
-@pytest.fixture(scope="session")
-def submission():
-    assert SUBMISSION_PATH.exists()
-    return pd.read_csv(SUBMISSION_PATH)
+    stats = SubmissionStats(columns, schema)
+    for chunk in pd.read_csv(path, chunksize=chunk_size):
+        stats.update(chunk)
+    return stats
 
 
 @pytest.fixture(scope="session")
@@ -26,6 +115,12 @@ def parameters():
         return json.load(fp)
 
 
+@pytest.fixture(scope="session")
+def submission(parameters):
+    assert SUBMISSION_PATH.exists()
+    return read_submission_stats(SUBMISSION_PATH, parameters["schema"])
+
+
 def test_first_columns_is_epsilon(submission):
     assert (
         submission.columns[0] == "epsilon"
@@ -43,7 +138,7 @@ def test_all_columns_match(submission, parameters):
         k for k in parameters["schema"].keys() if k not in NOT_USED_IN_SUBMISSION
     ]
     expected_data_columns = ["epsilon"] + columns
-    found_data_columns = submission.columns.tolist()
+    found_data_columns = submission.columns
     assert (
         found_data_columns == expected_data_columns
     ), "Submission columns not as expected"
@@ -57,17 +152,17 @@ def test_submission_matches_schema(submission, parameters):
             c in submission.columns
         ), f"expected column {c} to be in data but it was not present"
         if "values" in entry:
-            invalid_values = list(set(submission[c].tolist()) - set(entry["values"]))
+            invalid_values = list(submission.values[c] - set(entry["values"]))
             err_msg = f"column {c} contains invalid values '{invalid_values}' (accepted values '{entry['values']}')"
             assert not invalid_values, err_msg
-        if "min" in entry:
+        if "min" in entry and c in submission.min:
             err_msg = f"column {c} contains values less than minimum ({entry['min']})"
-            assert submission[c].min() >= entry["min"], err_msg
-        if "max" in entry and entry["max"] is not None:
+            assert submission.min[c] >= entry["min"], err_msg
+        if "max" in entry and entry["max"] is not None and c in submission.max:
             err_msg = (
                 f"column {c} contains values greater than maximum ({entry['max']})"
             )
-            assert submission[c].max() <= entry["max"], err_msg
+            assert submission.max[c] <= entry["max"], err_msg
 
 
 def test_max_rows_and_max_rows_per_individual(submission, parameters):
@@ -76,7 +171,7 @@ def test_max_rows_and_max_rows_per_individual(submission, parameters):
 
     # calculate the sizes of each epsilon run and add to the df
     runs_df = pd.concat(
-        [runs_df, submission.groupby("epsilon").size().rename("row_count")], axis=1
+        [runs_df, submission.row_counts.rename("row_count")], axis=1
     )
 
     # max_records + delta are nan for epsilons in submission but not in parameters.json
@@ -91,13 +186,14 @@ def test_max_rows_and_max_rows_per_individual(submission, parameters):
 
     # calculate number of records per individual
     for run in parameters["runs"]:
-        mask = submission.epsilon == run["epsilon"]
-        counts_per_individual = submission.loc[mask].taxi_id.value_counts()
+        rows_per_individual = submission.rows_per_individual
+        mask = rows_per_individual.index.get_level_values(0) == run["epsilon"]
+        counts_per_individual = rows_per_individual[mask]
         assert counts_per_individual.max() <= run["max_records_per_individual"]
 
 
 def test_epsilons_valid(submission, parameters):
-    present_epsilons = set(submission["epsilon"].unique())
+    present_epsilons = set(submission.row_counts.index)
     expected_epsilons = set([run["epsilon"] for run in parameters["runs"]])
 
     missing_epsilons = expected_epsilons - present_epsilons
@@ -116,9 +212,7 @@ def test_data_types_usable(submission, parameters):
     for c, entry in parameters["schema"].items():
         if c in NOT_USED_IN_SUBMISSION:
             continue
-        try:
-            submission[c].astype(entry["dtype"])
-        except (ValueError, TypeError):
+        if c in submission.uncastable:
             pytest.fail(f"Column {c} must be able to be cast to dtype {entry['dtype']}")
 
 
@@ -128,6 +222,6 @@ def test_all_float_values_are_finite(submission, parameters):
             continue
         dtype = entry["dtype"]
         if "float" in dtype:
-            assert np.isfinite(
-                submission[c].astype(dtype).values
-            ).all(), f"Values in column {c} must be finite (not NaN or inf)"
+            assert (
+                c not in submission.nonfinite
+            ), f"Values in column {c} must be finite (not NaN or inf)"